@@ -0,0 +1,138 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from schedule_calculator import get_interval_timedelta
+
+logger = logging.getLogger()
+
+
+def get_backfill_windows(interval_val, interval_type, start, end):
+    # the end of every epoch aligned window after start, up to the first one at or after end,
+    # the same boundaries as GROUP BY time() and the scheduled runs
+    interval = get_interval_timedelta(interval_val, interval_type)
+    epoch = datetime(1970, 1, 1, tzinfo=start.tzinfo)
+    windows = []
+    now = start
+    while now < end:
+        now = epoch + interval * ((now - epoch) // interval + 1)
+        windows.append(now)
+    return windows
+
+
+def group_windows(windows, intervals_per_window):
+    # merges every intervals_per_window consecutive windows into one, keeping the last end
+    if intervals_per_window <= 1 or len(windows) == 0:
+        return windows
+    grouped = windows[intervals_per_window - 1::intervals_per_window]
+    if grouped == [] or grouped[-1] != windows[-1]:
+        grouped.append(windows[-1])
+    return grouped
+
+
+def read_watermark(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        contents = f.read().strip()
+    if contents == "":
+        return None
+    return datetime.fromisoformat(contents)
+
+
+def write_watermark(path, watermark):
+    if path is None:
+        return
+    # write to a temporary file first so a crash never leaves a truncated watermark
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(watermark.isoformat())
+    os.replace(tmp_path, path)
+
+
+def skip_completed_windows(windows, watermark):
+    if watermark is None:
+        return windows
+    return [w for w in windows if w > watermark]
+
+
+def run_windows(windows, run_window, concurrency=1, watermark_file=None, progress_interval=10):
+    """
+    Runs run_window(now) for every window, keeping at most concurrency windows in flight.
+    Windows may complete out of order, but the watermark only advances over the contiguous
+    prefix of successfully completed windows, so resuming from it never leaves a gap.
+    Returns the number of completed and failed windows.
+    """
+    if len(windows) == 0:
+        return 0, 0
+
+    # status by window index, True for success, False for failure
+    status = {}
+    next_watermark_index = 0
+    watermark_blocked = False
+    completed = 0
+    failed = 0
+
+    start_time = time.time()
+    last_progress = start_time
+
+    def advance_watermark():
+        nonlocal next_watermark_index, watermark_blocked
+        watermark = None
+        while next_watermark_index in status:
+            if not status[next_watermark_index]:
+                # a failed window blocks the watermark so it gets re-run on resume
+                watermark_blocked = True
+                break
+            watermark = windows[next_watermark_index]
+            next_watermark_index += 1
+        if watermark is not None:
+            write_watermark(watermark_file, watermark)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        pending = iter(enumerate(windows))
+
+        def submit_next():
+            try:
+                index, window = next(pending)
+            except StopIteration:
+                return False
+            in_flight[executor.submit(run_window, window)] = index
+            return True
+
+        for _ in range(concurrency):
+            if not submit_next():
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                try:
+                    success = bool(future.result())
+                except BaseException as e:
+                    logger.error(f"Backfill window ending {windows[index]} failed with exception {str(e)}")
+                    success = False
+
+                status[index] = success
+                if success:
+                    completed += 1
+                else:
+                    failed += 1
+                submit_next()
+
+            if not watermark_blocked:
+                advance_watermark()
+
+            now = time.time()
+            if now - last_progress >= progress_interval or not in_flight:
+                elapsed = now - start_time
+                rate = (completed + failed) / elapsed if elapsed > 0 else 0.0
+                logger.info(
+                    f"Backfill progress: {completed + failed}/{len(windows)} windows, {failed} failed, {rate:.2f} windows/s")
+                last_progress = now
+
+    return completed, failed
@@ -0,0 +1,242 @@
+"""
+End to end benchmark of run() and backfill() against local stand-ins for InfluxDB: a
+pyarrow.flight server streaming synthetic downsampled results, and an HTTP endpoint
+accepting line protocol writes. Reports rows per second, peak RSS and per-stage times,
+and saves them as JSON so results can be compared between commits.
+
+    python benchmark.py --rows 100000 --tags 3 --fields 10 --output results.json
+    python benchmark.py --compare results.json
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import statistics
+import subprocess
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pyarrow as pa
+import pyarrow.flight as flight
+
+STAGES = ["query_gen_time", "query_time", "write_time"]
+
+
+class SyntheticFlightServer(flight.FlightServerBase):
+    """Answers the schema queries and streams rows shaped like InfluxQL GROUP BY results."""
+
+    def __init__(self, rows, tag_count, field_count, cardinality, chunk_rows, location="grpc+tcp://127.0.0.1:0"):
+        super().__init__(location)
+        self.rows = rows
+        self.tags = [f"tag_{t}" for t in range(tag_count)]
+        self.fields = [f"field_{f}" for f in range(field_count)]
+        self.cardinality = cardinality
+        self.chunk_rows = chunk_rows
+        self.queries = 0
+
+    def make_batch(self, rows, start_ns):
+        columns = {
+            "iox::measurement": pa.array(["cpu"] * rows).dictionary_encode(),
+            "time": pa.array([start_ns] * rows, pa.timestamp("ns", tz="UTC")),
+        }
+        for tag in self.tags:
+            columns[tag] = pa.array([f"value_{random.randrange(self.cardinality)}" for _ in range(rows)]).dictionary_encode()
+        for field in self.fields:
+            columns[field] = pa.array([random.random() * 100 for _ in range(rows)])
+        return pa.RecordBatch.from_pydict(columns)
+
+    def do_get(self, context, ticket):
+        query = json.loads(ticket.ticket.decode("utf-8"))["sql_query"]
+        if query.startswith("SHOW FIELD KEYS"):
+            table = pa.table({"fieldKey": self.fields, "fieldType": ["float"] * len(self.fields)})
+            return flight.RecordBatchStream(table)
+        if query.startswith("SHOW TAG KEYS"):
+            return flight.RecordBatchStream(pa.table({"tagKey": self.tags}))
+
+        self.queries += 1
+        match = re.search(r"time > '([^']+)'", query)
+        start = datetime.fromisoformat(match.group(1)).replace(tzinfo=timezone.utc) if match else datetime.now(timezone.utc)
+        start_ns = int(start.timestamp()) * 10**9
+        # the batches are built once per query, so generating them is not part of the measurement
+        batches = []
+        remaining = self.rows
+        while remaining > 0:
+            size = min(self.chunk_rows, remaining)
+            batches.append(self.make_batch(size, start_ns))
+            remaining -= size
+        if not batches:
+            batches.append(self.make_batch(0, start_ns))
+        # Flight streams need a single dictionary per column
+        return flight.RecordBatchStream(pa.Table.from_batches(batches).unify_dictionaries())
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        stats = self.server.write_stats
+        with stats["lock"]:
+            stats["requests"] += 1
+            stats["bytes"] += len(body)
+            stats["lines"] += body.count(b"\n") + (0 if body.endswith(b"\n") else 1)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StageRecorder:
+    """Stands in for the logging client, keeping the fields of every task_log point."""
+
+    def __init__(self):
+        self.runs = []
+
+    def write(self, record, database=None, **kwargs):
+        self.runs.append(dict(record._fields))
+
+
+def start_write_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WriteHandler)
+    server.write_stats = {"lock": threading.Lock(), "requests": 0, "bytes": 0, "lines": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def summarize(name, recorder, write_stats, elapsed):
+    rows = sum(run.get("row_count", 0) for run in recorder.runs)
+    result = {
+        "runs": len(recorder.runs),
+        "failed_runs": sum(1 for run in recorder.runs if "exception" in run),
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed > 0 else 0,
+        "write_requests": write_stats["requests"],
+        "bytes_written": write_stats["bytes"],
+        "lines_written": write_stats["lines"],
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+    for stage in STAGES:
+        values = [run[stage] for run in recorder.runs if stage in run]
+        result[f"{stage}_median"] = statistics.median(values) if values else None
+        result[f"{stage}_total"] = sum(values)
+    print(f"{name:>9}: {result['rows']:,} rows in {elapsed:.3f}s, {result['rows_per_second']:,.0f} rows/s, "
+          f"{result['write_requests']} writes, peak RSS {result['peak_rss_bytes'] / 2**20:.1f} MiB")
+    return result
+
+
+def reset_write_stats(server):
+    with server.write_stats["lock"]:
+        server.write_stats.update(requests=0, bytes=0, lines=0)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous_path):
+    with open(previous_path, "r") as f:
+        previous = json.load(f)
+    for scenario in ["run", "backfill"]:
+        if scenario not in previous or scenario not in current:
+            continue
+        before = previous[scenario]["rows_per_second"]
+        after = current[scenario]["rows_per_second"]
+        change = (after / before - 1) * 100 if before else 0
+        print(f"{scenario:>9}: {before:,.0f} -> {after:,.0f} rows/s ({change:+.1f}%) "
+              f"against {previous.get('commit') or previous_path}")
+
+
+def main(args):
+    source = SyntheticFlightServer(args.rows, args.tags, args.fields, args.cardinality, args.chunk_rows)
+    target = start_write_server()
+    os.environ.update({
+        "SOURCE_HOST": f"http://127.0.0.1:{source.port}",
+        "SOURCE_DB": "source",
+        "SOURCE_TOKEN": "benchmark",
+        "SOURCE_MEASUREMENT": "cpu",
+        "TARGET_HOST": f"http://127.0.0.1:{target.server_port}",
+        "TARGET_DB": "target",
+        "TARGET_MEASUREMENT": "cpu_downsampled",
+        "RUN_INTERVAL": "1m",
+        "TASK_ID": "benchmark",
+    })
+    for setting in args.env:
+        key, value = setting.split("=", 1)
+        os.environ[key] = value
+
+    import main as downsampler
+    downsampler.logger = logging.getLogger()
+    downsampler.logger.setLevel(logging.WARNING)
+    task = downsampler.setup_task()
+
+    results = {"commit": git_commit(),
+               "timestamp": datetime.now(timezone.utc).isoformat(),
+               "config": vars(args)}
+
+    # run() once to warm up the connections and the schema, then measure
+    task.logging_client = StageRecorder()
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    downsampler.run(task, now=now)
+    task.logging_client = StageRecorder()
+    reset_write_stats(target)
+    start = time.perf_counter()
+    for i in range(args.runs):
+        downsampler.run(task, now=now - timedelta(minutes=i))
+    results["run"] = summarize("run", task.logging_client, target.write_stats, time.perf_counter() - start)
+
+    if args.backfill_windows > 0:
+        task.logging_client = StageRecorder()
+        reset_write_stats(target)
+        end = now - timedelta(days=1)
+        task.settings["BACKFILL_START"] = (end - timedelta(minutes=args.backfill_windows)).isoformat()
+        task.settings["BACKFILL_END"] = end.isoformat()
+        task.settings["BACKFILL_CONCURRENCY"] = args.backfill_concurrency
+        start = time.perf_counter()
+        downsampler.backfill(task)
+        results["backfill"] = summarize("backfill", task.logging_client, target.write_stats,
+                                        time.perf_counter() - start)
+
+    source.shutdown()
+    target.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000, help="rows returned by each query")
+    parser.add_argument("--tags", type=int, default=3)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--cardinality", type=int, default=1000, help="distinct values of each tag")
+    parser.add_argument("--chunk-rows", type=int, default=8192, help="rows in each Flight chunk")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backfill-windows", type=int, default=10)
+    parser.add_argument("--backfill-concurrency", type=int, default=4)
+    parser.add_argument("--env", action="append", default=[],
+                        help="extra settings such as WRITE_WORKERS=4, can be repeated")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare rows per second with a previous JSON result")
+    main(parser.parse_args())
@@ -0,0 +1,75 @@
+"""
+Compares the DataFrame write path with the arrow line protocol encoder on a synthetic
+downsampled batch. Nothing is sent over the network, only serialization is timed.
+
+    python benchmark_line_protocol.py --rows 100000 --tags 3 --fields 10
+"""
+import argparse
+import time
+import random
+
+import pyarrow as pa
+
+from line_protocol import encode_record_batch, to_payload
+
+
+def make_batch(rows, tag_count, field_count, cardinality):
+    columns = {
+        "iox::measurement": pa.array(["cpu"] * rows).dictionary_encode(),
+        "time": pa.array([i * 60_000_000_000 for i in range(rows)], pa.timestamp("ns", tz="UTC")),
+    }
+    for t in range(tag_count):
+        values = [f"value_{random.randrange(cardinality)}" for _ in range(rows)]
+        columns[f"tag_{t}"] = pa.array(values).dictionary_encode()
+    for f in range(field_count):
+        columns[f"field_{f}"] = pa.array([random.random() * 100 for _ in range(rows)])
+    return pa.RecordBatch.from_pydict(columns)
+
+
+def dataframe_path(batch, measurement, tags):
+    # what write_downsampled_data did before, including the client's serializer
+    from influxdb_client_3 import WritePrecision
+    from influxdb_client_3.write_client.client.write_api import PointSettings
+    from influxdb_client_3.write_client.client.write.dataframe_serializer import data_frame_to_list_of_points
+
+    df = batch.to_pandas()
+    if 'iox::measurement' in df.columns:
+        df = df.drop('iox::measurement', axis=1)
+    lines = data_frame_to_list_of_points(df, PointSettings(), WritePrecision.NS,
+                                         data_frame_measurement_name=measurement,
+                                         data_frame_timestamp_column="time",
+                                         data_frame_tag_columns=tags)
+    return "\n".join(lines).encode("utf-8")
+
+
+def arrow_path(batch, measurement, tags):
+    return to_payload(encode_record_batch(batch, measurement, tags))
+
+
+def time_path(name, path, batch, tags, repeat):
+    best = None
+    payload = b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = path(batch, "cpu_downsampled", tags)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:>10}: {best:.4f}s, {batch.num_rows / best:,.0f} rows/s, {len(payload):,} bytes")
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--tags", type=int, default=3)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--cardinality", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    batch = make_batch(args.rows, args.tags, args.fields, args.cardinality)
+    tags = [f"tag_{t}" for t in range(args.tags)]
+
+    dataframe_time = time_path("dataframe", dataframe_path, batch, tags, args.repeat)
+    arrow_time = time_path("arrow", arrow_path, batch, tags, args.repeat)
+    print(f"speedup: {dataframe_time / arrow_time:.1f}x")
@@ -0,0 +1,120 @@
+"""
+Measures the cold start of a RUN_ONCE invocation: the time a fresh interpreter takes to
+import main.py, and the time from starting `python main.py` with RUN_ONCE=true and
+RUN_PREVIOUS_INTERVAL=true until its first query reaches a local pyarrow.flight stand-in
+for the source, and until the process exits.
+
+    python benchmark_startup.py --repeat 10 --output startup.json
+    python benchmark_startup.py --compare startup.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+from benchmark import SyntheticFlightServer, start_write_server, git_commit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+METRICS = ["import_seconds", "interpreter_seconds", "first_query_seconds", "exit_seconds"]
+
+
+class FirstQueryServer(SyntheticFlightServer):
+    """Records when the first query of any kind arrived, the schema queries included."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_query = None
+
+    def do_get(self, context, ticket):
+        if self.first_query is None:
+            self.first_query = time.perf_counter()
+        return super().do_get(context, ticket)
+
+
+def time_import():
+    # in-process import time of main.py, and the wall time of the whole interpreter
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], cwd=HERE)
+    return float(output.decode().strip()), time.perf_counter() - start
+
+
+def time_run_once(source, target, rows):
+    env = dict(os.environ,
+               SOURCE_HOST=f"http://127.0.0.1:{source.port}",
+               SOURCE_DB="source",
+               SOURCE_TOKEN="benchmark",
+               SOURCE_MEASUREMENT="cpu",
+               TARGET_HOST=f"http://127.0.0.1:{target.server_port}",
+               TARGET_DB="target",
+               TARGET_MEASUREMENT="cpu_downsampled",
+               RUN_INTERVAL="1m",
+               TASK_ID="startup",
+               RUN_ONCE="true",
+               RUN_PREVIOUS_INTERVAL="true",
+               CONTAINER_LOG_LEVEL="WARNING")
+    source.first_query = None
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(HERE, "main.py")], env=env, cwd=HERE, check=True,
+                   stdout=subprocess.DEVNULL)
+    exit_seconds = time.perf_counter() - start
+    return source.first_query - start, exit_seconds
+
+
+def compare(current, previous_path):
+    with open(previous_path, "r") as f:
+        previous = json.load(f)
+    for metric in METRICS:
+        before = previous["results"][metric]
+        after = current["results"][metric]
+        print(f"{metric:>20}: {before * 1000:.0f}ms -> {after * 1000:.0f}ms ({(after / before - 1) * 100:+.1f}%) "
+              f"against {previous.get('commit') or previous_path}")
+
+
+def main(args):
+    source = FirstQueryServer(args.rows, args.tags, args.fields, args.cardinality, args.chunk_rows)
+    target = start_write_server()
+
+    samples = {metric: [] for metric in METRICS}
+    for _ in range(args.repeat):
+        import_seconds, interpreter_seconds = time_import()
+        first_query_seconds, exit_seconds = time_run_once(source, target, args.rows)
+        samples["import_seconds"].append(import_seconds)
+        samples["interpreter_seconds"].append(interpreter_seconds)
+        samples["first_query_seconds"].append(first_query_seconds)
+        samples["exit_seconds"].append(exit_seconds)
+
+    source.shutdown()
+    target.shutdown()
+
+    results = {metric: statistics.median(values) for metric, values in samples.items()}
+    for metric in METRICS:
+        print(f"{metric:>20}: median {results[metric] * 1000:.0f}ms, min {min(samples[metric]) * 1000:.0f}ms")
+
+    current = {"commit": git_commit(),
+               "timestamp": datetime.now(timezone.utc).isoformat(),
+               "config": vars(args),
+               "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        compare(current, args.compare)
+    return current
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="cold starts to take the median of")
+    parser.add_argument("--rows", type=int, default=1000, help="rows returned by the query of the run")
+    parser.add_argument("--tags", type=int, default=3)
+    parser.add_argument("--fields", type=int, default=10)
+    parser.add_argument("--cardinality", type=int, default=100, help="distinct values of each tag")
+    parser.add_argument("--chunk-rows", type=int, default=8192, help="rows in each Flight chunk")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with a previous JSON result")
+    main(parser.parse_args())
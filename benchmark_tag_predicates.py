@@ -0,0 +1,92 @@
+"""
+Compares query latency with the unescaped regular expression filter INCLUDE_TAG_VALUES used
+to generate against the equality predicates generated now. The stand-in is a pyarrow.flight
+server that evaluates the tag predicates of each query on a synthetic table with Arrow
+compute, so it measures predicate evaluation and transfer, not the storage engine's pruning.
+
+    python benchmark_tag_predicates.py --rows 1000000 --cardinality 1000 --values 20
+"""
+import re
+import json
+import time
+import random
+import argparse
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.flight as flight
+
+from influxdb_client_3 import InfluxDBClient3
+
+from tag_predicates import generate_influxql_tag_predicates
+
+REGEX_PREDICATE = re.compile(r'"([^"]+)" =~ /(.*)/')
+EQUALITY_PREDICATE = re.compile(r'"([^"]+)" = \'((?:[^\'\\]|\\.)*)\'')
+
+
+def regex_clause(tag_values):
+    # the filter generated before, values joined into an unanchored alternation
+    influxql = ""
+    for key, values in tag_values.items():
+        influxql += f'AND\n\t"{key}" =~ /({"|".join(values)})/\n'
+    return influxql
+
+
+class FilteringFlightServer(flight.FlightServerBase):
+    def __init__(self, table, location="grpc+tcp://127.0.0.1:0"):
+        super().__init__(location)
+        self.table = table
+
+    def do_get(self, context, ticket):
+        query = json.loads(ticket.ticket.decode("utf-8"))["sql_query"]
+        mask = None
+        for key, pattern in REGEX_PREDICATE.findall(query):
+            mask = pc.match_substring_regex(self.table[key], pattern)
+        equalities = {}
+        for key, value in EQUALITY_PREDICATE.findall(query):
+            equalities.setdefault(key, []).append(value.replace("\\'", "'"))
+        for key, values in equalities.items():
+            mask = pc.is_in(self.table[key], value_set=pa.array(values))
+        table = self.table if mask is None else self.table.filter(mask)
+        return flight.RecordBatchStream(table)
+
+
+def make_table(rows, cardinality):
+    hosts = [f"host-{random.randrange(cardinality)}.example.com" for _ in range(rows)]
+    return pa.table({"time": pa.array(range(rows), pa.timestamp("ns", tz="UTC")),
+                     "host": hosts,
+                     "usage": [random.random() * 100 for _ in range(rows)]})
+
+
+def time_query(name, client, clause, repeat):
+    query = f"SELECT usage FROM cpu WHERE time > 0\n{clause}"
+    best = None
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = client.query(query, language="influxql", mode="all").num_rows
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:>8}: {best:.4f}s, {rows:,} rows")
+    return best, rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--cardinality", type=int, default=1000, help="distinct hosts")
+    parser.add_argument("--values", type=int, default=20, help="hosts in INCLUDE_TAG_VALUES")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    server = FilteringFlightServer(make_table(args.rows, args.cardinality))
+    client = InfluxDBClient3(host=f"http://127.0.0.1:{server.port}", database="source", token="benchmark")
+    tag_values = {"host": [f"host-{i}.example.com" for i in range(args.values)]}
+
+    regex_time, regex_rows = time_query("regex", client, regex_clause(tag_values), args.repeat)
+    exact_time, exact_rows = time_query("exact", client, generate_influxql_tag_predicates(tag_values), args.repeat)
+    print(f"speedup: {regex_time / exact_time:.1f}x")
+    if regex_rows != exact_rows:
+        # the unanchored regex also matches values that contain one of the included values
+        print(f"the regex matched {regex_rows - exact_rows:,} rows more")
+    server.shutdown()
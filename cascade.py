@@ -0,0 +1,94 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from influxql_generator import get_aggregations, generate_tag_filter_clause, THEN_PLACEHOLDER, NOW_PLACEHOLDER
+
+# aggregates whose results can be combined from the results of a lower tier
+MERGEABLE_AGGREGATES = ['count', 'sum', 'mean', 'min', 'max', 'first', 'last']
+
+# the aggregate combining the lower tier's values of each aggregate
+MERGE_FUNCTIONS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max', 'first': 'first', 'last': 'last'}
+
+SUM_STATE_SUFFIX = '__sum'
+COUNT_STATE_SUFFIX = '__count'
+
+
+def state_aggregations(fields_dict, aggregate):
+    """
+    Returns (function, column, output column) for the first tier, computed from raw data.
+    Means are stored as their sum and count, so higher tiers can combine them exactly.
+    """
+    selections = []
+    for field_name, field_aggregate, alias in get_aggregations(fields_dict, aggregate):
+        if field_aggregate.lower() == 'mean':
+            selections.append(('sum', field_name, alias + SUM_STATE_SUFFIX))
+            selections.append(('count', field_name, alias + COUNT_STATE_SUFFIX))
+        else:
+            selections.append((field_aggregate.lower(), field_name, alias))
+    return selections
+
+
+def merge_aggregations(fields_dict, aggregate):
+    # returns (function, column, output column) combining a lower tier into a higher one
+    selections = []
+    for _, field_aggregate, alias in get_aggregations(fields_dict, aggregate):
+        if field_aggregate.lower() == 'mean':
+            selections.append(('sum', alias + SUM_STATE_SUFFIX, alias + SUM_STATE_SUFFIX))
+            selections.append(('sum', alias + COUNT_STATE_SUFFIX, alias + COUNT_STATE_SUFFIX))
+        else:
+            selections.append((MERGE_FUNCTIONS[field_aggregate.lower()], alias, alias))
+    return selections
+
+
+def mean_aliases(fields_dict, aggregate):
+    return [alias for _, field_aggregate, alias in get_aggregations(fields_dict, aggregate)
+            if field_aggregate.lower() == 'mean']
+
+
+def get_cascade_query_template(selections, measurement, tags_list, interval, tag_values=None, include_then=False):
+    fields_clause = ',\n'.join(f'\t{function}("{column}") as "{alias}"' for function, column, alias in selections)
+    tags_clause = ''.join(f', "{tag}"' for tag in tags_list)
+    tag_values = generate_tag_filter_clause(tag_values)
+    # a lower tier's rows are stamped with the start of their bucket, which is the start of the window
+    then_operator = '>=' if include_then else '>'
+
+    query = f"""
+SELECT
+    {fields_clause}
+FROM
+    "{measurement}"
+WHERE
+    time {then_operator} '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+{tag_values}
+GROUP BY
+    time({interval}){tags_clause}
+    """
+
+    return query
+
+
+class MeanReader:
+    """Wraps a chunk reader, adding the mean column computed from the sum and count state of each mean."""
+
+    def __init__(self, reader, aliases):
+        self._reader = reader
+        self._aliases = aliases
+
+    def read_chunk(self):
+        batch, metadata = self._reader.read_chunk()
+        columns = dict(zip(batch.schema.names, batch.columns))
+        for alias in self._aliases:
+            total = columns.get(alias + SUM_STATE_SUFFIX)
+            count = columns.get(alias + COUNT_STATE_SUFFIX)
+            if total is None or count is None:
+                continue
+            # no values in the bucket leave the mean empty rather than dividing by zero
+            count = pc.if_else(pc.equal(count, 0), pa.scalar(None, count.type), count)
+            columns[alias] = pc.divide(pc.cast(total, pa.float64()), pc.cast(count, pa.float64()))
+        return pa.RecordBatch.from_pydict(columns), metadata
+
+    def close(self):
+        if hasattr(self._reader, "close"):
+            self._reader.close()
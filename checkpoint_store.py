@@ -0,0 +1,157 @@
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+
+def to_epoch(dt):
+    # windows without a time zone are in UTC, like the scheduler's utcnow() runs
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+class CheckpointStore(ABC):
+    """
+    Records which windows of each task completed. A window is identified by its task and
+    the end of its interval, so a run covering several intervals records each of them.
+    Other backends implement the same methods.
+    """
+
+    @abstractmethod
+    def mark_completed(self, task_id, window_ends, row_count=None):
+        pass
+
+    @abstractmethod
+    def completed_windows(self, task_id, start, end):
+        # the ends of the completed windows between start and end, inclusive
+        pass
+
+    @abstractmethod
+    def first_window(self, task_id):
+        # the end of the earliest completed window, or None if the task has none
+        pass
+
+    @abstractmethod
+    def source_counts(self, task_id, start, end):
+        # the source point counts recorded for windows between start and end, by window end
+        pass
+
+    @abstractmethod
+    def record_source_counts(self, task_id, counts):
+        pass
+
+    @abstractmethod
+    def claim(self, task_id, window_ends):
+        # marks the windows as in progress, returns False if another run already claimed one of them
+        pass
+
+    @abstractmethod
+    def release(self, task_id, window_ends):
+        pass
+
+    def is_completed(self, task_id, window_ends):
+        completed = self.completed_windows(task_id, min(window_ends), max(window_ends))
+        return all(from_epoch(to_epoch(end)) in completed for end in window_ends)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Keeps the checkpoints in a local SQLite database file, shared by every task in the process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "task_id TEXT NOT NULL, "
+                "window_end INTEGER NOT NULL, "
+                "row_count INTEGER, "
+                "completed_at REAL NOT NULL, "
+                "PRIMARY KEY (task_id, window_end))")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS claims ("
+                "task_id TEXT NOT NULL, "
+                "window_end INTEGER NOT NULL, "
+                "claimed_at REAL NOT NULL, "
+                "PRIMARY KEY (task_id, window_end))")
+            # the runs that claimed windows before a restart are gone
+            self._connection.execute("DELETE FROM claims")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS source_counts ("
+                "task_id TEXT NOT NULL, "
+                "window_end INTEGER NOT NULL, "
+                "source_count INTEGER NOT NULL, "
+                "PRIMARY KEY (task_id, window_end))")
+
+    def mark_completed(self, task_id, window_ends, row_count=None):
+        completed_at = time.time()
+        rows = [(task_id, to_epoch(end), row_count, completed_at) for end in window_ends]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO checkpoints (task_id, window_end, row_count, completed_at) "
+                "VALUES (?, ?, ?, ?)", rows)
+
+    def completed_windows(self, task_id, start, end):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT window_end FROM checkpoints WHERE task_id = ? AND window_end BETWEEN ? AND ?",
+                (task_id, to_epoch(start), to_epoch(end))).fetchall()
+        return set(from_epoch(row[0]) for row in rows)
+
+    def first_window(self, task_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MIN(window_end) FROM checkpoints WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return from_epoch(row[0])
+
+    def source_counts(self, task_id, start, end):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT window_end, source_count FROM source_counts "
+                "WHERE task_id = ? AND window_end BETWEEN ? AND ?",
+                (task_id, to_epoch(start), to_epoch(end))).fetchall()
+        return {from_epoch(window_end): count for window_end, count in rows}
+
+    def record_source_counts(self, task_id, counts):
+        rows = [(task_id, to_epoch(end), count) for end, count in counts.items()]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO source_counts (task_id, window_end, source_count) "
+                "VALUES (?, ?, ?)", rows)
+
+    def claim(self, task_id, window_ends):
+        claimed_at = time.time()
+        ends = [to_epoch(end) for end in window_ends]
+        with self._lock, self._connection:
+            inserted = []
+            for end in ends:
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO claims (task_id, window_end, claimed_at) VALUES (?, ?, ?)",
+                    (task_id, end, claimed_at))
+                if cursor.rowcount == 0:
+                    # give back what this call claimed, the other run keeps its windows
+                    self._connection.executemany(
+                        "DELETE FROM claims WHERE task_id = ? AND window_end = ?",
+                        [(task_id, claimed) for claimed in inserted])
+                    return False
+                inserted.append(end)
+        return True
+
+    def release(self, task_id, window_ends):
+        rows = [(task_id, to_epoch(end)) for end in window_ends]
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM claims WHERE task_id = ? AND window_end = ?", rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
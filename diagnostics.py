@@ -0,0 +1,30 @@
+import logging
+
+import pyarrow as pa
+
+logger = logging.getLogger()
+
+DIAGNOSTICS_MEASUREMENT = "task_diagnostics"
+
+
+def get_query_plan(task, query):
+    """
+    Runs the query again under EXPLAIN ANALYZE and returns the plan with the time spent in
+    every operator, one line per row of the result. This doubles the load of the query on the
+    source, so it is only done for a sample of runs.
+    """
+    table = task.source_client.query(f"EXPLAIN ANALYZE {query.strip()}", language=task.query_language,
+                                     mode="all", database=task.source_db)
+    columns = [name for name in table.column_names
+               if pa.types.is_string(table.schema.field(name).type)
+               or pa.types.is_dictionary(table.schema.field(name).type)]
+    rows = zip(*[table.column(name).to_pylist() for name in columns])
+    return "\n".join(": ".join(str(value) for value in row if value is not None) for row in rows)
+
+
+def chunk_points(query_time, chunks):
+    # (chunk, fields) for every chunk, arrival is counted from sending the query
+    points = []
+    for number, (offset, rows, size) in enumerate(chunks):
+        points.append((number, [("arrival_time", query_time + offset), ("rows", rows), ("bytes", size)]))
+    return points
@@ -0,0 +1,96 @@
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+def rendezvous_owner(name, members):
+    # the member ranked first for the name, adding or removing a member only moves its own names
+    def score(member):
+        return hashlib.sha256(f"{member}/{name}".encode("utf-8")).digest()
+    return max(members, key=score) if members else None
+
+
+class Fleet:
+    """
+    Splits the tasks among identical replicas. Every replica keeps its membership alive in a
+    shared lease store, each task belongs to the live replica that rendezvous hashing ranks
+    first for it, and a replica only runs a task while it holds the task's lease, so two
+    replicas never run the same task even while they disagree on who is alive. Memberships
+    and leases not renewed for lease_ttl seconds expire, and the others take over the tasks.
+    """
+
+    def __init__(self, store, replica_id, lease_ttl=60.0):
+        self.store = store
+        self.replica_id = replica_id
+        self.lease_ttl = lease_ttl
+        self._members = [replica_id]
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def owner(self, name):
+        with self._lock:
+            members = list(self._members)
+        return rendezvous_owner(name, members)
+
+    def heartbeat(self):
+        # renews the membership and the leases this replica still owns, gives up the others
+        now = time.time()
+        self.store.join(self.replica_id, now + self.lease_ttl)
+        members = self.store.members(now)
+        if self.replica_id not in members:
+            members.append(self.replica_id)
+        with self._lock:
+            self._members = members
+            held = list(self._held)
+        for name in held:
+            self.acquire(name)
+
+    def acquire(self, name):
+        # returns True if this replica owns the task and holds its lease
+        if self.owner(name) != self.replica_id:
+            self._release(name)
+            return False
+        now = time.time()
+        acquired = self.store.acquire(name, self.replica_id, now + self.lease_ttl, now)
+        with self._lock:
+            if acquired:
+                self._held.add(name)
+            else:
+                self._held.discard(name)
+        return acquired
+
+    def _release(self, name):
+        with self._lock:
+            if name not in self._held:
+                return
+            self._held.discard(name)
+        self.store.release(name, self.replica_id)
+        logger.info(f"Task {name} moved to replica {self.owner(name)}")
+
+    def start(self):
+        # joins before the first run, the leases are renewed three times per TTL
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.lease_ttl / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"Fleet heartbeat failed with exception {str(e)}")
+
+    def close(self):
+        # hands the tasks over to the other replicas right away instead of after the TTL
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.store.leave(self.replica_id)
+        except Exception as e:
+            logger.error(f"Leaving the fleet failed with exception {str(e)}")
@@ -1,13 +1,37 @@
 from datetime import timezone
 from collections import defaultdict
 
-def generate_fields_string(fields_dict, aggregate):
+from tag_predicates import generate_influxql_tag_predicates
+
+# aggregates that also make sense for string and boolean fields
+NON_NUMERIC_AGGREGATES = ['count', 'first', 'last']
+
+def get_aggregations(fields_dict, aggregate):
+    # returns (field, aggregate, output column) for every field that gets aggregated
+    # aggregate is either a single aggregate applied to the numeric fields, keeping their names,
+    # or a dict of field name (or "*" for any other field) to a list of aggregates, in which
+    # case the output columns are suffixed with the aggregate, i.e. "usage_mean"
+    aggregations = []
+    if isinstance(aggregate, str):
+        for field_name, field_type in fields_dict.items():
+            if field_is_num(field_name, fields_dict):
+                aggregations.append((field_name, aggregate, field_name))
+        return aggregations
+
+    for field_name in fields_dict:
+        field_aggregates = aggregate.get(field_name, aggregate.get('*', []))
+        for field_aggregate in field_aggregates:
+            if not field_is_num(field_name, fields_dict) and field_aggregate.lower() not in NON_NUMERIC_AGGREGATES:
+                continue
+            aggregations.append((field_name, field_aggregate, f'{field_name}_{field_aggregate.lower()}'))
+    return aggregations
+
+def generate_fields_string(fields_dict, aggregate="mean"):
     query = ''
-    for field_name, field_type in fields_dict.items():
-        if field_is_num(field_name, fields_dict):
-            if query != '':
-                query += ',\n'
-            query += f'\t{aggregate}("{field_name}") as "{field_name}"'
+    for field_name, field_aggregate, alias in get_aggregations(fields_dict, aggregate):
+        if query != '':
+            query += ',\n'
+        query += f'\t{field_aggregate}("{field_name}") as "{alias}"'
     return query
 
 def generate_group_by_string(tags_list, interval):
@@ -18,16 +42,18 @@ def generate_group_by_string(tags_list, interval):
     return group_by_clause
 
 def generate_tag_filter_clause(tag_values):
-    if tag_values is None:
-        return ""
-    
-    influxql = ""
-    for key, values in tag_values.items():
-        joined_values = "|".join(values)
-        influxql += f'AND\n\t"{key}" =~ /({joined_values})/\n'
-    return influxql
+    # literal values become equality predicates the storage engine can prune with
+    return generate_influxql_tag_predicates(tag_values)
 
-def get_query(fields_dict, measurement, then, now, tags_list, interval, aggregate, tag_values ):
+# placeholders for the time range, so a generated query can be reused for every window
+THEN_PLACEHOLDER = '$__then'
+NOW_PLACEHOLDER = '$__now'
+
+def fill_query_template(template, then, now):
+    return template.replace(THEN_PLACEHOLDER, then.strftime('%Y-%m-%d %H:%M:%S')).replace(
+        NOW_PLACEHOLDER, now.strftime('%Y-%m-%d %H:%M:%S'))
+
+def get_query_template(fields_dict, measurement, tags_list, interval, aggregate, tag_values):
     fields_clause = generate_fields_string(fields_dict, aggregate)
     tags_clause = generate_group_by_string(tags_list, interval)
     tag_values = generate_tag_filter_clause(tag_values)
@@ -38,9 +64,9 @@ SELECT
 FROM
     {measurement}
 WHERE
-    time > '{then.strftime('%Y-%m-%d %H:%M:%S')}'
+    time > '{THEN_PLACEHOLDER}'
 AND
-    time < '{now.strftime('%Y-%m-%d %H:%M:%S')}'
+    time < '{NOW_PLACEHOLDER}'
 {tag_values}
 GROUP BY
     {tags_clause}
@@ -48,6 +74,61 @@ GROUP BY
 
     return query
 
+def get_query(fields_dict, measurement, then, now, tags_list, interval, aggregate, tag_values ):
+    template = get_query_template(fields_dict, measurement, tags_list, interval, aggregate, tag_values)
+    return fill_query_template(template, then, now)
+
+def get_count_query(fields_dict, measurement, then, now, interval, tag_values):
+    # counts the points of every field per interval, to detect windows that received late data
+    counts = [f'count("{field_name}") as "{field_name}"' for field_name in fields_dict]
+    counts_clause = ',\n\t'.join(counts)
+    tag_values = generate_tag_filter_clause(tag_values)
+
+    query = f"""
+SELECT
+    {counts_clause}
+FROM
+    {measurement}
+WHERE
+    time > '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+{tag_values}
+GROUP BY
+    time({interval}) fill(0)
+    """
+
+    return fill_query_template(query, then, now)
+
+def get_raw_query_template(fields_dict, measurement, tags_list, aggregate, tag_values):
+    # selects the rows that get_query would aggregate, for aggregating them locally
+    field_names = []
+    for field_name, _, _ in get_aggregations(fields_dict, aggregate):
+        if field_name not in field_names:
+            field_names.append(field_name)
+    columns = [f'"{field_name}"' for field_name in field_names]
+    columns += [f'"{tag}"::tag' for tag in tags_list]
+    columns_clause = ',\n\t'.join(columns)
+    tag_values = generate_tag_filter_clause(tag_values)
+
+    query = f"""
+SELECT
+    {columns_clause}
+FROM
+    {measurement}
+WHERE
+    time > '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+{tag_values}
+    """
+
+    return query
+
+def get_raw_query(fields_dict, measurement, then, now, tags_list, aggregate, tag_values):
+    template = get_raw_query_template(fields_dict, measurement, tags_list, aggregate, tag_values)
+    return fill_query_template(template, then, now)
+
 def field_is_num(field_name, fields_dict):
     numeric_types = ['integer', 'float', 'double']
     field_type = fields_dict.get(field_name)
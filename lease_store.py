@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+
+class LeaseStore(ABC):
+    """
+    Shared by the replicas of a fleet: records which replicas are alive, and which replica
+    holds the lease of each task. Both expire unless they are renewed, so the tasks of a
+    replica that died are taken over by the others. Other backends implement the same methods.
+    """
+
+    @abstractmethod
+    def join(self, replica_id, expires):
+        # adds the replica to the live members, or extends its membership
+        pass
+
+    @abstractmethod
+    def leave(self, replica_id):
+        # removes the replica and gives up every lease it holds
+        pass
+
+    @abstractmethod
+    def members(self, now):
+        # the replicas whose membership has not expired at now
+        pass
+
+    @abstractmethod
+    def acquire(self, name, replica_id, expires, now):
+        # takes or renews the lease, returns False while another replica holds it
+        pass
+
+    @abstractmethod
+    def release(self, name, replica_id):
+        pass
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """
+    Keeps the members and leases in a SQLite database file, on a volume shared by the
+    replicas. The expiry times are wall clock times, so the clocks of the replicas must
+    agree to well within the lease TTL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                "replica_id TEXT PRIMARY KEY, "
+                "expires REAL NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, "
+                "replica_id TEXT NOT NULL, "
+                "expires REAL NOT NULL)")
+
+    def join(self, replica_id, expires):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO members (replica_id, expires) VALUES (?, ?)", (replica_id, expires))
+
+    def leave(self, replica_id):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM members WHERE replica_id = ?", (replica_id,))
+            self._connection.execute("DELETE FROM leases WHERE replica_id = ?", (replica_id,))
+
+    def members(self, now):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT replica_id FROM members WHERE expires >= ? ORDER BY replica_id", (now,)).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire(self, name, replica_id, expires, now):
+        # a single statement, so two replicas taking an expired lease at once can not both get it
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO leases (name, replica_id, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET replica_id = excluded.replica_id, expires = excluded.expires "
+                "WHERE leases.replica_id = excluded.replica_id OR leases.expires < ?",
+                (name, replica_id, expires, now))
+        return cursor.rowcount == 1
+
+    def release(self, name, replica_id):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM leases WHERE name = ? AND replica_id = ?", (name, replica_id))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,142 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# columns returned by InfluxQL queries that are never written as tags or fields
+IGNORED_COLUMNS = ['iox::measurement']
+
+
+def escape_measurement(measurement):
+    return measurement.replace(",", "\\,").replace(" ", "\\ ")
+
+
+def escape_key(key):
+    return key.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def escape_tag_values(array):
+    if pa.types.is_dictionary(array.type):
+        # escape the (small) dictionary once instead of every row
+        escaped = escape_tag_values(array.dictionary)
+        array = pa.DictionaryArray.from_arrays(array.indices, escaped)
+        return pc.cast(array, pa.string())
+    if not pa.types.is_string(array.type) and not pa.types.is_large_string(array.type):
+        array = pc.cast(array, pa.string())
+    escaped = pc.replace_substring_regex(array, pattern=r'([,= ])', replacement=r'\\\1')
+    # empty tag values are not valid line protocol, treat them like missing tags
+    return pc.if_else(pc.equal(escaped, ""), pa.scalar(None, pa.string()), escaped)
+
+
+def format_field_values(array):
+    # returns the line protocol representation of each value, null where there is no value
+    data_type = array.type
+    if pa.types.is_dictionary(data_type):
+        array = pc.cast(array, data_type.value_type)
+        data_type = array.type
+
+    if pa.types.is_floating(data_type):
+        # NaN and infinity can not be represented in line protocol
+        array = pc.if_else(pc.is_finite(array), array, pa.scalar(None, data_type))
+        return pc.cast(array, pa.string())
+    elif pa.types.is_unsigned_integer(data_type):
+        return pc.binary_join_element_wise(pc.cast(array, pa.string()), "u", "")
+    elif pa.types.is_integer(data_type):
+        return pc.binary_join_element_wise(pc.cast(array, pa.string()), "i", "")
+    elif pa.types.is_boolean(data_type):
+        return pc.cast(array, pa.string())
+    else:
+        array = pc.cast(array, pa.string())
+        escaped = pc.replace_substring_regex(array, pattern=r'(["\\])', replacement=r'\\\1')
+        return pc.binary_join_element_wise('"', escaped, '"', "")
+
+
+def format_timestamps(array):
+    if pa.types.is_timestamp(array.type):
+        if array.type.unit != "ns":
+            array = pc.cast(array, pa.timestamp("ns", tz=array.type.tz))
+        array = array.view(pa.int64())
+    return pc.cast(array, pa.string())
+
+
+def encode_record_batch(batch, measurement, tag_columns, timestamp_column="time"):
+    """
+    Encodes a RecordBatch as an array of line protocol lines, one column at a time.
+    Columns are selected by name, so the batch itself is never copied or modified.
+    Rows without any non-null field are dropped, as they can not be written.
+    """
+    names = batch.schema.names
+    tag_columns = [t for t in tag_columns if t in names]
+    field_columns = [n for n in names
+                     if n not in tag_columns and n != timestamp_column and n not in IGNORED_COLUMNS]
+
+    tag_pieces = []
+    for tag in tag_columns:
+        values = escape_tag_values(batch.column(tag))
+        # null values propagate, so missing tags are skipped when joining below
+        tag_pieces.append(pc.binary_join_element_wise(f",{escape_key(tag)}=", values, ""))
+
+    series = pc.binary_join_element_wise(escape_measurement(measurement), *tag_pieces, "",
+                                         null_handling="replace", null_replacement="")
+    if not isinstance(series, (pa.Array, pa.ChunkedArray)):
+        # no tags, the scalar measurement is broadcast to every row
+        series = pa.array([series.as_py()] * batch.num_rows, pa.string())
+
+    field_pieces = []
+    for field in field_columns:
+        values = format_field_values(batch.column(field))
+        field_pieces.append(pc.binary_join_element_wise(f"{escape_key(field)}=", values, ""))
+
+    if len(field_pieces) == 0:
+        return pa.array([], pa.string())
+
+    # null_handling="skip" drops rows where every value is null, which would misalign
+    # the field set with the other columns, so the pieces are folded together instead
+    field_set = field_pieces[0]
+    for piece in field_pieces[1:]:
+        joined = pc.binary_join_element_wise(field_set, piece, ",")
+        field_set = pc.coalesce(joined, field_set, piece)
+    field_set = pc.fill_null(field_set, "")
+    timestamps = format_timestamps(batch.column(timestamp_column))
+
+    lines = pc.binary_join_element_wise(series, field_set, timestamps, " ")
+    has_fields = pc.and_(pc.not_equal(field_set, ""), pc.is_valid(timestamps))
+    return pc.filter(lines, has_fields)
+
+
+def to_payload(lines):
+    """
+    Joins encoded lines into a single newline separated payload. Each line is terminated
+    with a newline by a single compute call, so the result is the array's data buffer.
+    """
+    if len(lines) == 0:
+        return b""
+    terminated = pc.binary_join_element_wise(lines, "", "\n")
+    if isinstance(terminated, pa.ChunkedArray):
+        terminated = terminated.combine_chunks()
+    offset_type = np.int64 if pa.types.is_large_string(terminated.type) else np.int32
+    offsets = np.frombuffer(terminated.buffers()[1], dtype=offset_type)
+    start = offsets[terminated.offset]
+    end = offsets[terminated.offset + len(terminated)]
+    return terminated.buffers()[2][start:end].to_pybytes()
+
+
+def split_lines(lines, max_bytes):
+    """
+    Splits encoded lines into consecutive slices whose payloads are at most max_bytes,
+    counting the newline of every line. A line longer than max_bytes gets a slice of its own.
+    """
+    if len(lines) == 0:
+        return []
+    sizes = pc.binary_length(lines).to_numpy(zero_copy_only=False).astype(np.int64) + 1
+    ends = np.cumsum(sizes)
+
+    slices = []
+    start = 0
+    consumed = 0
+    while start < len(lines):
+        end = int(np.searchsorted(ends, consumed + max_bytes, side="right"))
+        end = max(end, start + 1)
+        slices.append(lines.slice(start, end - start))
+        consumed = int(ends[end - 1])
+        start = end
+    return slices
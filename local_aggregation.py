@@ -0,0 +1,137 @@
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+INTERVAL_NANOSECONDS = {"m": 60 * 10**9, "h": 3600 * 10**9, "d": 86400 * 10**9}
+
+# aggregates that map directly onto a pyarrow hash aggregate
+HASH_AGGREGATES = {
+    "count": ("count", None),
+    "mean": ("mean", None),
+    "sum": ("sum", None),
+    "min": ("min", None),
+    "max": ("max", None),
+    "first": ("first", None),
+    "last": ("last", None),
+    # InfluxQL returns the sample standard deviation
+    "stddev": ("stddev", pc.VarianceOptions(ddof=1)),
+    "distinct": ("distinct", None),
+    # medians are computed from the collected values, pyarrow only has an approximation
+    "median": ("list", None),
+}
+
+
+class TableChunkReader:
+    """Adapts an arrow Table to the read_chunk() interface of the Flight stream reader."""
+
+    def __init__(self, table):
+        self._batches = iter(table.to_batches())
+
+    def read_chunk(self):
+        return next(self._batches), None
+
+
+def interval_to_nanoseconds(interval):
+    match = re.fullmatch(r'(\d+)([mhd])', interval)
+    if match is None:
+        raise ValueError(f"invalid interval format: {interval}")
+    return int(match.group(1)) * INTERVAL_NANOSECONDS[match.group(2)]
+
+
+def bucket_times(times, interval):
+    # GROUP BY time(interval) buckets are aligned to the unix epoch
+    interval_ns = interval_to_nanoseconds(interval)
+    if pa.types.is_timestamp(times.type) and times.type.unit != "ns":
+        times = pc.cast(times, pa.timestamp("ns", tz=times.type.tz))
+    nanoseconds = pc.cast(times, pa.int64())
+    buckets = pc.multiply(pc.divide(nanoseconds, interval_ns), interval_ns)
+    return pc.cast(buckets, pa.timestamp("ns", tz="UTC"))
+
+
+def median_from_lists(lists):
+    # exact medians, matching InfluxQL which averages the two middle values of an even count
+    group_count = len(lists)
+    values = pc.list_flatten(lists)
+    parents = pc.list_parent_indices(lists)
+    valid = pc.is_valid(values)
+    values = pc.cast(pc.filter(values, valid), pa.float64()).to_numpy(zero_copy_only=False)
+    parents = pc.filter(parents, valid).to_numpy(zero_copy_only=False)
+
+    order = np.lexsort((values, parents))
+    values = values[order]
+    counts = np.bincount(parents, minlength=group_count)
+    starts = np.cumsum(counts) - counts
+
+    has_values = counts > 0
+    low = starts + np.maximum(counts - 1, 0) // 2
+    high = starts + counts // 2
+    medians = np.zeros(group_count)
+    medians[has_values] = (values[low[has_values]] + values[high[has_values]]) / 2
+    return pa.array(medians, pa.float64(), mask=~has_values)
+
+
+def aggregate_table(table, aggregations, tags_list, interval):
+    """
+    Computes the GROUP BY time(interval), tags aggregation of raw rows locally.
+    aggregations is a list of (field, aggregate, output column) tuples.
+    Returns a table with a time column, the tag columns and one column per aggregation.
+    """
+    aggregates = [a.lower() for _, a, _ in aggregations]
+    if "distinct" in aggregates and len(aggregations) > 1:
+        # the same restriction InfluxQL applies, distinct returns a row per value
+        raise ValueError("aggregate function distinct() cannot be combined with other functions or fields")
+
+    tags_list = [t for t in tags_list if t in table.column_names]
+    keys = ["time"] + tags_list
+
+    columns = {"time": bucket_times(table.column("time"), interval)}
+    for tag in tags_list:
+        columns[tag] = table.column(tag)
+    for field, _, _ in aggregations:
+        if field in table.column_names:
+            columns[field] = table.column(field)
+    grouped_input = pa.table(columns)
+
+    # first and last are taken in input order, so sort by the raw timestamps
+    grouped_input = grouped_input.take(pc.sort_indices(table.column("time")))
+
+    specs = []
+    for field, aggregate, _ in aggregations:
+        if field not in grouped_input.column_names:
+            continue
+        function, options = HASH_AGGREGATES[aggregate.lower()]
+        if (field, function, options) not in specs:
+            specs.append((field, function, options))
+
+    result = grouped_input.group_by(keys, use_threads=False).aggregate(specs)
+
+    output = {"time": result.column("time")}
+    for tag in tags_list:
+        column = result.column(tag)
+        if pa.types.is_dictionary(column.type):
+            # dictionary columns can not be sorted
+            column = pc.cast(column, column.type.value_type)
+        output[tag] = column
+    for field, aggregate, alias in aggregations:
+        if field not in grouped_input.column_names:
+            continue
+        function, _ = HASH_AGGREGATES[aggregate.lower()]
+        column = result.column(f"{field}_{function}")
+        if aggregate.lower() == "median":
+            column = median_from_lists(column.combine_chunks())
+        output[alias] = column
+
+    output = pa.table(output)
+
+    if "distinct" in aggregates and len(output) > 0:
+        # one output row per distinct value, repeating the group's time and tags
+        _, _, alias = aggregations[0]
+        lists = output.column(alias).combine_chunks()
+        parents = pc.list_parent_indices(lists)
+        output = output.drop_columns([alias]).take(parents)
+        output = output.append_column(alias, pc.list_flatten(lists))
+
+    sort_keys = [(tag, "ascending") for tag in tags_list] + [("time", "ascending")]
+    return output.sort_by(sort_keys)
@@ -1,329 +1,1368 @@
 import os
 import re
+import json
 import socket
 import time
 import string
 import random
+import queue
+import copy
+import atexit
+import signal
 import logging
 from pythonjsonlogger import jsonlogger
 import threading
 
-from dateutil.parser import parse
-from apscheduler.schedulers.background import BlockingScheduler
-from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
-from datetime import datetime, timezone
-from influxdb_client_3 import InfluxDBClient3, Point, SYNCHRONOUS, write_client_options
-from schedule_calculator import get_next_run_time, get_then
+import pyarrow as pa
+import pyarrow.compute as pc
+from datetime import datetime, timedelta, timezone
+from task import Task, get_client, load_task_settings
+from schedule_calculator import get_next_run_time, get_then, get_interval_timedelta, get_start_offset
+from subwindows import split_window, intervals_per_subwindow, ConcurrentChunkReader
+from backfill_runner import get_backfill_windows, group_windows, read_watermark, skip_completed_windows, run_windows
 from schema_configuration import populate_fields, populate_tags, populate_tag_values
-from influxql_generator import get_query
-
-logging_client = None
-source_client = None
-target_client = None
-source_measurement = ""
-target_measurement = ""
-fields = None
-tags = None
-ignore_schema_cache = False
-source_host = ""
-task_id = ""
-interval = ""
-aggregate = ""
-tag_values = None
-logger = None
+from influxql_generator import get_query_template, get_raw_query_template, fill_query_template, get_aggregations, get_count_query
+from cascade import (MERGEABLE_AGGREGATES, MeanReader, get_cascade_query_template, state_aggregations,
+                     merge_aggregations, mean_aliases)
+from sql_generator import get_sql_query_template, get_sql_raw_query_template
+from schema_cache import SchemaCache, schema_hash
+from checkpoint_store import SQLiteCheckpointStore, to_epoch, from_epoch
+from lease_store import SQLiteLeaseStore
+from fleet import Fleet
+from local_aggregation import aggregate_table, TableChunkReader
+from telemetry import TelemetryFlusher
+from spool import WriteSpool
+from diagnostics import DIAGNOSTICS_MEASUREMENT, get_query_plan, chunk_points
+from profiler import RunProfile
+import metrics
+from line_protocol import encode_record_batch, to_payload, split_lines
+from write_batcher import BatchCoalescer, gzip_payload
+from write_limiter import WriteLimiter, is_overloaded, retry_after_seconds
+from write_dedup import WrittenHashes, row_hashes
 
+logger = None
 
-def parse_interval(explicit_interval=None):
-    global interval
-    if explicit_interval is None:
-        interval = os.getenv('RUN_INTERVAL')
 
-    match = re.fullmatch(r'(\d+)([mhd])', interval)
+def parse_interval(interval):
+    match = re.fullmatch(r'(\d+)([mhd])', interval or "")
     if match is None:
-        logger.critical(f"invalid interval format: {interval}")
-        exit(1)
+        raise ValueError(f"invalid interval format: {interval}")
     t = int(match.group(1))
     if t < 1:
-        logger.critical(f"invalid interval format: {interval}")
-        exit(1)
+        raise ValueError(f"invalid interval format: {interval}")
     return t, match.group(2)
 
 
-def setup_aggregate():
-    global aggregate
-    aggregate = os.getenv("AGGREGATE", "MEAN")
+def setup_interval(task):
+    task.interval = task.getenv('RUN_INTERVAL')
+    try:
+        task.interval_val, task.interval_type = parse_interval(task.interval)
+    except ValueError as e:
+        logger.critical(str(e))
+        exit(1)
+
+
+def parse_aggregates(aggregates_opt):
+    # AGGREGATES is either a comma separated list applied to every field,
+    # or a JSON map of field names to lists of aggregates
+    if aggregates_opt.strip().startswith("{"):
+        spec = json.loads(aggregates_opt)
+        if not isinstance(spec, dict) or not all(isinstance(v, list) and all(isinstance(a, str) for a in v)
+                                                 for v in spec.values()):
+            raise ValueError("AGGREGATES must map field names to lists of aggregate names")
+        return spec
+    return {"*": [a.strip() for a in aggregates_opt.split(",") if a.strip() != ""]}
+
+
+def setup_aggregate(task):
     allowed_aggregates = ["count", "distinct", "mean",
                           "median", "stddev", "sum", "first", "last", "max", "min"]
+    help_url = "https://docs.influxdata.com/influxdb/cloud-serverless/reference/influxql/feature-support/#function-support"
+
+    aggregates_opt = task.getenv("AGGREGATES")
+    if aggregates_opt is None:
+        task.aggregate = task.getenv("AGGREGATE", "MEAN")
+        requested = [task.aggregate]
+    else:
+        try:
+            task.aggregate = parse_aggregates(aggregates_opt)
+        except Exception as e:
+            logger.critical(f"Failed to parse AGGREGATES: {str(e)}")
+            exit(1)
+        requested = [a for field_aggregates in task.aggregate.values() for a in field_aggregates]
+        if "distinct" in [a.lower() for a in requested] and len(requested) > 1:
+            logger.critical("aggregate distinct can not be combined with other aggregates or fields")
+            exit(1)
+        logger.debug(f"AGGREGATES parsed to: {task.aggregate}")
+
+    for requested_aggregate in requested:
+        if requested_aggregate.lower() not in allowed_aggregates:
+            logger.critical(
+                f"aggregate {requested_aggregate} not allowed. Only {allowed_aggregates} accepted. See {help_url}")
+            exit(1)
+
+
+def setup_aggregation_engine(task):
+    task.aggregation_engine = task.getenv("AGGREGATION_ENGINE", "server").lower()
+    allowed_engines = ["server", "local"]
+
+    if task.aggregation_engine not in allowed_engines:
+        logger.critical(
+            f"aggregation engine {task.aggregation_engine} not allowed. Only {allowed_engines} accepted.")
+        exit(1)
+
+
+def setup_cascade(task):
+    # CASCADE_TIERS lists the higher tiers computed from the RUN_INTERVAL tier, i.e. "1h,1d"
+    tiers_opt = task.getenv('CASCADE_TIERS')
+    if tiers_opt is None or tiers_opt.strip() == "":
+        return
 
-    if aggregate.lower() not in allowed_aggregates:
-        help_url = "https://docs.influxdata.com/influxdb/cloud-serverless/reference/influxql/feature-support/#function-support"
+    if task.aggregation_engine != "server" or task.query_language != "influxql":
+        logger.critical("CASCADE_TIERS requires AGGREGATION_ENGINE=server and QUERY_LANGUAGE=influxql")
+        exit(1)
+
+    if isinstance(task.aggregate, str):
+        requested = [task.aggregate]
+    else:
+        requested = [a for field_aggregates in task.aggregate.values() for a in field_aggregates]
+    for requested_aggregate in requested:
+        if requested_aggregate.lower() not in MERGEABLE_AGGREGATES:
+            logger.critical(f"aggregate {requested_aggregate} can not be cascaded. Only {MERGEABLE_AGGREGATES} accepted.")
+            exit(1)
+
+    lower = get_interval_timedelta(task.interval_val, task.interval_type)
+    for interval in tiers_opt.split(","):
+        interval = interval.strip()
+        try:
+            interval_val, interval_type = parse_interval(interval)
+        except ValueError as e:
+            logger.critical(f"invalid CASCADE_TIERS: {str(e)}")
+            exit(1)
+        tier_interval = get_interval_timedelta(interval_val, interval_type)
+        if tier_interval <= lower or tier_interval % lower:
+            logger.critical(f"CASCADE_TIERS interval {interval} must be a multiple of the interval below it")
+            exit(1)
+        lower = tier_interval
+        task.cascade_tiers.append({"interval": interval,
+                                   "interval_val": interval_val,
+                                   "interval_type": interval_type,
+                                   "measurement": f"{task.target_measurement}_{interval}"})
+
+    # the higher tiers read the lower tiers back from the target
+    host = task.getenv('TARGET_HOST', task.source_host)
+    token = task.getenv('TARGET_TOKEN', task.getenv('SOURCE_TOKEN'))
+    org = task.getenv('TARGET_ORG', 'none')
+    task.cascade_client = get_client(host, task.target_db, token, org)
+    logger.debug(f"Cascading into tiers {[tier['measurement'] for tier in task.cascade_tiers]}")
+
+
+def setup_query_language(task):
+    task.query_language = task.getenv("QUERY_LANGUAGE", "influxql").lower()
+    allowed_languages = ["influxql", "sql"]
+
+    if task.query_language not in allowed_languages:
         logger.critical(
-            f"aggregate {aggregate} not allowed. Only {allowed_aggregates} accepted. See {help_url}")
+            f"query language {task.query_language} not allowed. Only {allowed_languages} accepted.")
         exit(1)
 
 
-def setup_tags_and_fields():
-    global fields
-    global tags
-    global tag_values
-    global ignore_schema_cache
-    global source_client
-    global source_measurement
+def fetch_schema(task, key):
+    start_time = time.time()
+    fields = populate_fields(task.source_client, task.source_measurement, task.source_db)
+    tags = populate_tags(task.source_client, task.source_measurement, task.source_db, task.getenv)
+    task.schema_cache.put(key, fields, tags)
+    task.schema_refresh_time = time.time() - start_time
+    return fields, tags
+
+
+def refresh_schema_in_background(task, key):
+    # the refreshed schema only goes to the cache, the next run picks it up at its start,
+    # so a run in progress keeps writing with the tags its query grouped by
+    with task.lock:
+        if task.schema_refreshing:
+            return
+        task.schema_refreshing = True
+
+    def refresh():
+        try:
+            fetch_schema(task, key)
+            logger.debug(f"Refreshed schema for task {task.task_id} in {task.schema_refresh_time}s")
+        except Exception as e:
+            logger.error(f"Schema refresh for task {task.task_id} failed with exception {str(e)}")
+        finally:
+            with task.lock:
+                task.schema_refreshing = False
+
+    threading.Thread(target=refresh, daemon=True).start()
 
-    if fields is None or ignore_schema_cache:
-        fields = populate_fields(source_client, source_measurement)
 
-    if tags is None or ignore_schema_cache:
-        tags = populate_tags(source_client, source_measurement)
+def setup_tags_and_fields(task):
+    if task.schema_cache is None or task.ignore_schema_cache:
+        if task.fields is None or task.ignore_schema_cache:
+            task.fields = populate_fields(task.source_client, task.source_measurement, task.source_db)
 
-    if tag_values is None or ignore_schema_cache:
-        tag_values = populate_tag_values()
+        if task.tags is None or task.ignore_schema_cache:
+            task.tags = populate_tags(task.source_client, task.source_measurement, task.source_db, task.getenv)
+    else:
+        key = task.schema_cache.key(task.source_host, task.source_db,
+                                    task.source_measurement, task.getenv('INCLUDE_TAGS'))
+        entry = task.schema_cache.get(key)
+        if entry is None:
+            task.schema_cache_misses += 1
+            task.fields, task.tags = fetch_schema(task, key)
+        else:
+            task.schema_cache_hits += 1
+            task.fields = entry["fields"]
+            task.tags = entry["tags"]
+            if not task.schema_cache.is_fresh(entry):
+                refresh_schema_in_background(task, key)
+
+    if task.tag_values is None or task.ignore_schema_cache:
+        task.tag_values = populate_tag_values(task.getenv)
+
+    task.schema_hash = schema_hash(task.fields, task.tags, task.tag_values)
+
+
+def get_query_for_window(task, then, now):
+    # the query is only generated again when the schema or the engine changed
+    template_key = (task.schema_hash, task.aggregation_engine, task.query_language, bool(task.cascade_tiers))
+    if task.query_template is None or task.query_template_key != template_key:
+        if task.aggregation_engine == "local" and task.query_language == "sql":
+            task.query_template = get_sql_raw_query_template(task.fields, task.source_measurement,
+                                                             task.tags, task.aggregate, task.tag_values)
+        elif task.aggregation_engine == "local":
+            task.query_template = get_raw_query_template(task.fields, task.source_measurement,
+                                                         task.tags, task.aggregate, task.tag_values)
+        elif task.cascade_tiers:
+            # the first tier stores the state the higher tiers are combined from
+            task.query_template = get_cascade_query_template(state_aggregations(task.fields, task.aggregate),
+                                                             task.source_measurement, task.tags,
+                                                             task.interval, task.tag_values)
+        elif task.query_language == "sql":
+            task.query_template = get_sql_query_template(task.fields, task.source_measurement,
+                                                         task.tags, task.interval, task.aggregate, task.tag_values)
+        else:
+            task.query_template = get_query_template(task.fields, task.source_measurement,
+                                                     task.tags, task.interval, task.aggregate, task.tag_values)
+        task.query_template_key = template_key
+        logger.debug(f"Generated query template for task {task.task_id}")
+    return fill_query_template(task.query_template, then, now)
 
 
-def get_down_sampled_data(query):
-    if source_client is None or source_measurement == "":
+def get_down_sampled_data(task, query):
+    if task.source_client is None or task.source_measurement == "":
         logger.critical("Source InfluxDB instance not defined. Exiting ...")
         exit(1)
     else:
         try:
-            reader = source_client.query(
-                query, language="influxql", mode="chunk")
+            reader = task.source_client.query(
+                query, language=task.query_language, mode="chunk", database=task.source_db)
             return (True, reader)
         except Exception as e:
             return (False, str(e))
 
 
-def run(interval_val, interval_type, now=None):
+def get_locally_aggregated_data(task, query):
+    # fetches the raw rows and aggregates them here instead of on the source instance
+    if task.source_client is None or task.source_measurement == "":
+        logger.critical("Source InfluxDB instance not defined. Exiting ...")
+        exit(1)
+    else:
+        try:
+            table = task.source_client.query(
+                query, language=task.query_language, mode="all", database=task.source_db)
+            aggregations = get_aggregations(task.fields, task.aggregate)
+            result = aggregate_table(table, aggregations, task.tags, task.interval)
+            return (True, TableChunkReader(result))
+        except Exception as e:
+            return (False, str(e))
+
+
+def run_query(task, query):
+    # get_downsampled data will return an arrow stream reader if successful
+    # if success == false, reader will be an exception string
+    if task.aggregation_engine == "local":
+        return get_locally_aggregated_data(task, query)
+    return get_down_sampled_data(task, query)
+
+
+def get_subwindows(task, then, now):
+    # a window spanning several GROUP BY intervals can be queried in parts
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    window_intervals = max(1, round((now - then) / interval))
+    if window_intervals == 1:
+        return [(then, now)]
+    per_subwindow = intervals_per_subwindow(window_intervals, task.subwindow_intervals,
+                                            task.subwindow_row_budget, task.rows_per_interval)
+    return split_window(then, now, interval, per_subwindow)
+
+
+def get_window_ends(task, then, now):
+    # the end of every interval in then..now, which is how the checkpoints identify windows
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    window_intervals = max(1, round((now - then) / interval))
+    return [then + interval * i for i in range(1, window_intervals)] + [now]
+
+
+def run(task, now=None, then=None, rerun=False, scheduler_lag=None):
     if now is None:
         now = datetime.now(timezone.utc)
     now = now.replace(second=0, microsecond=0)
-    then = get_then(interval_val, interval_type, now)
+    if then is None:
+        then = get_then(task.interval_val, task.interval_type, now)
+    log_extra = {"task_id": task.task_id}
+
+    window_ends = get_window_ends(task, then, now)
+    if task.checkpoint_store is None:
+        return profile_window(task, now, then, rerun, window_ends, scheduler_lag)
+
+    # the claim keeps an overlapping run of the same windows from processing them too
+    if not task.checkpoint_store.claim(task.task_id, window_ends):
+        logger.info(f"Skipping window ending {now.strftime('%Y-%m-%dT%H:%M:%SZ')}, another run is processing it",
+                    extra=log_extra)
+        return True
+    try:
+        # reruns process windows that completed before but received late data since
+        if not rerun and task.checkpoint_store.is_completed(task.task_id, window_ends):
+            logger.info(f"Skipping window ending {now.strftime('%Y-%m-%dT%H:%M:%SZ')}, it already completed",
+                        extra=log_extra)
+            return True
+        return profile_window(task, now, then, rerun, window_ends, scheduler_lag)
+    finally:
+        task.checkpoint_store.release(task.task_id, window_ends)
+
+
+def profile_window(task, now, then, rerun, window_ends, scheduler_lag=None):
+    # a sample of runs is profiled, see PROFILE_SAMPLE_RATE
+    if not (task.profile_sample_rate > 0 and random.random() < task.profile_sample_rate):
+        return run_window(task, now, then, rerun, window_ends, scheduler_lag=scheduler_lag)
+    profile = RunProfile()
+    try:
+        return run_window(task, now, then, rerun, window_ends, profile, scheduler_lag)
+    finally:
+        # also stops the profilers of a run that raised
+        profile.stop()
+
+
+def finish_profile(task, profile, then, log_fields):
+    if profile is None:
+        return
+    profile.stop()
+    log_fields.append(("cpu_time", profile.cpu_time))
+    if profile.peak_mem_bytes is not None:
+        log_fields.append(("peak_mem_bytes", profile.peak_mem_bytes))
+    if task.profile_dir is None:
+        return
+    try:
+        path = profile.dump(task.profile_dir, f"{task.task_id}-{then.strftime('%Y%m%dT%H%M%SZ')}")
+        logger.info(f"Wrote the profile of the run to {path}", extra={"task_id": task.task_id})
+    except Exception as e:
+        logger.error(f"Writing the profile failed with exception {str(e)}", extra={"task_id": task.task_id})
 
+
+def run_window(task, now, then, rerun, window_ends, profile=None, scheduler_lag=None):
+    log_extra = {"task_id": task.task_id}
     logger.info(
-        f"Running job for {then.strftime('%Y-%m-%dT%H:%M:%SZ')} to {now.strftime('%Y-%m-%dT%H:%M:%SZ')}. Time stamp will be {then.strftime('%Y-%m-%dT%H:%M:%SZ')}.")
+        f"Running job for {then.strftime('%Y-%m-%dT%H:%M:%SZ')} to {now.strftime('%Y-%m-%dT%H:%M:%SZ')}. Time stamp will be {then.strftime('%Y-%m-%dT%H:%M:%SZ')}.",
+        extra=log_extra)
 
     # generate the query
     start_time = time.time()
 
     # setting up tags and fields in the run function in case the user
     # has set NO_SCHEMA_CACHE=true, it can recalcuate the schema on successive runs
-    setup_tags_and_fields()
-    log_tags = [("task_id", task_id),
-                ("source_host", source_host),
-                ("source_measurement", source_measurement),
-                ("target_measurement", target_measurement),
-                ("interval", interval),
-                ("task_id", task_id),
+    setup_tags_and_fields(task)
+    log_tags = [("task_id", task.task_id),
+                ("source_host", task.source_host),
+                ("source_measurement", task.source_measurement),
+                ("target_measurement", task.target_measurement),
+                ("interval", task.interval),
+                ("aggregation_engine", task.aggregation_engine),
+                ("query_language", task.query_language),
+                ("task_id", task.task_id),
                 ("task_host", socket.gethostname())]
+    if rerun:
+        log_tags.append(("rerun", "late_data"))
 
     log_fields = [("start", then.strftime('%Y-%m-%dT%H:%M:%SZ')),
                   ("stop", now.strftime('%Y-%m-%dT%H:%M:%SZ'))]
 
-    query = get_query(fields, source_measurement, then, now,
-                      tags, interval, aggregate, tag_values)
-    logger.debug(f"running query: {query}")
+    if scheduler_lag is not None:
+        # windows missed while the task was busy or stalled are run together with the scheduled one
+        log_fields.append(("scheduler_lag", scheduler_lag))
+        log_fields.append(("coalesced_windows", len(window_ends)))
+
+    if task.schema_cache is not None:
+        log_fields.append(("schema_cache_hits", task.schema_cache_hits))
+        log_fields.append(("schema_cache_misses", task.schema_cache_misses))
+        log_fields.append(("schema_refresh_time", task.schema_refresh_time))
+
+    subwindows = get_subwindows(task, then, now)
+    queries = [get_query_for_window(task, sub_then, sub_now) for sub_then, sub_now in subwindows]
+    for query in queries:
+        logger.debug(f"running query: {query}", extra=log_extra)
     end_time = time.time()
 
     query_gen_time = end_time - start_time
     log_fields.append(("query_gen_time", query_gen_time))
+    if len(subwindows) > 1:
+        log_fields.append(("subwindows", len(subwindows)))
 
     # execute the query
     start_time = time.time()
 
-    # get_downsampled data will return an arrow stream reader if successful
-    # if success == false, reader will be an exception string
-    success, reader = get_down_sampled_data(query)
+    if len(queries) == 1:
+        success, reader = run_query(task, queries[0])
+    else:
+        # query errors of the sub-windows surface while the stream is drained
+        success = True
+        reader = ConcurrentChunkReader([lambda q=q: run_query(task, q) for q in queries],
+                                       max_concurrency=task.subwindow_concurrency,
+                                       queue_size=task.write_queue_size)
     end_time = time.time()
     query_time = end_time - start_time
-    log_fields.append(("query_time", query_time))
+
+    if success and task.cascade_tiers:
+        reader = MeanReader(reader, mean_aliases(task.fields, task.aggregate))
 
     if not success:
         exception_string = reader
+        finish_profile(task, profile, then, log_fields)
+        log_fields.append(("query_time", query_time))
         log_tags.append(("error", "query"))
         log_fields.append(("exception", exception_string))
-        log("task_log", log_tags, log_fields)
-        logger.error(f"Downsampling job failed with {exception_string}")
-        return
-
-    # write the downsampled data
-    start_time = time.time()
+        log(task, "task_log", log_tags, log_fields)
+        metrics.runs.inc(task_id=task.task_id, status="error")
+        logger.error(f"Downsampling job failed with {exception_string}", extra=log_extra)
+        return False
+
+    # write the downsampled data, the stream is drained while earlier chunks are written
+    # so the stage timings are collected by write_downsampled_data
+    stats = {}
+    diagnose = task.diagnostics_sample_rate > 0 and random.random() < task.diagnostics_sample_rate
+    if diagnose:
+        stats["chunks"] = []
+    if profile is not None:
+        stats["profile"] = profile
 
     # if success if false, result is an error string
     # otherwise results is the count of rows written
-    success, result, row_count, retries = write_downsampled_data(reader)
-    end_time = time.time()
-    write_time = end_time - start_time
-    log_fields.append(("write_time", write_time))
+    success, result, row_count, retries = write_downsampled_data(task, reader, stats)
+    record_run_metrics(task, stats, query_time, time.time() - start_time, row_count, retries, success)
+    finish_profile(task, profile, then, log_fields)
+    if diagnose:
+        # after the run, so the plan query does not add to its timings
+        log_diagnostics(task, then, now, queries[0], query_time, stats)
+
+    # the query stage includes draining the stream, not just the call that starts it
+    log_fields.append(("query_time", query_time + stats.get("drain_time", 0.0)))
+    log_fields.append(("write_time", stats.get("write_time", 0.0)))
+    write_batches = stats.get("write_batches", 0)
+    log_fields.append(("write_batches", write_batches))
+    if write_batches > 0:
+        log_fields.append(("avg_batch_rows", stats["write_rows"] / write_batches))
+        log_fields.append(("avg_batch_bytes", stats["write_bytes"] / write_batches))
+        if task.write_gzip_level is not None:
+            log_fields.append(("compression_ratio", stats["write_bytes"] / stats["write_compressed_bytes"]))
+    if task.written_hashes is not None:
+        log_fields.append(("written_rows", stats.get("write_rows", 0)))
+        log_fields.append(("skipped_rows", stats.get("skipped_rows", 0)))
+    if task.write_spool is not None:
+        log_fields.append(("spooled_rows", stats.get("spooled_rows", 0)))
+        log_fields.append(("spool_bytes", task.write_spool.size()))
+        log_fields.append(("spool_evicted_files", task.write_spool.evicted_files))
     if not success:
-        log_tags.append(("error", "write"))
+        log_tags.append(("error", stats.get("error_stage", "write")))
         log_fields.append(("exception", result))
         log_fields.append(("row_count", row_count))
         log_fields.append(("retries", retries))
-        log("task_log", log_tags, log_fields)
+        log(task, "task_log", log_tags, log_fields)
         logger.error(
-            f"Downsampling job failed with {result}, {retries} retries, {row_count} rows written")
-        return
+            f"Downsampling job failed with {result}, {retries} retries, {row_count} rows written",
+            extra=log_extra)
+        return False
     log_fields.append(("retries", retries))
     log_fields.append(("row_count", row_count))
+
+    # remember the density of the measurement for sizing the sub-windows of later runs
+    task.rows_per_interval = row_count / len(window_ends)
+
     # log the results
-    log("task_log", log_tags, log_fields)
-    logger.info(f"Downsampling job run successfully for {row_count} rows")
+    log(task, "task_log", log_tags, log_fields)
+    logger.info(f"Downsampling job run successfully for {row_count} rows", extra=log_extra)
+
+    # a window whose higher tiers failed is not complete, so it is run again with them
+    if task.cascade_tiers and not run_cascade(task, then, now):
+        return False
+
+    if task.checkpoint_store is not None:
+        try:
+            task.checkpoint_store.mark_completed(task.task_id, window_ends, row_count)
+        except Exception as e:
+            # the data is written, at worst the window is processed again after a restart
+            logger.error(f"Failed to record the checkpoint: {str(e)}", extra=log_extra)
+    return True
+
+
+def run_cascade(task, then, now):
+    # computes every higher tier window that closed in then..now from the tier below it
+    success = True
+    lower_measurement = task.target_measurement
+    for tier in task.cascade_tiers:
+        interval = get_interval_timedelta(tier["interval_val"], tier["interval_type"])
+        epoch = datetime(1970, 1, 1, tzinfo=now.tzinfo)
+        boundary = epoch + interval * ((then - epoch) // interval + 1)
+        while boundary <= now:
+            success = run_tier(task, tier, lower_measurement, boundary - interval, boundary) and success
+            boundary += interval
+        lower_measurement = tier["measurement"]
+    return success
+
+
+def run_tier(task, tier, lower_measurement, then, now):
+    log_extra = {"task_id": task.task_id}
+    log_tags = [("task_id", task.task_id),
+                ("source_measurement", lower_measurement),
+                ("target_measurement", tier["measurement"]),
+                ("interval", tier["interval"]),
+                ("tier", tier["interval"]),
+                ("task_host", socket.gethostname())]
+    log_fields = [("start", then.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                  ("stop", now.strftime('%Y-%m-%dT%H:%M:%SZ'))]
+
+    template = get_cascade_query_template(merge_aggregations(task.fields, task.aggregate), lower_measurement,
+                                          task.tags, tier["interval"], include_then=True)
+    query = fill_query_template(template, then, now)
+    logger.debug(f"running tier query: {query}", extra=log_extra)
+
+    start_time = time.time()
+    try:
+        reader = task.cascade_client.query(query, language="influxql", mode="chunk", database=task.target_db)
+    except Exception as e:
+        log_fields.append(("query_time", time.time() - start_time))
+        log_tags.append(("error", "query"))
+        log_fields.append(("exception", str(e)))
+        log(task, "task_log", log_tags, log_fields)
+        logger.error(f"Tier {tier['interval']} failed with {str(e)}", extra=log_extra)
+        return False
+    query_time = time.time() - start_time
+
+    # the writer only needs a different target measurement
+    tier_task = copy.copy(task)
+    tier_task.target_measurement = tier["measurement"]
+    stats = {}
+    success, result, row_count, retries = write_downsampled_data(
+        tier_task, MeanReader(reader, mean_aliases(task.fields, task.aggregate)), stats)
+
+    log_fields.append(("query_time", query_time + stats.get("drain_time", 0.0)))
+    log_fields.append(("write_time", stats.get("write_time", 0.0)))
+    log_fields.append(("retries", retries))
+    log_fields.append(("row_count", row_count))
+    if not success:
+        log_tags.append(("error", stats.get("error_stage", "write")))
+        log_fields.append(("exception", result))
+        log(task, "task_log", log_tags, log_fields)
+        logger.error(f"Tier {tier['interval']} failed with {result}", extra=log_extra)
+        return False
+    log(task, "task_log", log_tags, log_fields)
+    logger.info(f"Tier {tier['interval']} run successfully for {row_count} rows", extra=log_extra)
+    return True
+
+def log_diagnostics(task, then, now, query, query_time, stats):
+    log_tags = [("task_id", task.task_id),
+                ("source_measurement", task.source_measurement),
+                ("interval", task.interval),
+                ("task_host", socket.gethostname())]
+    window_fields = [("start", then.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                     ("stop", now.strftime('%Y-%m-%dT%H:%M:%SZ'))]
+
+    fields = window_fields + [("query_call_time", query_time), ("chunks", len(stats["chunks"]))]
+    if "first_chunk_delay" in stats:
+        fields.append(("time_to_first_chunk", query_time + stats["first_chunk_delay"]))
+    fields.append(("drain_time", stats.get("drain_time", 0.0)))
+    try:
+        fields.append(("plan", get_query_plan(task, query)))
+    except Exception as e:
+        logger.error(f"EXPLAIN ANALYZE failed with exception {str(e)}", extra={"task_id": task.task_id})
+        fields.append(("plan_error", str(e)))
+    log(task, DIAGNOSTICS_MEASUREMENT, log_tags + [("record", "run")], fields)
+
+    for number, chunk_fields in chunk_points(query_time, stats["chunks"]):
+        log(task, DIAGNOSTICS_MEASUREMENT, log_tags + [("record", "chunk"), ("chunk", str(number))],
+            window_fields + chunk_fields)
+
+
+def record_run_metrics(task, stats, query_time, run_time, row_count, retries, success):
+    if "first_chunk_delay" in stats:
+        # the query call returns before any data has streamed
+        metrics.time_to_first_chunk.observe(query_time + stats["first_chunk_delay"], task_id=task.task_id)
+    metrics.drain_time.observe(stats.get("drain_time", 0.0), task_id=task.task_id)
+    if success and run_time > 0:
+        metrics.rows_per_second.observe(row_count / run_time, task_id=task.task_id)
+    metrics.written_bytes.inc(stats.get("write_compressed_bytes", 0), task_id=task.task_id)
+    metrics.write_retries.inc(retries, task_id=task.task_id)
+    metrics.runs.inc(task_id=task.task_id, status="success" if success else "error")
+
+
+def get_write_limiter(task):
+    # tasks set up without setup_write_options get a limiter on their first write
+    if task.write_limiter is None:
+        task.write_limiter = WriteLimiter(task.write_workers)
+    return task.write_limiter
+
+
+def write_batch(task, payload, batch_number, content_encoding=None):
+    # returns the number of retries, raises once the retries are exhausted
+    limiter = get_write_limiter(task)
+    retries = 0
+    # compressed payloads are sent as they are, with a Content-Encoding header
+    kwargs = {} if content_encoding is None else {"content_encoding": content_encoding}
+    for tries in range(task.max_write_retries):
+        # waits for a free slot, and for the backoff of a failed write to pass
+        started = limiter.acquire()
+        start_time = time.time()
+        try:
+            task.target_client.write(record=payload, database=task.target_db, **kwargs)
+        except Exception as e:
+            metrics.write_batch_latency.observe(time.time() - start_time, task_id=task.task_id)
+            limiter.release(started, failed=True, overloaded=is_overloaded(e), retry_after=retry_after_seconds(e))
+            metrics.write_concurrency_limit.set(limiter.limit, task_id=task.task_id)
+            retries += 1
+            logger.error(
+                f"Error on batch {batch_number} write attempt {tries+1}: {str(e)}")
+            # if this was the last retry and it still failed, re-raise the exception
+            if tries == task.max_write_retries - 1:
+                raise
+            continue
+
+        metrics.write_batch_latency.observe(time.time() - start_time, task_id=task.task_id)
+        limiter.release(started)
+        metrics.write_concurrency_limit.set(limiter.limit, task_id=task.task_id)
+        logger.debug(
+            f"Successful write for batch {batch_number} attempt {tries + 1}")
+        return retries
+    return retries
+
+
+def write_batch_row_target(task):
+    # the row limit, lowered to fit the byte limit once the size of a line is known
+    rows = task.write_batch_rows
+    if task.bytes_per_row:
+        rows = min(rows, max(1, int(task.write_batch_bytes // task.bytes_per_row)))
+    return rows
+
+
+def write_downsampled_data(task, reader, stats=None):
+    """
+    Drains the reader into a bounded queue in the calling thread while task.write_workers
+    threads encode and write the chunks, so reading the next chunk overlaps the current
+    write. How many of the workers write at once is adapted to the target's load by
+    task.write_limiter. The queue holds at most task.write_queue_size chunks, which bounds
+    memory when writes are slower than the stream. The chunks are re-batched to task.write_batch_rows
+    rows and task.write_batch_bytes bytes of line protocol, and gzipped if configured.
+    Stage timings and batch sizes are added to stats if it is given.
+    """
+    if stats is None:
+        stats = {}
+
+    chunks = queue.Queue(maxsize=task.write_queue_size)
+    failed = threading.Event()
+    lock = threading.Lock()
+    errors = []
+    totals = {"retries": 0, "write_time": 0.0, "batches": 0, "rows": 0, "bytes": 0, "compressed_bytes": 0,
+              "spooled_rows": 0, "skipped_rows": 0}
+    content_encoding = None if task.write_gzip_level is None else "gzip"
+
+    spooling = threading.Event()
+
+    def spool_lines(piece):
+        # raises if the batch can not be spooled either, which fails the run
+        if not task.write_spool.spill(task, piece):
+            raise ValueError(f"write batch of {len(piece)} rows failed and does not fit in the write spool")
+        with lock:
+            totals["spooled_rows"] += len(piece)
+
+    def write_worker():
+        # the workers of a profiled run are profiled with it
+        if "profile" not in stats:
+            return write_chunks()
+        with stats["profile"].thread():
+            write_chunks()
+
+    def write_chunks():
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if failed.is_set():
+                # keep consuming so the reader never blocks on a full queue
+                continue
+            batch_number, batch = item
+            # where the batch failed, if it does
+            stage = "encode"
+            try:
+                written = None
+                if task.written_hashes is not None:
+                    # rows whose series and window were written before with the same values are skipped
+                    keys, values = row_hashes(batch, task.target_measurement, task.tags)
+                    changed = ~task.written_hashes.unchanged(keys, values)
+                    with lock:
+                        totals["skipped_rows"] += len(changed) - int(changed.sum())
+                    batch = batch.filter(pa.array(changed))
+                    written = (keys[changed], values[changed])
+                    if batch.num_rows == 0:
+                        continue
+                lines = encode_record_batch(batch, task.target_measurement, task.tags)
+                spilled = False
+                for piece in split_lines(lines, task.write_batch_bytes):
+                    payload = to_payload(piece)
+                    size = len(payload)
+                    if content_encoding is not None:
+                        payload = gzip_payload(payload, task.write_gzip_level)
+                    # once the target did not accept a batch of this run, the rest goes straight to the spool
+                    if not spooling.is_set():
+                        stage = "write"
+                        start_time = time.time()
+                        try:
+                            retries = write_batch(task, payload, batch_number, content_encoding)
+                        except Exception:
+                            with lock:
+                                # the failed batch used every retry
+                                totals["retries"] += task.max_write_retries
+                            if task.write_spool is None:
+                                raise
+                            spooling.set()
+                        else:
+                            with lock:
+                                totals["retries"] += retries
+                                totals["batches"] += 1
+                                totals["rows"] += len(piece)
+                                totals["bytes"] += size
+                                totals["compressed_bytes"] += len(payload)
+                                # sizes the row batches of later chunks and runs to the byte target
+                                task.bytes_per_row = totals["bytes"] / totals["rows"]
+                            continue
+                        finally:
+                            with lock:
+                                totals["write_time"] += time.time() - start_time
+                    stage = "spool"
+                    spool_lines(piece)
+                    spilled = True
+                # only remembered once the target has the rows, spooled rows are written again by a re-run
+                if written is not None and not spilled:
+                    task.written_hashes.remember(*written)
+            except Exception as e:
+                with lock:
+                    if not errors:
+                        stats["error_stage"] = stage
+                    errors.append(e)
+                failed.set()
+
+    workers = [threading.Thread(target=write_worker, daemon=True) for _ in range(task.write_workers)]
+    for worker in workers:
+        worker.start()
 
-def write_downsampled_data(reader):
     row_count = 0
-    retry_count = 0
     current_batch = 0
+    coalescer = BatchCoalescer(write_batch_row_target(task))
+    drain_start = time.time()
     try:
-        while True:
-            batch, buff = reader.read_chunk()
-
-            df = batch.to_pandas()
-            row_count += df.shape[0]
-
-            if 'iox::measurement' in df.columns:
-                df = df.drop('iox::measurement', axis=1)
-
-            max_retries = int(os.getenv("MAX_WRITE_RETRIES", 5))
-            for tries in range(max_retries):
-                try:
-                    target_client.write(record=df,
-                                        data_frame_measurement_name=target_measurement,
-                                        data_frame_timestamp_column="time",
-                                        data_frame_tag_columns=tags)
-                    # if write is successful, break the retry loop
+        while not failed.is_set():
+            try:
+                batch, buff = reader.read_chunk()
+            except StopIteration:
+                for rest in coalescer.flush():
                     current_batch += 1
-                    logger.debug(
-                        f"Successful write for batch {current_batch} attempt {tries + 1}")
-                    break
-
-                except Exception as e:
-                    retry_count += 1
-                    logger.error(
-                        f"Error on batch {current_batch + 1} write attempt {tries+1}: {str(e)}")
-                    # exponential backoff with jitter
-                    wait_time = (2 ** tries) + random.random()
-                    time.sleep(wait_time)
-                    # if this was the last retry and it still failed, re-raise the exception
-                    if tries == max_retries - 1:
-                        raise
-
-    except StopIteration as e:
-        return True, None, row_count, retry_count
-
+                    chunks.put((current_batch, rest))
+                break
+            if "first_chunk_delay" not in stats:
+                stats["first_chunk_delay"] = time.time() - drain_start
+            if "chunks" in stats:
+                # arrival and size of every chunk, for the diagnostics of a sampled run
+                stats["chunks"].append((time.time() - drain_start, batch.num_rows, batch.nbytes))
+            row_count += batch.num_rows
+            for ready in coalescer.add(batch):
+                current_batch += 1
+                chunks.put((current_batch, ready))
+            coalescer.max_rows = write_batch_row_target(task)
+    except Exception as e:
+        # reading the stream failed, so the query is to blame rather than the write
+        stats["error_stage"] = "query"
+        with lock:
+            errors.append(e)
+        failed.set()
+    finally:
+        stats["drain_time"] = time.time() - drain_start
+        if failed.is_set() and hasattr(reader, "close"):
+            # stop any queries still streaming into the reader
+            reader.close()
+        for _ in workers:
+            chunks.put(None)
+        for worker in workers:
+            worker.join()
+
+    stats["write_time"] = totals["write_time"]
+    stats["write_batches"] = totals["batches"]
+    stats["write_rows"] = totals["rows"]
+    stats["write_bytes"] = totals["bytes"]
+    stats["write_compressed_bytes"] = totals["compressed_bytes"]
+    stats["spooled_rows"] = totals["spooled_rows"]
+    stats["skipped_rows"] = totals["skipped_rows"]
+    if errors:
+        logger.error(f"write failed with exception {str(errors[0])}")
+        return False, str(errors[0]), row_count, totals["retries"]
+    return True, None, row_count, totals["retries"]
+
+
+def get_window_counts(task, then, now):
+    # one query counting the source points of every interval in then..now, by window end
+    query = get_count_query(task.fields, task.source_measurement, then, now, task.interval, task.tag_values)
+    table = task.source_client.query(query, language="influxql", mode="all", database=task.source_db)
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+
+    totals = None
+    for field in task.fields:
+        if field in table.column_names:
+            column = pc.fill_null(table.column(field), 0)
+            totals = column if totals is None else pc.add(totals, column)
+    if totals is None:
+        return {}
+
+    counts = {}
+    for bucket, count in zip(table.column("time").to_pylist(), totals.to_pylist()):
+        counts[from_epoch(to_epoch(bucket)) + interval] = count
+    return counts
+
+
+def get_scheduled_time(task, started):
+    # the latest run time of the task's trigger at or before started
+    if task.schedule_interval is None:
+        return task.schedule_start
+    elapsed = max(started - task.schedule_start, task.schedule_interval * 0)
+    return task.schedule_start + task.schedule_interval * (elapsed // task.schedule_interval)
+
+
+def get_scheduled_window(task, scheduled):
+    # the window ending at the scheduled time, extended back to the end of the last scheduled
+    # window, so the windows missed while the task was busy or stalled are run with it
+    now = scheduled.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    then = get_then(task.interval_val, task.interval_type, now)
+    if task.last_window_end is None or task.last_window_end >= then:
+        return then, now
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    oldest = now - interval * task.max_coalesced_windows
+    if task.last_window_end < oldest:
+        # the rest is left to the checkpoints or a backfill
+        logger.warning(f"Task {task.task_id} missed the windows from {task.last_window_end.isoformat()} to "
+                       f"{oldest.isoformat()}, only the last {task.max_coalesced_windows} are run",
+                       extra={"task_id": task.task_id})
+        return oldest, now
+    return task.last_window_end, now
+
+
+def owns_task(task):
+    # without a fleet every task belongs to this process
+    if task.fleet is None:
+        return True
+    try:
+        return task.fleet.acquire(task.task_id)
     except Exception as e:
-        logger.error(f"write failed with exception {str(e)}")
-        return False, str(e), row_count, retry_count
+        # without the lease store no replica can tell who owns the task, so none runs it
+        logger.error(f"Acquiring the lease of task {task.task_id} failed with exception {str(e)}")
+        return False
+
+
+def run_scheduled(task):
+    # the scheduler's job, which records how late it started and catches up on missed windows
+    started = datetime.now()
+    if not owns_task(task):
+        logger.debug(f"Task {task.task_id} is run by another replica, skipping")
+        # the windows run by the other replica are not caught up on when the task comes back
+        task.last_window_end = None
+        return True
+    if task.schedule_start is None:
+        return run_with_late_data(task)
+    scheduled = get_scheduled_time(task, started)
+    lag = (started - scheduled).total_seconds()
+    metrics.scheduler_lag.observe(lag, task_id=task.task_id)
+
+    # the window ends at the interval boundary, the run starts start_offset after it
+    then, now = get_scheduled_window(task, scheduled - task.start_offset)
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    coalesced = round((now - then) / interval) - 1
+    if coalesced > 0:
+        logger.info(f"Running {coalesced} missed windows together with the window ending {now.isoformat()}",
+                    extra={"task_id": task.task_id})
+        metrics.coalesced_windows.inc(coalesced, task_id=task.task_id)
+    try:
+        return run_with_late_data(task, now=now, then=then, scheduler_lag=lag)
+    finally:
+        # failed windows are not run again by the next run, as before
+        task.last_window_end = now
+
+
+def run_with_late_data(task, now=None, then=None, scheduler_lag=None):
+    # runs the window that just closed, then re-runs the recent windows whose
+    # source point counts changed since they were processed
+    if task.late_data_windows == 0:
+        return run(task, now=now, then=then, scheduler_lag=scheduler_lag)
 
+    if now is None:
+        now = datetime.now(timezone.utc)
+    now = now.replace(second=0, microsecond=0)
+    log_extra = {"task_id": task.task_id}
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    start = now - interval * (task.late_data_windows + 1)
 
-def log(measurement, tags, fields):
+    # counted before the window is queried, so points arriving during the run are caught next time
+    try:
+        setup_tags_and_fields(task)
+        counts = get_window_counts(task, start, now)
+    except Exception as e:
+        logger.error(f"Checking for late data failed with {str(e)}", extra=log_extra)
+        counts = None
+
+    success = run(task, now=now, then=then, scheduler_lag=scheduler_lag)
+    if counts is None:
+        return success
+
+    previous = task.checkpoint_store.source_counts(task.task_id, start, now)
+    recorded = {}
+    if success:
+        recorded[now] = counts.get(now, 0)
+
+    for i in range(task.late_data_windows, 0, -1):
+        window_end = now - interval * i
+        count = counts.get(window_end, 0)
+        if not task.checkpoint_store.is_completed(task.task_id, [window_end]):
+            # the scheduled run of the window failed, it is retried with every point it has now
+            logger.info(f"Window ending {window_end.isoformat()} did not complete, running it again",
+                        extra=log_extra)
+            if run(task, now=window_end):
+                recorded[window_end] = count
+        elif window_end not in previous:
+            # windows processed before the late data mode was enabled have no count to compare to
+            recorded[window_end] = count
+        elif previous[window_end] != count:
+            logger.info(f"Window ending {window_end.isoformat()} changed from {previous[window_end]} to {count} points",
+                        extra=log_extra)
+            # a failed rerun keeps its previous count, so it is retried on the next run
+            if run(task, now=window_end, rerun=True):
+                recorded[window_end] = count
+
+    task.checkpoint_store.record_source_counts(task.task_id, recorded)
+    return success
+
+
+def log(task, measurement, tags, fields):
     logger.info(f"logging: {measurement},{tags},{fields}")
-    if logging_client is None:
+    if task.logging_client is None:
         logger.info("No logging client specified, skipping logging")
         return
-    point = Point(measurement)
+    # imported with the logging client, runs without one never need it
+    from influxdb_client_3 import Point
+    # timestamped here, the point is written later by the telemetry flusher
+    point = Point(measurement).time(datetime.now(timezone.utc))
     for field in fields:
         point.field(field[0], field[1])
     for tag in tags:
         point.tag(tag[0], tag[1])
-    try:
-        logging_client.write(point)
-    except Exception as e:
-        logger.error(f"Logging failed with exception {str(e)}")
-
+    if task.telemetry is None:
+        try:
+            task.logging_client.write(point, database=task.log_db)
+        except Exception as e:
+            logger.error(f"Logging failed with exception {str(e)}")
+        return
+    task.telemetry.submit((task.log_host, task.log_db), task.logging_client, task.log_db,
+                          point.to_line_protocol())
 
-def setup_source_client():
-    host = os.getenv('SOURCE_HOST')
-    db = os.getenv('SOURCE_DB')
-    token = os.getenv('SOURCE_TOKEN')
-    org = os.getenv('SOURCE_ORG', 'none')
 
-    global source_measurement
-    source_measurement = os.getenv('SOURCE_MEASUREMENT')
+def setup_source_client(task):
+    host = task.getenv('SOURCE_HOST')
+    db = task.getenv('SOURCE_DB')
+    token = task.getenv('SOURCE_TOKEN')
+    org = task.getenv('SOURCE_ORG', 'none')
 
-    global source_host
-    source_host = host
+    task.source_measurement = task.getenv('SOURCE_MEASUREMENT')
+    task.source_host = host
+    task.source_db = db
 
-    if None in [host, db, token, source_measurement]:
+    if None in [host, db, token, task.source_measurement]:
         logger.critical(
             "Source host, database, token, or measurement not defined. Aborting ...")
         exit(1)
     else:
-        global source_client
-
-        source_client = InfluxDBClient3(
-            host=host, database=db, token=token, org=org)
-
-def setup_target_client():
-    global source_host
-    global source_measurement
-    global target_measurement
+        task.source_client = get_client(host, db, token, org)
 
-    host = os.getenv('TARGET_HOST', source_host)
-    db = os.getenv('TARGET_DB')
-    token = os.getenv('TARGET_TOKEN', os.getenv('SOURCE_TOKEN'))
-    org = os.getenv('TARGET_ORG', 'none')
-    target_measurement = os.getenv('TARGET_MEASUREMENT', source_measurement)
+def setup_target_client(task):
+    host = task.getenv('TARGET_HOST', task.source_host)
+    db = task.getenv('TARGET_DB')
+    token = task.getenv('TARGET_TOKEN', task.getenv('SOURCE_TOKEN'))
+    org = task.getenv('TARGET_ORG', 'none')
+    task.target_measurement = task.getenv('TARGET_MEASUREMENT', task.source_measurement)
+    task.target_db = db
 
-    if None in [host, db, token, source_measurement]:
+    if None in [host, db, token, task.source_measurement]:
         logger.critical(
             "Target host, database, token, or measurement not defined. Aborting ...")
         exit(1)
     else:
-        global target_client
-        wco = write_client_options(write_options=SYNCHRONOUS)
-        target_client = InfluxDBClient3(
-            host=host, database=db, token=token, org=org, write_client_options=wco)
+        task.target_client = get_client(host, db, token, org, writer=True)
 
 
-def setup_container_logging():
-    host = os.getenv('LOG_HOST')
-    db = os.getenv('LOG_DB')
-    token = os.getenv('LOG_TOKEN')
-    org = os.getenv('LOG_ORG', 'none')
+def setup_container_logging(task):
+    host = task.getenv('LOG_HOST')
+    db = task.getenv('LOG_DB')
+    token = task.getenv('LOG_TOKEN')
+    org = task.getenv('LOG_ORG', 'none')
 
     if None in [host, db, token]:
         logger.info(
             "Log host, database, or token not defined. Skipping logging.")
     else:
-        global logging_client
-        logging_client = InfluxDBClient3(
-            host=host, database=db, token=token, org=org)
+        task.log_host = host
+        task.log_db = db
+        task.logging_client = get_client(host, db, token, org)
 
 
-def setup_task_id():
-    global task_id
-    task_id = os.getenv('TASK_ID', ''.join(random.choices(
+def setup_task_id(task):
+    task.task_id = task.getenv('TASK_ID', ''.join(random.choices(
         string.ascii_uppercase + string.digits, k=7)))
 
 
-def setup_no_schema_cache_option():
-    global ignore_schema_cache
-    ignore_schema_cache_opt = os.getenv('NO_SCHEMA_CACHE', "false")
-    ignore_schema_cache = ignore_schema_cache_opt.lower() in ['true', '1']
+def setup_no_schema_cache_option(task):
+    ignore_schema_cache_opt = task.getenv('NO_SCHEMA_CACHE', "false")
+    task.ignore_schema_cache = ignore_schema_cache_opt.lower() in ['true', '1']
+
+
+def int_setting(name, default, minimum=1, getenv=os.getenv):
+    opt = getenv(name, str(default))
+    try:
+        value = int(opt)
+    except ValueError:
+        value = minimum - 1
+    if value < minimum:
+        logger.critical(f"invalid {name}: {opt}")
+        exit(1)
+    logger.debug(f"{name} is {value}")
+    return value
+
+
+def backfill_concurrency_setting(task):
+    return int_setting('BACKFILL_CONCURRENCY', 1, getenv=task.getenv)
+
+
+def setup_write_options(task):
+    task.max_write_retries = int_setting('MAX_WRITE_RETRIES', 5, getenv=task.getenv)
+    task.write_workers = int_setting('WRITE_WORKERS', 4, getenv=task.getenv)
+    task.write_queue_size = int_setting('WRITE_QUEUE_SIZE', 4, getenv=task.getenv)
+    task.write_batch_rows = int_setting('WRITE_BATCH_ROWS', 10000, getenv=task.getenv)
+    task.write_batch_bytes = int_setting('WRITE_BATCH_BYTES', 5000000, getenv=task.getenv)
+
+    # writes in flight start at one and grow up to WRITE_WORKERS while the target keeps up
+    latency_target = task.getenv('WRITE_LATENCY_TARGET')
+    if latency_target is not None:
+        latency_target = int_setting('WRITE_LATENCY_TARGET', None, getenv=task.getenv) / 1000
+    task.write_limiter = WriteLimiter(task.write_workers, latency_target=latency_target)
+
+    # remembers what was written, so re-runs skip the series whose values did not change
+    dedup_entries = int_setting('WRITE_DEDUP_MAX_ENTRIES', 0, minimum=0, getenv=task.getenv)
+    if dedup_entries > 0:
+        task.written_hashes = WrittenHashes(dedup_entries, int_setting('WRITE_DEDUP_TTL', 86400, getenv=task.getenv))
+
+    write_gzip = task.getenv('WRITE_GZIP', 'false').lower() in ['true', '1']
+    if write_gzip:
+        task.write_gzip_level = int_setting('WRITE_GZIP_LEVEL', 1, getenv=task.getenv)
+        if task.write_gzip_level > 9:
+            logger.critical(f"invalid WRITE_GZIP_LEVEL: {task.write_gzip_level}")
+            exit(1)
+
+
+def setup_subwindow_options(task):
+    if task.getenv('SUBWINDOW_INTERVALS') is not None:
+        task.subwindow_intervals = int_setting('SUBWINDOW_INTERVALS', 1, getenv=task.getenv)
+    if task.getenv('SUBWINDOW_ROW_BUDGET') is not None:
+        task.subwindow_row_budget = int_setting('SUBWINDOW_ROW_BUDGET', 1, getenv=task.getenv)
+    task.subwindow_concurrency = int_setting('SUBWINDOW_CONCURRENCY', 1, getenv=task.getenv)
+
+
+def setup_schema_cache():
+    # the schema cache is shared by every task in the process
+    directory = os.getenv('SCHEMA_CACHE_DIR')
+    ttl = os.getenv('SCHEMA_CACHE_TTL')
+    if directory is None and ttl is None:
+        return None
+    if ttl is not None:
+        ttl = int_setting('SCHEMA_CACHE_TTL', None)
+    logger.debug(f"Schema cache in {directory} with a TTL of {ttl}")
+    return SchemaCache(directory, ttl)
+
+
+def setup_checkpoint_store():
+    # the checkpoint store is shared by every task in the process, keyed by TASK_ID
+    path = os.getenv('CHECKPOINT_DB')
+    if path is None:
+        return None
+    try:
+        store = SQLiteCheckpointStore(path)
+    except Exception as e:
+        logger.critical(f"Failed to open CHECKPOINT_DB {path}: {str(e)}")
+        exit(1)
+    logger.debug(f"Recording completed windows in {path}")
+    return store
+
+
+def setup_diagnostics_option(task):
+    rate = task.getenv('DIAGNOSTICS_SAMPLE_RATE', '0')
+    try:
+        task.diagnostics_sample_rate = float(rate)
+    except ValueError:
+        task.diagnostics_sample_rate = -1
+    if not 0 <= task.diagnostics_sample_rate <= 1:
+        logger.critical(f"invalid DIAGNOSTICS_SAMPLE_RATE: {rate}, must be between 0 and 1")
+        exit(1)
+
+
+def setup_profile_option(task):
+    rate = task.getenv('PROFILE_SAMPLE_RATE', '0')
+    try:
+        task.profile_sample_rate = float(rate)
+    except ValueError:
+        task.profile_sample_rate = -1
+    if not 0 <= task.profile_sample_rate <= 1:
+        logger.critical(f"invalid PROFILE_SAMPLE_RATE: {rate}, must be between 0 and 1")
+        exit(1)
+    task.profile_dir = task.getenv('PROFILE_DIR')
+
+
+def setup_schedule_options(task):
+    task.max_coalesced_windows = int_setting('MAX_COALESCED_WINDOWS', 60, getenv=task.getenv)
+    max_offset = int_setting('START_STAGGER_SECONDS', 0, minimum=0, getenv=task.getenv)
+    interval = get_interval_timedelta(task.interval_val, task.interval_type)
+    task.start_offset = get_start_offset(task.task_id, interval, max_offset)
+    logger.debug(f"Task {task.task_id} starts {task.start_offset} into its interval")
+
+
+def setup_late_data_option(task):
+    task.late_data_windows = int_setting('LATE_DATA_WINDOWS', 0, minimum=0, getenv=task.getenv)
+    if task.late_data_windows > 0 and task.checkpoint_store is None:
+        # the source counts of processed windows are kept with the checkpoints
+        logger.critical("LATE_DATA_WINDOWS requires CHECKPOINT_DB")
+        exit(1)
+
+
+def setup_metrics_endpoint():
+    port = os.getenv('METRICS_PORT')
+    if port is None:
+        return None
+    port = int_setting('METRICS_PORT', 9090, minimum=0)
+    try:
+        server = metrics.start_metrics_server(port)
+    except Exception as e:
+        logger.critical(f"Failed to serve metrics on port {port}: {str(e)}")
+        exit(1)
+    logger.info(f"Serving metrics on port {server.server_port}")
+    return server
+
+
+def setup_write_spool():
+    # write batches that used up their retries are kept here for every task in the process
+    directory = os.getenv('WRITE_SPOOL_DIR')
+    if directory is None:
+        return None
+    max_bytes = int_setting('WRITE_SPOOL_MAX_BYTES', 1000000000)
+    drain_interval = int_setting('WRITE_SPOOL_DRAIN_INTERVAL', 30)
+    try:
+        spool = WriteSpool(directory, max_bytes, drain_interval)
+    except Exception as e:
+        logger.critical(f"Failed to open WRITE_SPOOL_DIR {directory}: {str(e)}")
+        exit(1)
+    logger.debug(f"Write spool in {directory}, holding at most {max_bytes} bytes")
+    return spool
+
+
+def setup_fleet():
+    # replicas sharing FLEET_LEASE_DB split the tasks among themselves
+    path = os.getenv('FLEET_LEASE_DB')
+    if path is None:
+        return None
+    replica_id = os.getenv('FLEET_REPLICA_ID', socket.gethostname())
+    lease_ttl = int_setting('FLEET_LEASE_TTL', 60)
+    try:
+        fleet = Fleet(SQLiteLeaseStore(path), replica_id, lease_ttl)
+        fleet.start()
+    except Exception as e:
+        logger.critical(f"Failed to join the fleet in FLEET_LEASE_DB {path}: {str(e)}")
+        exit(1)
+    # leaving hands the tasks to the other replicas without waiting for the leases to expire
+    atexit.register(fleet.close)
+    logger.info(f"Joined the fleet as replica {replica_id}")
+    return fleet
+
+
+def setup_telemetry():
+    # task logs of every task are written by one background flusher
+    flush_interval = int_setting('TELEMETRY_FLUSH_INTERVAL', 5)
+    max_lines = int_setting('TELEMETRY_BUFFER_SIZE', 10000)
+    spill_dir = os.getenv('TELEMETRY_SPILL_DIR')
+    telemetry = TelemetryFlusher(flush_interval, max_lines, spill_dir=spill_dir)
+    # flush what is buffered when the process exits, including after RUN_ONCE or a backfill
+    atexit.register(telemetry.close)
+    return telemetry
+
+
+def setup_task(settings=None, schema_cache=None, checkpoint_store=None, telemetry=None, write_spool=None, fleet=None):
+    # parse input and setup the task's resources
+    task = Task(settings)
+    task.schema_cache = schema_cache
+    task.checkpoint_store = checkpoint_store
+    task.telemetry = telemetry
+    task.write_spool = write_spool
+    task.fleet = fleet
+    setup_interval(task)
+    setup_task_id(task)
+    setup_source_client(task)
+    setup_target_client(task)
+    setup_container_logging(task)
+    setup_no_schema_cache_option(task)
+    setup_aggregate(task)
+    setup_aggregation_engine(task)
+    setup_query_language(task)
+    setup_cascade(task)
+    setup_write_options(task)
+    setup_subwindow_options(task)
+    setup_late_data_option(task)
+    setup_schedule_options(task)
+    setup_diagnostics_option(task)
+    setup_profile_option(task)
+    if write_spool is not None:
+        write_spool.register(task)
+    return task
+
+
+def setup_tasks():
+    # TASKS_FILE runs every task defined in it in this process,
+    # otherwise the environment defines a single task
+    schema_cache = setup_schema_cache()
+    checkpoint_store = setup_checkpoint_store()
+    telemetry = setup_telemetry()
+    write_spool = setup_write_spool()
+    fleet = setup_fleet()
+    tasks_file = os.getenv('TASKS_FILE')
+    if tasks_file is None:
+        tasks = [setup_task(schema_cache=schema_cache, checkpoint_store=checkpoint_store, telemetry=telemetry,
+                            write_spool=write_spool, fleet=fleet)]
+        start_write_spool(write_spool)
+        return tasks
+
+    try:
+        task_settings = load_task_settings(tasks_file)
+    except Exception as e:
+        logger.critical(f"Failed to load TASKS_FILE {tasks_file}: {str(e)}")
+        exit(1)
+
+    tasks = [setup_task(settings, schema_cache, checkpoint_store, telemetry, write_spool, fleet)
+             for settings in task_settings]
+    task_ids = [task.task_id for task in tasks]
+    if len(set(task_ids)) != len(task_ids):
+        logger.critical(f"TASK_ID must be unique for every task in {tasks_file}")
+        exit(1)
+    logger.info(f"Loaded {len(tasks)} tasks from {tasks_file}")
+    start_write_spool(write_spool)
+    return tasks
+
+
+def start_write_spool(write_spool):
+    # once every task is registered, batches spooled before a restart can be written too
+    if write_spool is None:
+        return
+    write_spool.start()
+    atexit.register(write_spool.close)
 
 
-def backfill(interval_val, interval_type):
-    backfill_start = os.getenv('BACKFILL_START')
-    backfill_end = os.getenv('BACKFILL_END')
+def backfill(task):
+    # returns True if the task was set up as a backfill job
+    backfill_start = task.getenv('BACKFILL_START')
+    backfill_end = task.getenv('BACKFILL_END')
 
     if backfill_start is not None:
+        # only backfills parse free form dates, so the parser is imported here
+        from dateutil.parser import parse
         if backfill_end is None:
             backfill_end = datetime.now(timezone.utc)
         else:
             backfill_end = parse(backfill_end).astimezone(timezone.utc)
 
+        concurrency = backfill_concurrency_setting(task)
+        watermark_file = task.getenv('BACKFILL_WATERMARK_FILE')
+
         try:
             then = parse(backfill_start).astimezone(timezone.utc)
-
-            while then < backfill_end:
-                then = get_next_run_time(interval_val, interval_type, then)
-                run(interval_val, interval_type, now=then)
-            exit(0)
+            windows = get_backfill_windows(task.interval_val, task.interval_type, then, backfill_end)
+
+            # several intervals per run are split into sub-windows again by run()
+            window_intervals = int_setting('BACKFILL_WINDOW_INTERVALS', 1, getenv=task.getenv)
+            ungrouped = windows
+            windows = group_windows(windows, window_intervals)
+            # each grouped window starts where the previous one ended
+            window_starts = {}
+            if window_intervals > 1 and len(windows) > 0:
+                first_start = get_then(task.interval_val, task.interval_type, ungrouped[0])
+                window_starts = dict(zip(windows, [first_start] + windows[:-1]))
+
+            # resume after the last contiguous window completed by a previous attempt
+            watermark = read_watermark(watermark_file)
+            if watermark is not None:
+                logger.info(f"Resuming backfill after watermark {watermark.isoformat()}")
+                windows = skip_completed_windows(windows, watermark)
 
         except Exception as e:
             logger.critical(f"Parsing backfill failed with exception {str(e)}")
             exit(1)
 
+        logger.info(f"Backfilling {len(windows)} windows with concurrency {concurrency}")
+        completed, failed = run_windows(windows,
+                                        lambda now: run(task, now=now, then=window_starts.get(now)),
+                                        concurrency=concurrency,
+                                        watermark_file=watermark_file)
+        if failed > 0:
+            logger.error(f"Backfill finished with {failed} failed windows, {completed} completed")
+        else:
+            logger.info(f"Backfill finished, {completed} windows completed")
+        return True
+    return False
+
+
+def fill_missing_windows(task):
+    # runs every window since the first checkpoint of the task that has not completed,
+    # windows that already completed are left alone
+    if task.checkpoint_store is None or not owns_task(task):
+        return
+    first = task.checkpoint_store.first_window(task.task_id)
+    if first is None:
+        logger.debug(f"No checkpoints for task {task.task_id} yet")
+        return
+
+    now = datetime.now(timezone.utc)
+    try:
+        windows = [w for w in get_backfill_windows(task.interval_val, task.interval_type, first, now) if w <= now]
+        completed = task.checkpoint_store.completed_windows(task.task_id, first, now)
+    except Exception as e:
+        # the task is still scheduled, its gaps can be filled after the next restart
+        logger.error(f"Finding the missing windows of task {task.task_id} failed with exception {str(e)}")
+        return
+    missing = [w for w in windows if w not in completed]
+    if len(missing) == 0:
+        return
+
+    logger.info(f"Filling {len(missing)} missing windows of task {task.task_id} since {first.isoformat()}")
+    completed, failed = run_windows(missing,
+                                    lambda now: run(task, now=now),
+                                    concurrency=backfill_concurrency_setting(task))
+    if failed > 0:
+        logger.error(f"Filling missing windows finished with {failed} failed windows, {completed} completed")
+
 
 def run_once_setting():
     run_once_opt = os.getenv('RUN_ONCE', 'false')
@@ -333,81 +1372,123 @@ def run_once_setting():
     return run_once
 
 
-def run_previous_interval_setting():
-    run_previous_opt = os.getenv('RUN_PREVIOUS_INTERVAL', 'false')
+def run_previous_interval_setting(task):
+    run_previous_opt = task.getenv('RUN_PREVIOUS_INTERVAL', 'false')
     logger.debug(f"RUN_PREVIOUS_INTERVAL set to: {run_previous_opt}")
     run_previous = run_previous_opt.lower() in ['true', '1']
     logger.debug(f"RUN_PREVIOUS_INTERVAL is {run_previous}")
     return run_previous
 
 
-def run_previous_interval(interval_val, interval_type):
+def run_previous_interval(task):
     logger.info(f"Running previous interval")
-    now = get_next_run_time(interval_val, interval_type,
+    now = get_next_run_time(task.interval_val, task.interval_type,
                             run_previous=True, now=datetime.utcnow())
-    run(interval_val, interval_type, now=now)
-
-
-def schedule_and_run(interval_val, interval_type, run_once=False):
-    # set the start date based on the interval type
-    # set the values for the intervals
-    
-    start_date = datetime.now()
-    logger.debug(f"Scheduling and running, run_once is {run_once}")
-
-    interval_settings = {"days": 0, "hours": 0, "minutes": 0}
-    if interval_type == "m":
-        start_date = start_date.replace(minute=0, second=0, microsecond=0)
-        interval_settings["minutes"] = interval_val
-    elif interval_type == "h":
-        start_date = start_date.replace(minute=0, second=0, microsecond=0)
-        interval_settings["hours"] = interval_val
-    elif interval_type == "d":
-        start_date = start_date.replace(
-            hour=0, minute=0, second=0, microsecond=0)
-        interval_settings["days"] = interval_val
-
-    logger.debug(f"Start date set to {start_date}")
-    logger.debug(f"Intervall settings: {interval_settings}")
-
-    # specify and run the job
-    scheduler = BlockingScheduler()
-
-    if run_once:
-        start_date = get_next_run_time(interval_val,interval_type,now=datetime.now(),run_previous=False)
-        logger.debug(f"Will run once with start date: {start_date}")
-        scheduler.add_job(run,
-                    'date',
-                    run_date= start_date,
-                    args=[interval_val, interval_type],
-                    max_instances=10
-                    )
-        def job_completed_listener(event):
-            if not event.exception:
-                logger.debug("Job ran once and completed successfully")
-                # start a new thread to shutdown the schedule thread,
-                # after which the app should terminate
-                threading.Thread(target=scheduler.shutdown).start()
-
-            else:
-                logger.error(f"Job ran once, but encountered an error: {event}")
-                threading.Thread(target=scheduler.shutdown).start()
-
-        # Add listener only for the one-time job scenario
-        scheduler.add_listener(job_completed_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
-
-    else:
-        scheduler.add_job(run,
+    run(task, now=now)
+
+
+def task_workers_setting():
+    return int_setting('TASK_WORKERS', 10)
+
+
+def run_tasks_once(tasks):
+    # RUN_ONCE waits for the next run time of every task and runs it without starting a scheduler
+    workers = threading.BoundedSemaphore(task_workers_setting())
+
+    def run_at(task):
+        start_date = get_next_run_time(task.interval_val, task.interval_type, now=datetime.now(), run_previous=False)
+        start_date += task.start_offset
+        logger.debug(f"Task {task.task_id} will run once with start date: {start_date}")
+        task.schedule_start, task.schedule_interval = start_date, None
+        delay = (start_date - datetime.now()).total_seconds()
+        if delay > 0:
+            time.sleep(delay)
+        with workers:
+            try:
+                run_scheduled(task)
+                logger.debug(f"Job {task.task_id} ran once and completed successfully")
+            except Exception as e:
+                logger.error(f"Job {task.task_id} ran once, but encountered an error: {str(e)}")
+
+    # daemon threads, so a SIGTERM while they wait exits without waiting for them
+    threads = [threading.Thread(target=run_at, args=[task], daemon=True) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def schedule_and_run(tasks):
+    # imported here, as RUN_ONCE, backfills and the tests do not start a scheduler
+    from apscheduler.schedulers.background import BlockingScheduler
+    from apscheduler.executors.pool import ThreadPoolExecutor
+
+    # every task is scheduled on a single scheduler, sharing its pool of worker threads
+    executors = {"default": ThreadPoolExecutor(task_workers_setting())}
+    scheduler = BlockingScheduler(executors=executors)
+    logger.debug("Scheduling and running")
+
+    for task in tasks:
+        interval_val = task.interval_val
+        interval_type = task.interval_type
+
+        # set the start date based on the interval type
+        # set the values for the intervals
+        start_date = datetime.now()
+
+        interval_settings = {"days": 0, "hours": 0, "minutes": 0}
+        if interval_type == "m":
+            start_date = start_date.replace(minute=0, second=0, microsecond=0)
+            interval_settings["minutes"] = interval_val
+        elif interval_type == "h":
+            start_date = start_date.replace(minute=0, second=0, microsecond=0)
+            interval_settings["hours"] = interval_val
+        elif interval_type == "d":
+            start_date = start_date.replace(
+                hour=0, minute=0, second=0, microsecond=0)
+            interval_settings["days"] = interval_val
+
+        start_date += task.start_offset
+        logger.debug(f"Start date for task {task.task_id} set to {start_date}")
+        logger.debug(f"Intervall settings: {interval_settings}")
+
+        # specify the job, runs of a task never overlap: a run due while the previous one
+        # is still going is skipped, and its window is coalesced into the next run
+        task.schedule_start = start_date
+        task.schedule_interval = timedelta(**interval_settings)
+        scheduler.add_job(run_scheduled,
                         'interval',
+                        id=task.task_id,
                         days=interval_settings["days"],
                         hours=interval_settings["hours"],
                         minutes=interval_settings["minutes"],
                         seconds=0,
                         start_date=start_date,
-                        args=[interval_val, interval_type],
-                        max_instances=10
+                        args=[task],
+                        max_instances=1,
+                        coalesce=True,
+                        misfire_grace_time=None
                         )
-    scheduler.start()
+
+    try:
+        scheduler.start()
+    except SystemExit:
+        # raised by handle_shutdown, no new runs start while the task logs are flushed on exit
+        scheduler.shutdown(wait=False)
+        raise
+
+
+def handle_shutdown(signum, frame):
+    # docker stop sends SIGTERM to the process, which runs as PID 1 and would otherwise
+    # be killed without running the atexit hooks that flush the task logs
+    logger.info(f"Received signal {signum}, shutting down")
+    raise SystemExit(0)
+
+
+def setup_shutdown_handler():
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
 
 def setup_logger():
     global logger
@@ -436,24 +1517,33 @@ def setup_logger():
 if __name__ == "__main__":
     # set up the logger
     setup_logger()
+    setup_shutdown_handler()
 
-    interval_val, interval_type = parse_interval()
+    # parse input and setup the resources of every task
+    tasks = setup_tasks()
+    setup_metrics_endpoint()
 
-    # parse input and setup global resources
-    setup_task_id()
-    setup_source_client()
-    setup_target_client()
-    setup_container_logging()
-    setup_no_schema_cache_option()
-    setup_aggregate()
+    # tasks defined as backfill jobs run their backfill and are not scheduled,
+    # the process exits once there is no other task left to schedule
+    tasks = [task for task in tasks if not backfill(task)]
+    if len(tasks) == 0:
+        exit(0)
 
-    # run as backfill job and exit if defined by the user
-    backfill(interval_val, interval_type)
+    # catch up on windows missed while the process was down or that failed
+    for task in tasks:
+        fill_missing_windows(task)
 
     run_once = run_once_setting()
-    run_previous = run_previous_interval_setting()
 
-    if run_previous:
-        run_previous_interval(interval_val, interval_type)
-    if not(run_once and run_previous):
-        schedule_and_run(interval_val, interval_type, run_once=run_once)
+    scheduled = []
+    for task in tasks:
+        run_previous = run_previous_interval_setting(task)
+        if run_previous:
+            run_previous_interval(task)
+        if not(run_once and run_previous):
+            scheduled.append(task)
+
+    if len(scheduled) > 0 and run_once:
+        run_tasks_once(scheduled)
+    elif len(scheduled) > 0:
+        schedule_and_run(scheduled)
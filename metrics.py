@@ -0,0 +1,190 @@
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+RATE_BUCKETS = (10, 100, 1000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            # counts are per bucket here and made cumulative when rendered
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self, openmetrics):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: dict(value, counts=list(value["counts"])) for key, value in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels, ('le', format_value(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels, ('le', '+Inf'))} {values['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(values['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {values['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def render(self, openmetrics):
+        # OpenMetrics names the counter without its _total suffix, the text format with it
+        family = self.name if openmetrics else f"{self.name}_total"
+        lines = [f"# HELP {family} {self.help_text}", f"# TYPE {family} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}_total{format_labels(zip(self.label_names, key))} {format_value(value)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._series[key] = value
+
+    def render(self, openmetrics):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{format_labels(zip(self.label_names, key))} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, help_text, label_names=("task_id",), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=("task_id",)):
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, label_names=("task_id",)):
+        metric = Gauge(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, openmetrics=True):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+time_to_first_chunk = registry.histogram(
+    "downsampler_time_to_first_chunk_seconds", "Time from sending the query to receiving the first chunk.")
+drain_time = registry.histogram(
+    "downsampler_drain_seconds", "Time spent reading the query results stream.")
+write_batch_latency = registry.histogram(
+    "downsampler_write_batch_seconds", "Latency of each write request to the target.")
+rows_per_second = registry.histogram(
+    "downsampler_rows_per_second", "Rows downsampled per second of a run, from query to last write.",
+    buckets=RATE_BUCKETS)
+scheduler_lag = registry.histogram(
+    "downsampler_scheduler_lag_seconds", "Actual start of a scheduled run minus its scheduled start.")
+coalesced_windows = registry.counter(
+    "downsampler_coalesced_windows", "Missed windows run together with a later scheduled window.")
+written_bytes = registry.counter(
+    "downsampler_written_bytes", "Bytes sent to the target in write requests.")
+write_retries = registry.counter(
+    "downsampler_write_retries", "Failed write requests to the target that were retried or gave up.")
+write_concurrency_limit = registry.gauge(
+    "downsampler_write_concurrency_limit", "Writes to the target allowed in flight at once, adjusted to its load.")
+runs = registry.counter(
+    "downsampler_runs", "Completed runs by status.", label_names=("task_id", "status"))
+
+
+def start_metrics_server(port, host=""):
+    # serves /metrics from a daemon thread, returns the server so it can be shut down
+    # the HTTP server is imported here, processes without METRICS_PORT never load it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            body = registry.render(openmetrics).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"metrics request: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,99 @@
+import os
+import re
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+logger = logging.getLogger()
+
+# tracemalloc traces the whole process, so only one run at a time measures its peak
+_memory_lock = threading.Lock()
+
+
+class RunProfile:
+    """
+    Profiles one run with cProfile in every thread that works on it, the run's own thread
+    and the write workers, and measures the CPU time those threads used and the peak memory
+    allocated by Python with tracemalloc. The profiles of the threads are merged into one
+    pstats file when the run is dumped.
+    """
+
+    def __init__(self):
+        self.cpu_time = 0.0
+        self.peak_mem_bytes = None
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        self._stopped = False
+        self._tracing = _memory_lock.acquire(blocking=False)
+        if self._tracing:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self._main = self.thread()
+        self._main.__enter__()
+
+    def thread(self):
+        # wraps the work of one thread, profiles started in a thread must be stopped in it
+        return _ThreadProfile(self)
+
+    def _add(self, profile, cpu_time):
+        with self._lock:
+            if profile is not None:
+                self._profiles.append(profile)
+            self.cpu_time += cpu_time
+
+    def stop(self):
+        # stopping again does nothing, so it can be stopped both before logging and on errors
+        if self._stopped:
+            return
+        self._stopped = True
+        self._main.__exit__(None, None, None)
+        if self._tracing:
+            self.peak_mem_bytes = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+            _memory_lock.release()
+            self._tracing = False
+
+    def dump(self, directory, name):
+        # returns the path of the pstats file, which can be read with pstats or snakeviz
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + ".prof")
+        stats.dump_stats(path)
+        return path
+
+
+class _ThreadProfile:
+    def __init__(self, run_profile):
+        self.run_profile = run_profile
+        self.profile = None
+        self.start_cpu = None
+
+    def __enter__(self):
+        self.start_cpu = time.thread_time()
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # another profiler is active in this thread
+            logger.debug(f"Not profiling thread: {str(e)}")
+            self.profile = None
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+        self.run_profile._add(self.profile, time.thread_time() - self.start_cpu)
+        return False
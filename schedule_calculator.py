@@ -1,3 +1,4 @@
+import hashlib
 from datetime import datetime, timedelta
 
 def get_next_run_time(interval_val, interval_type, now=None, run_previous=False):
@@ -33,18 +34,35 @@ def get_next_run_time_minutes(minutes, now=None):
 def get_next_run_time_hours(hours, now=None):
     if now == None:
         now = datetime.now()
-    return now.replace(hour=now.hour + 1, minute=0, second=0, microsecond=0)
+    return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
 
 def get_next_run_time_days(days, now=None):
     if now == None:
         now = datetime.now()
-    return now.replace(day = now.day + 1, hour=0, minute=0, second=0, microsecond=0)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
    
 
+def get_interval_timedelta(interval_val, interval_type):
+    if interval_type == "m":
+        return timedelta(minutes=interval_val)
+    elif interval_type == "h":
+        return timedelta(hours=interval_val)
+    elif interval_type == "d":
+        return timedelta(days=interval_val)
+
 def get_then(interval_val, interval_type, now):
     if interval_type == "m":
         return now - timedelta(minutes=interval_val)
     elif interval_type == "h":
         return now - timedelta(hours=interval_val)
     elif interval_type == "d":
-        return now - timedelta(days=interval_val)
\ No newline at end of file
+        return now - timedelta(days=interval_val)
+
+def get_start_offset(task_id, interval, max_offset):
+    # a task always starts the same number of seconds into its interval, up to max_offset,
+    # so the tasks sharing an interval do not all query the source at the same time
+    limit = min(max_offset, int(interval.total_seconds()) - 1)
+    if limit <= 0:
+        return timedelta(0)
+    digest = hashlib.sha256(task_id.encode("utf-8")).digest()
+    return timedelta(seconds=int.from_bytes(digest[:8], "big") % (limit + 1))
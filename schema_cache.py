@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+def schema_hash(fields, tags, tag_values=None):
+    contents = json.dumps({"fields": fields, "tags": tags, "tag_values": tag_values}, sort_keys=True)
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+
+class SchemaCache:
+    """
+    Caches the fields and tags of measurements, keyed by host, database and measurement.
+    Entries are kept in memory and, if a directory is given, persisted there as JSON files so
+    they survive a restart. Entries older than ttl seconds are stale and should be refreshed,
+    a ttl of None keeps them fresh forever.
+    """
+
+    def __init__(self, directory=None, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, host, db, measurement, include_tags=None):
+        # INCLUDE_TAGS changes the tags, so it is part of the key as well
+        return hashlib.sha256(json.dumps([host, db, measurement, include_tags]).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None or self.directory is None:
+            return entry
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except Exception as e:
+            logger.error(f"Ignoring unreadable schema cache file {path}: {str(e)}")
+            return None
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def put(self, key, fields, tags):
+        entry = {"fields": fields,
+                 "tags": tags,
+                 "fetched_at": time.time(),
+                 "hash": schema_hash(fields, tags)}
+        with self._lock:
+            self._entries[key] = entry
+
+        if self.directory is not None:
+            # replace the file atomically so a reader never sees a partial entry
+            path = self._path(key)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        return entry
+
+    def is_fresh(self, entry):
+        if self.ttl is None:
+            return True
+        return time.time() - entry["fetched_at"] < self.ttl
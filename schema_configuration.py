@@ -2,9 +2,11 @@ import os
 import json
 import logging
 
+from tag_predicates import TagFilter, MATCH_MODES
+
 logger = logging.getLogger()
 
-def populate_fields(client, measurement):
+def populate_fields(client, measurement, database=None):
   
     if client is None or measurement == "":
         logger.critical("Source InfluxDB instane not defined. Existing ...")
@@ -12,15 +14,15 @@ def populate_fields(client, measurement):
     else:
         query = f'SHOW FIELD KEYS FROM "{measurement}"'
         logger.debug(f"Fetching fields from database with query:\n{query}")
-        fields_table = client.query(query, language="influxql")
+        fields_table = client.query(query, language="influxql", database=database)
         fields = dict(zip([f.as_py() for f in fields_table["fieldKey"]], 
                             [f.as_py() for f in fields_table["fieldType"]]))
         return fields
     
 
-def populate_tag_values():
-    json_str = os.getenv("INCLUDE_TAG_VALUES")
-    logger.debug(f"INCLUDE_TAG_VALUES envar set to: {json_str}")
+def parse_tag_values(getenv, key):
+    json_str = getenv(key)
+    logger.debug(f"{key} envar set to: {json_str}")
 
     try:
         if json_str is not None:
@@ -28,15 +30,27 @@ def populate_tag_values():
         else:
             return None
     except Exception as e:
-        logger.critical(f"Failed to parse INCLUDE_TAG_VALUES: {str(e)}")
+        logger.critical(f"Failed to parse {key}: {str(e)}")
+        exit(1)
+
+def populate_tag_values(getenv=os.getenv):
+    include = parse_tag_values(getenv, "INCLUDE_TAG_VALUES")
+    exclude = parse_tag_values(getenv, "EXCLUDE_TAG_VALUES")
+    match = getenv("TAG_VALUES_MATCH", "exact").lower()
+    if match not in MATCH_MODES:
+        logger.critical(f"TAG_VALUES_MATCH must be one of {', '.join(MATCH_MODES)}, got {match}")
         exit(1)
 
-def populate_tags(client, measurement):  
+    if include is None and exclude is None:
+        return None
+    return TagFilter(include or {}, exclude or {}, match)
+
+def populate_tags(client, measurement, database=None, getenv=os.getenv):
     if client is None or measurement == "":
         logger.critical("Source InfluxDB instance not defined. Existing ...")
         exit(1)
     
-    include_tags = os.getenv('INCLUDE_TAGS')
+    include_tags = getenv('INCLUDE_TAGS')
     logger.debug(f"INCLUDE_TAGS set to: {include_tags}")
     if include_tags is not None:
         try: 
@@ -54,7 +68,7 @@ def populate_tags(client, measurement):
     else:
         query = f'SHOW TAG KEYS FROM "{measurement}"'
         logger.debug(f"No tag list set by user, retrieving from InfluxDB with query: {query}")
-        tags_table = client.query(query, language="influxql")
+        tags_table = client.query(query, language="influxql", database=database)
         tags = tags_table["tagKey"]
         tags_list = tags.to_pylist()
         logger.debug(f"Retrieved tag list from {measurement}:\n{tags_list}")
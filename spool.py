@@ -0,0 +1,144 @@
+import os
+import re
+import time
+import logging
+import threading
+
+import pyarrow as pa
+
+from line_protocol import to_payload, split_lines
+from write_batcher import gzip_payload
+
+logger = logging.getLogger()
+
+SPOOL_SUFFIX = ".arrow"
+
+
+class WriteSpool:
+    """
+    Keeps the line protocol of write batches that used up their retries in Arrow IPC files,
+    one file per batch, and writes them to the target from a background thread once it
+    accepts writes again. The files are memory mapped when they are replayed. The spool
+    holds at most max_bytes, the oldest files are evicted to make room for new ones.
+    """
+
+    def __init__(self, directory, max_bytes, drain_interval=30.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.drain_interval = drain_interval
+        self.spooled_rows = 0
+        self.replayed_rows = 0
+        self.evicted_files = 0
+
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._thread = None
+
+    def register(self, task):
+        # the drainer writes each file with the client and settings of the task that spooled it
+        with self._lock:
+            self._tasks[task.task_id] = task
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def files(self):
+        # oldest first, the names start with the time they were spooled
+        names = [name for name in os.listdir(self.directory) if name.endswith(SPOOL_SUFFIX)]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def size(self):
+        total = 0
+        for path in self.files():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _evict(self, needed):
+        files = self.files()
+        total = sum(os.path.getsize(path) for path in files)
+        while files and total + needed > self.max_bytes:
+            path = files.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self.evicted_files += 1
+            logger.warning(f"Write spool is full, evicted {os.path.basename(path)}")
+        return total + needed <= self.max_bytes
+
+    def spill(self, task, lines):
+        # returns False if the batch does not fit in the spool even when it is empty
+        table = pa.table({"line": lines})
+        table = table.replace_schema_metadata({"task_id": task.task_id, "database": task.target_db or ""})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        buffer = sink.getvalue()
+
+        with self._lock:
+            if not self._evict(buffer.size):
+                logger.error(f"Write batch of {buffer.size} bytes is larger than the write spool")
+                return False
+            task_name = re.sub(r'[^A-Za-z0-9_-]', '_', task.task_id)
+            path = os.path.join(self.directory, f"{time.time_ns():020d}-{task_name}{SPOOL_SUFFIX}")
+            # written aside first, so the drainer never reads a partial file
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(buffer)
+            os.replace(f"{path}.tmp", path)
+            self.spooled_rows += len(lines)
+        return True
+
+    def _replay_file(self, path):
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            metadata = {k.decode(): v.decode() for k, v in (table.schema.metadata or {}).items()}
+            with self._lock:
+                task = self._tasks.get(metadata.get("task_id"))
+            if task is None:
+                # left for a process that runs the task, or for eviction
+                return False
+
+            content_encoding = None if task.write_gzip_level is None else "gzip"
+            kwargs = {} if content_encoding is None else {"content_encoding": content_encoding}
+            lines = table.column("line").combine_chunks()
+            for piece in split_lines(lines, task.write_batch_bytes):
+                payload = to_payload(piece)
+                if content_encoding is not None:
+                    payload = gzip_payload(payload, task.write_gzip_level)
+                task.target_client.write(record=payload, database=metadata["database"] or task.target_db, **kwargs)
+        os.remove(path)
+        with self._lock:
+            self.replayed_rows += len(lines)
+        return True
+
+    def drain(self):
+        # writes the spooled files oldest first, stops at the first failure as the target is still down
+        with self._drain_lock:
+            replayed = 0
+            for path in self.files():
+                try:
+                    if self._replay_file(path):
+                        replayed += 1
+                except FileNotFoundError:
+                    # evicted while draining
+                    continue
+                except Exception as e:
+                    logger.error(f"Replaying the write spool failed with exception {str(e)}")
+                    break
+            if replayed > 0:
+                logger.info(f"Replayed {replayed} spooled write batches")
+            return replayed
+
+    def _run(self):
+        while not self._stopped.wait(self.drain_interval):
+            self.drain()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
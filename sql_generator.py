@@ -0,0 +1,116 @@
+from influxql_generator import get_aggregations, fill_query_template, THEN_PLACEHOLDER, NOW_PLACEHOLDER
+from tag_predicates import generate_sql_tag_predicates, quote_identifier, quote_literal
+
+# InfluxQL aggregates and the SQL expression computing the same value for a column
+SQL_AGGREGATES = {
+    'count': 'count({column})',
+    'mean': 'avg({column})',
+    # InfluxQL returns a float median for integer fields too
+    'median': 'median(CAST({column} AS DOUBLE))',
+    'stddev': 'stddev({column})',
+    'sum': 'sum({column})',
+    'min': 'min({column})',
+    'max': 'max({column})',
+    'first': "selector_first({column}, time)['value']",
+    'last': "selector_last({column}, time)['value']",
+}
+
+INTERVAL_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+def generate_date_bin(interval):
+    # the same epoch aligned buckets as GROUP BY time(interval)
+    value, unit = interval[:-1], interval[-1]
+    return f"date_bin(INTERVAL '{value} {INTERVAL_UNITS[unit]}', time, TIMESTAMP '1970-01-01T00:00:00Z')"
+
+def generate_sql_tag_filter_clause(tag_values):
+    # equality and IN predicates can be pushed down, unlike regular expressions
+    return generate_sql_tag_predicates(tag_values)
+
+def generate_sql_aggregates(fields_dict, aggregate="mean"):
+    columns = []
+    for field_name, field_aggregate, alias in get_aggregations(fields_dict, aggregate):
+        expression = SQL_AGGREGATES[field_aggregate.lower()].format(column=quote_identifier(field_name))
+        columns.append(f'{expression} AS {quote_identifier(alias)}')
+    return columns
+
+def get_sql_query_template(fields_dict, measurement, tags_list, interval, aggregate, tag_values):
+    """
+    Generates a SQL query returning the same columns as the InfluxQL query of get_query_template:
+    iox::measurement, time, the tags and one column per aggregation.
+    """
+    tag_columns = [quote_identifier(tag) for tag in tags_list]
+    aggregations = get_aggregations(fields_dict, aggregate)
+    tag_filter = generate_sql_tag_filter_clause(tag_values)
+
+    if len(aggregations) == 1 and aggregations[0][1].lower() == 'distinct':
+        # a row per distinct value in each bucket, like InfluxQL's distinct()
+        field_name, _, alias = aggregations[0]
+        columns = [f"{quote_literal(measurement)} AS \"iox::measurement\"",
+                   f'{generate_date_bin(interval)} AS time'] + tag_columns
+        columns.append(f'{quote_identifier(field_name)} AS {quote_identifier(alias)}')
+        columns_clause = ',\n    '.join(columns)
+        return f"""
+SELECT DISTINCT
+    {columns_clause}
+FROM
+    {quote_identifier(measurement)}
+WHERE
+    time > '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+AND
+    {quote_identifier(field_name)} IS NOT NULL
+{tag_filter}
+    """
+
+    columns = [f"{quote_literal(measurement)} AS \"iox::measurement\"",
+               f'{generate_date_bin(interval)} AS time'] + tag_columns
+    columns += generate_sql_aggregates(fields_dict, aggregate)
+    columns_clause = ',\n    '.join(columns)
+    # the bucket is the second column, the measurement name is a constant
+    group_by_clause = ', '.join(['2'] + tag_columns)
+
+    query = f"""
+SELECT
+    {columns_clause}
+FROM
+    {quote_identifier(measurement)}
+WHERE
+    time > '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+{tag_filter}
+GROUP BY
+    {group_by_clause}
+    """
+
+    return query
+
+def get_sql_query(fields_dict, measurement, then, now, tags_list, interval, aggregate, tag_values):
+    template = get_sql_query_template(fields_dict, measurement, tags_list, interval, aggregate, tag_values)
+    return fill_query_template(template, then, now)
+
+def get_sql_raw_query_template(fields_dict, measurement, tags_list, aggregate, tag_values):
+    # selects the rows that get_sql_query would aggregate, for aggregating them locally
+    field_names = []
+    for field_name, _, _ in get_aggregations(fields_dict, aggregate):
+        if field_name not in field_names:
+            field_names.append(field_name)
+    columns = ['time'] + [quote_identifier(tag) for tag in tags_list]
+    columns += [quote_identifier(field_name) for field_name in field_names]
+    columns_clause = ',\n    '.join(columns)
+    tag_filter = generate_sql_tag_filter_clause(tag_values)
+
+    query = f"""
+SELECT
+    {columns_clause}
+FROM
+    {quote_identifier(measurement)}
+WHERE
+    time > '{THEN_PLACEHOLDER}'
+AND
+    time < '{NOW_PLACEHOLDER}'
+{tag_filter}
+    """
+
+    return query
@@ -0,0 +1,102 @@
+import queue
+import threading
+from datetime import datetime
+
+
+def split_window(then, now, interval, intervals_per_subwindow):
+    """
+    Splits then..now into sub-windows of intervals_per_subwindow GROUP BY intervals.
+    Boundaries fall on GROUP BY time() bucket boundaries, which are aligned to the unix epoch,
+    so no bucket is divided between two queries. Returns a list of (then, now) tuples.
+    """
+    step = interval * max(1, intervals_per_subwindow)
+    epoch = datetime(1970, 1, 1, tzinfo=then.tzinfo)
+    bucket_start = then - ((then - epoch) % interval)
+
+    subwindows = []
+    start = then
+    boundary = bucket_start + step
+    while boundary < now:
+        subwindows.append((start, boundary))
+        start = boundary
+        boundary += step
+    subwindows.append((start, now))
+    return subwindows
+
+
+def intervals_per_subwindow(window_intervals, subwindow_intervals=None, row_budget=None, rows_per_interval=None):
+    # the row budget takes precedence once a previous run has measured the rows per interval
+    if row_budget is not None and rows_per_interval:
+        return max(1, int(row_budget // rows_per_interval))
+    if subwindow_intervals is not None:
+        return subwindow_intervals
+    return window_intervals
+
+
+class SubwindowQueryError(Exception):
+    """Raised by ConcurrentChunkReader when the query of a sub-window fails."""
+
+
+class ConcurrentChunkReader:
+    """
+    Runs the queries of several sub-windows, at most max_concurrency at a time, and
+    interleaves their chunks behind the read_chunk() interface of a single Flight stream.
+    Each query is a callable returning (success, reader) like get_down_sampled_data. The
+    chunk queue is bounded, so a slow consumer pauses the queries instead of buffering them.
+    """
+
+    _DONE = object()
+
+    def __init__(self, queries, max_concurrency=1, queue_size=4):
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._remaining = len(queries)
+        self._closed = threading.Event()
+        self._slots = threading.Semaphore(max_concurrency)
+        self._threads = [threading.Thread(target=self._drain, args=(q,), daemon=True) for q in queries]
+        for thread in self._threads:
+            thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _drain(self, query):
+        with self._slots:
+            try:
+                if self._closed.is_set():
+                    return
+                success, reader = query()
+                if not success:
+                    raise SubwindowQueryError(reader)
+                while True:
+                    try:
+                        chunk = reader.read_chunk()
+                    except StopIteration:
+                        break
+                    if not self._put(chunk):
+                        return
+            except Exception as e:
+                self._put(e if isinstance(e, SubwindowQueryError) else SubwindowQueryError(str(e)))
+            finally:
+                self._put(self._DONE)
+
+    def read_chunk(self):
+        while self._remaining > 0:
+            item = self._chunks.get()
+            if item is self._DONE:
+                self._remaining -= 1
+                continue
+            if isinstance(item, Exception):
+                # stop the other sub-windows, their results would be incomplete
+                self.close()
+                raise item
+            return item
+        raise StopIteration
+
+    def close(self):
+        self._closed.set()
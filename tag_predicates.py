@@ -0,0 +1,98 @@
+from collections import namedtuple
+
+# tag values to include and to exclude, as dicts of tag key to a list of values, and how
+# the values are matched: "exact" compares them as literals, "regex" as regular expressions
+# that have to match the whole tag value
+TagFilter = namedtuple("TagFilter", ["include", "exclude", "match"])
+
+MATCH_MODES = ["exact", "regex"]
+
+
+def as_tag_filter(tag_values):
+    # a plain dict is the INCLUDE_TAG_VALUES form, its values are matched exactly
+    if tag_values is None or isinstance(tag_values, TagFilter):
+        return tag_values
+    return TagFilter(tag_values, {}, "exact")
+
+
+def influxql_identifier(name):
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def influxql_literal(value):
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def anchored_regex(values):
+    # the values are the user's patterns, only the delimiter is escaped so they stay inside the literal
+    patterns = "|".join(str(value).replace('/', '\\/') for value in values)
+    return f'^(?:{patterns})$'
+
+
+def generate_influxql_tag_predicates(tag_values):
+    tag_filter = as_tag_filter(tag_values)
+    if tag_filter is None:
+        return ""
+
+    influxql = ""
+    for key, values in (tag_filter.include or {}).items():
+        if not values:
+            continue
+        identifier = influxql_identifier(key)
+        if tag_filter.match == "regex":
+            influxql += f'AND\n\t{identifier} =~ /{anchored_regex(values)}/\n'
+        elif len(values) == 1:
+            influxql += f'AND\n\t{identifier} = {influxql_literal(values[0])}\n'
+        else:
+            predicates = " OR ".join(f'{identifier} = {influxql_literal(value)}' for value in values)
+            influxql += f'AND\n\t({predicates})\n'
+
+    for key, values in (tag_filter.exclude or {}).items():
+        if not values:
+            continue
+        identifier = influxql_identifier(key)
+        if tag_filter.match == "regex":
+            influxql += f'AND\n\t{identifier} !~ /{anchored_regex(values)}/\n'
+        else:
+            for value in values:
+                influxql += f'AND\n\t{identifier} != {influxql_literal(value)}\n'
+    return influxql
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def generate_sql_tag_predicates(tag_values):
+    tag_filter = as_tag_filter(tag_values)
+    if tag_filter is None:
+        return ""
+
+    sql = ""
+    for key, values in (tag_filter.include or {}).items():
+        if not values:
+            continue
+        identifier = quote_identifier(key)
+        if tag_filter.match == "regex":
+            sql += f'AND\n\t{identifier} ~ {quote_literal(anchored_regex(values))}\n'
+        elif len(values) == 1:
+            sql += f'AND\n\t{identifier} = {quote_literal(values[0])}\n'
+        else:
+            joined_values = ", ".join(quote_literal(value) for value in values)
+            sql += f'AND\n\t{identifier} IN ({joined_values})\n'
+
+    for key, values in (tag_filter.exclude or {}).items():
+        if not values:
+            continue
+        identifier = quote_identifier(key)
+        # rows without the tag are kept, as they are by InfluxQL
+        if tag_filter.match == "regex":
+            sql += f'AND\n\t({identifier} IS NULL OR {identifier} !~ {quote_literal(anchored_regex(values))})\n'
+        else:
+            joined_values = ", ".join(quote_literal(value) for value in values)
+            sql += f'AND\n\t({identifier} IS NULL OR {identifier} NOT IN ({joined_values}))\n'
+    return sql
@@ -0,0 +1,137 @@
+import os
+import json
+import threading
+from datetime import timedelta
+
+# clients are shared by every task using the same host and credentials,
+# the database is passed on each query and write instead
+clients = {}
+clients_lock = threading.Lock()
+
+
+class Task:
+    """
+    The configuration, clients and cached schema of one downsampling task.
+    Settings are looked up in the task's own settings first, so a task defined
+    in a tasks file can override any of the environment variables.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+        self.lock = threading.Lock()
+
+        self.task_id = ""
+        self.source_host = ""
+        self.source_db = None
+        self.target_db = None
+        self.log_host = None
+        self.log_db = None
+        self.source_client = None
+        self.target_client = None
+        self.logging_client = None
+        self.telemetry = None
+        self.source_measurement = ""
+        self.target_measurement = ""
+
+        self.interval = ""
+        self.interval_val = None
+        self.interval_type = None
+        self.aggregate = "mean"
+        self.aggregation_engine = "server"
+        self.query_language = "influxql"
+        self.cascade_tiers = []
+        self.cascade_client = None
+
+        self.fields = None
+        self.tags = None
+        self.tag_values = None
+        self.ignore_schema_cache = False
+        self.schema_cache = None
+        self.schema_hash = None
+        self.schema_refreshing = False
+        self.schema_cache_hits = 0
+        self.schema_cache_misses = 0
+        self.schema_refresh_time = 0.0
+        self.query_template = None
+        self.query_template_key = None
+
+        self.max_write_retries = 5
+        self.write_workers = 4
+        self.write_limiter = None
+        self.write_spool = None
+        self.written_hashes = None
+        self.diagnostics_sample_rate = 0
+        self.profile_sample_rate = 0
+        self.profile_dir = None
+        self.write_queue_size = 4
+        self.write_batch_rows = 10000
+        self.write_batch_bytes = 5000000
+        self.write_gzip_level = None
+        self.bytes_per_row = None
+
+        self.subwindow_intervals = None
+        self.subwindow_row_budget = None
+        self.subwindow_concurrency = 1
+        self.rows_per_interval = None
+
+        self.checkpoint_store = None
+        self.schedule_start = None
+        self.schedule_interval = None
+        self.last_window_end = None
+        self.max_coalesced_windows = 60
+        self.start_offset = timedelta(0)
+        self.fleet = None
+        self.late_data_windows = 0
+
+    def getenv(self, key, default=None):
+        value = self.settings.get(key)
+        if value is None:
+            return os.getenv(key, default)
+        if isinstance(value, (dict, list)):
+            # structured settings such as INCLUDE_TAG_VALUES are passed on as JSON
+            return json.dumps(value)
+        if isinstance(value, bool):
+            return str(value).lower()
+        return str(value)
+
+
+def get_client(host, database, token, org, writer=False):
+    # the client requires a default database, the first task's database is used
+    # but every call made through a shared client passes its own database
+    key = (host, token, org, writer)
+    # imported with the first client, after the settings are checked
+    from influxdb_client_3 import InfluxDBClient3, SYNCHRONOUS, write_client_options
+    with clients_lock:
+        if key not in clients:
+            if writer:
+                wco = write_client_options(write_options=SYNCHRONOUS)
+                clients[key] = InfluxDBClient3(
+                    host=host, database=database, token=token, org=org, write_client_options=wco)
+            else:
+                clients[key] = InfluxDBClient3(
+                    host=host, database=database, token=token, org=org)
+        return clients[key]
+
+
+def load_task_settings(path):
+    """
+    Reads a JSON or YAML tasks file. It is either a list of task settings, or an object with
+    a "tasks" list and optional "defaults" that apply to every task. Returns a list of dicts.
+    """
+    with open(path, "r") as f:
+        contents = f.read()
+
+    if path.endswith((".yaml", ".yml")):
+        # YAML support is optional, JSON needs no extra dependency
+        import yaml
+        config = yaml.safe_load(contents)
+    else:
+        config = json.loads(contents)
+
+    if isinstance(config, list):
+        config = {"tasks": config}
+    if not isinstance(config, dict) or not isinstance(config.get("tasks"), list):
+        raise ValueError("tasks file must contain a list of tasks")
+
+    defaults = config.get("defaults", {})
+    return [{**defaults, **task_settings} for task_settings in config["tasks"]]
@@ -0,0 +1,141 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger()
+
+
+class TelemetryFlusher:
+    """
+    Buffers task log lines and writes them from a background thread, batched across runs
+    and tasks, so a slow logging instance never delays a run. The buffer holds at most
+    max_lines lines. When it is full, lines are appended to a file in spill_dir and sent
+    once the destination accepts writes again, or dropped if there is no spill_dir. The
+    thread is started with the first line, tasks without a logging instance never start it.
+    """
+
+    def __init__(self, flush_interval=5.0, max_lines=10000, batch_size=1000, spill_dir=None):
+        self.flush_interval = flush_interval
+        self.max_lines = max_lines
+        self.batch_size = batch_size
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        self.spilled = 0
+
+        self._lines = deque()
+        self._destinations = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._thread = None
+
+    def submit(self, destination, client, database, line):
+        # destination identifies the logging instance and database, it names the spill file
+        with self._lock:
+            if self._thread is None and not self._stopped.is_set():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._destinations[destination] = (client, database)
+            if len(self._lines) >= self.max_lines:
+                self._overflow(destination, [line])
+                return
+            self._lines.append((destination, line))
+            if len(self._lines) >= self.batch_size:
+                self._wake.set()
+
+    def _spill_path(self, destination):
+        name = hashlib.sha256(json.dumps(destination).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.spill_dir, f"{name}.lp")
+
+    def _overflow(self, destination, lines):
+        if self.spill_dir is None:
+            self.dropped += len(lines)
+            logger.warning(f"Telemetry buffer full, dropped {len(lines)} task log lines")
+            return
+        try:
+            with open(self._spill_path(destination), "a") as f:
+                f.write("".join(f"{line}\n" for line in lines))
+            self.spilled += len(lines)
+        except Exception as e:
+            self.dropped += len(lines)
+            logger.error(f"Spilling task log lines failed with exception {str(e)}")
+
+    def _write(self, destination, lines):
+        client, database = self._destinations[destination]
+        for start in range(0, len(lines), self.batch_size):
+            payload = "\n".join(lines[start:start + self.batch_size]).encode("utf-8")
+            client.write(record=payload, database=database)
+
+    def _replay_spill(self, destination):
+        path = self._spill_path(destination)
+        if not os.path.exists(path):
+            return
+        # move the file aside first, lines spilled while replaying go to a new file
+        replay_path = f"{path}.replay"
+        os.replace(path, replay_path)
+        with open(replay_path, "r") as f:
+            lines = [line for line in f.read().splitlines() if line]
+        try:
+            self._write(destination, lines)
+        except Exception:
+            with self._lock:
+                self._overflow(destination, lines)
+            raise
+        finally:
+            os.remove(replay_path)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._lines)
+                self._lines.clear()
+                destinations = list(self._destinations)
+
+            by_destination = {}
+            for destination, line in pending:
+                by_destination.setdefault(destination, []).append(line)
+
+            for destination in destinations:
+                lines = by_destination.get(destination, [])
+                try:
+                    if self.spill_dir is not None:
+                        self._replay_spill(destination)
+                    if lines:
+                        self._write(destination, lines)
+                except Exception as e:
+                    logger.error(f"Logging failed with exception {str(e)}")
+                    # keep the lines for the next flush, as far as the buffer allows
+                    with self._lock:
+                        room = max(0, self.max_lines - len(self._lines))
+                        self._lines.extendleft((destination, line) for line in reversed(lines[:room]))
+                        if len(lines) > room:
+                            self._overflow(destination, lines[room:])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self, timeout=10.0):
+        # flushes what is buffered, called on shutdown
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+        with self._lock:
+            if self.spill_dir is not None:
+                # lines the logging instance did not accept are sent after a restart
+                for destination, line in list(self._lines):
+                    self._overflow(destination, [line])
+                self._lines.clear()
+            elif self._lines:
+                logger.error(f"Dropped {len(self._lines)} task log lines on shutdown")
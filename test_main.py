@@ -1,10 +1,39 @@
 import unittest
 from unittest.mock import MagicMock, Mock, patch
-from main import parse_interval, write_downsampled_data
-from influxql_generator import field_is_num, generate_fields_string, generate_group_by_string
-from schedule_calculator import get_next_run_time_minutes, get_next_run_time_hours, get_next_run_time, get_then
-from datetime import datetime
+from main import write_batch, run, run_cascade, run_with_late_data, run_scheduled, schedule_and_run, get_scheduled_time, get_scheduled_window, parse_interval, write_downsampled_data, parse_aggregates, setup_tags_and_fields, get_query_for_window
+from schema_cache import SchemaCache, schema_hash
+from checkpoint_store import CheckpointStore, SQLiteCheckpointStore
+from lease_store import SQLiteLeaseStore
+from fleet import Fleet, rendezvous_owner
+from telemetry import TelemetryFlusher
+from spool import WriteSpool
+from metrics import MetricsRegistry, start_metrics_server
+from write_limiter import WriteLimiter, retry_after_seconds, is_overloaded
+from write_dedup import WrittenHashes, row_hashes
+import urllib.request
+from task import Task, load_task_settings
+from sql_generator import get_sql_query
+from cascade import state_aggregations, merge_aggregations, get_cascade_query_template, MeanReader
+from tag_predicates import TagFilter, generate_influxql_tag_predicates, generate_sql_tag_predicates
+from schema_configuration import populate_tag_values
+from influxql_generator import field_is_num, generate_fields_string, generate_group_by_string, get_raw_query
+from local_aggregation import aggregate_table
+from schedule_calculator import get_next_run_time_minutes, get_next_run_time_hours, get_next_run_time, get_then, get_start_offset
+from line_protocol import encode_record_batch, to_payload, split_lines
+from subwindows import split_window, intervals_per_subwindow, ConcurrentChunkReader, SubwindowQueryError
+from backfill_runner import get_backfill_windows, group_windows, run_windows, read_watermark, skip_completed_windows
+from datetime import datetime, timedelta, timezone
+import os
+import json
+import time
+import tempfile
+import gzip
+import sys
+import subprocess
 import traceback
+import statistics
+import pstats
+import pyarrow as pa
 
 class SQLGeneration(unittest.TestCase):
     def test_field_is_num(self):
@@ -29,6 +58,38 @@ class SQLGeneration(unittest.TestCase):
         expected_result = ''
         self.assertEqual(generate_fields_string(fields), expected_result)
 
+    def test_generate_fields_string_multiple_aggregates(self):
+        fields = {'req_bytes': 'integer', 'status': 'string'}
+
+        expected_result = ('\tmean("req_bytes") as "req_bytes_mean",\n'
+                           '\tcount("req_bytes") as "req_bytes_count",\n'
+                           '\tcount("status") as "status_count"')
+        self.assertEqual(generate_fields_string(fields, parse_aggregates("mean,count")), expected_result)
+
+        with self.assertRaises(ValueError):
+            parse_aggregates('{"usage": [1]}')
+
+        spec = parse_aggregates('{"req_bytes": ["max"], "status": ["last", "mean"]}')
+        expected_result = '\tmax("req_bytes") as "req_bytes_max",\n\tlast("status") as "status_last"'
+        self.assertEqual(generate_fields_string(fields, spec), expected_result)
+
+    def test_sql_query(self):
+        fields = {'usage': 'float', 'state': 'string'}
+        query = get_sql_query(fields, 'cpu', datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 1),
+                              ['host'], '1m', parse_aggregates('mean,last'), {'host': ['a', "b'c"]})
+
+        self.assertIn("date_bin(INTERVAL '1 minutes', time, TIMESTAMP '1970-01-01T00:00:00Z') AS time", query)
+        self.assertIn('avg("usage") AS "usage_mean"', query)
+        median = get_sql_query({'requests': 'integer'}, 'cpu', datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 1),
+                               [], '1m', 'median', None)
+        self.assertIn('median(CAST("requests" AS DOUBLE)) AS "requests"', median)
+        self.assertIn('selector_last("state", time)[\'value\'] AS "state_last"', query)
+        # exact tag predicates instead of regular expressions
+        self.assertIn('"host" IN (\'a\', \'b\'\'c\')', query)
+        self.assertNotIn('=~', query)
+        self.assertIn("time > '2023-07-07 12:00:00'", query)
+        self.assertIn('GROUP BY\n    2, "host"', query)
+
     def test_generate_group_by_clause(self):
         tags = ['tag1', 'tag2', 'tag3']
         interval = '5m'
@@ -39,6 +100,35 @@ class SQLGeneration(unittest.TestCase):
         expected_result = 'time(5m)'
         self.assertEqual(generate_group_by_string(tags, interval), expected_result)
 
+class TestTagPredicates(unittest.TestCase):
+    def test_exact_values(self):
+        influxql = generate_influxql_tag_predicates({"host": ["a.b"], "region": ["us", "eu's"]})
+        self.assertEqual(influxql, 'AND\n\t"host" = \'a.b\'\n'
+                                   'AND\n\t("region" = \'us\' OR "region" = \'eu\\\'s\')\n')
+
+        sql = generate_sql_tag_predicates(TagFilter({"host": ["a.b"]}, {"region": ["us", "eu"]}, "exact"))
+        self.assertEqual(sql, 'AND\n\t"host" = \'a.b\'\n'
+                              'AND\n\t("region" IS NULL OR "region" NOT IN (\'us\', \'eu\'))\n')
+
+    def test_exclusions(self):
+        influxql = generate_influxql_tag_predicates(TagFilter({}, {"host": ["a", "b"]}, "exact"))
+        self.assertEqual(influxql, 'AND\n\t"host" != \'a\'\nAND\n\t"host" != \'b\'\n')
+
+    def test_regex_values(self):
+        tag_filter = TagFilter({"host": ["web-.*", "a/b"]}, {"region": ["test.*"]}, "regex")
+        self.assertEqual(generate_influxql_tag_predicates(tag_filter),
+                         'AND\n\t"host" =~ /^(?:web-.*|a\\/b)$/\n'
+                         'AND\n\t"region" !~ /^(?:test.*)$/\n')
+
+    def test_populate_tag_values(self):
+        settings = {"INCLUDE_TAG_VALUES": '{"host": ["a"]}', "EXCLUDE_TAG_VALUES": '{"region": ["b"]}'}
+        self.assertEqual(populate_tag_values(settings.get), TagFilter({"host": ["a"]}, {"region": ["b"]}, "exact"))
+        self.assertIsNone(populate_tag_values({}.get))
+
+        settings["TAG_VALUES_MATCH"] = "glob"
+        with self.assertRaises(SystemExit):
+            populate_tag_values(settings.get)
+
 class TestParseInterval(unittest.TestCase):
     def test_positive_case(self):
         self.assertEqual(parse_interval('10m'), (10, 'm'))
@@ -55,6 +145,100 @@ class TestParseInterval(unittest.TestCase):
         with self.assertRaises(ValueError):
             parse_interval('0m')
 
+class TestTasks(unittest.TestCase):
+    def test_task_settings_override_environment(self):
+        task = Task({"SOURCE_MEASUREMENT": "cpu", "INCLUDE_TAG_VALUES": {"host": ["a"]}, "NO_SCHEMA_CACHE": True})
+        with patch.dict(os.environ, {"SOURCE_MEASUREMENT": "mem", "SOURCE_DB": "metrics"}):
+            self.assertEqual(task.getenv("SOURCE_MEASUREMENT"), "cpu")
+            self.assertEqual(task.getenv("SOURCE_DB"), "metrics")
+            self.assertEqual(task.getenv("INCLUDE_TAG_VALUES"), '{"host": ["a"]}')
+            self.assertEqual(task.getenv("NO_SCHEMA_CACHE"), "true")
+            self.assertEqual(task.getenv("TARGET_DB", "default"), "default")
+
+    def test_load_task_settings(self):
+        config = {"defaults": {"SOURCE_DB": "metrics", "RUN_INTERVAL": "1m"},
+                  "tasks": [{"TASK_ID": "cpu", "SOURCE_MEASUREMENT": "cpu"},
+                            {"TASK_ID": "mem", "SOURCE_MEASUREMENT": "mem", "RUN_INTERVAL": "1h"}]}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tasks.json")
+            with open(path, "w") as f:
+                json.dump(config, f)
+            settings = load_task_settings(path)
+
+        self.assertEqual(settings, [
+            {"SOURCE_DB": "metrics", "RUN_INTERVAL": "1m", "TASK_ID": "cpu", "SOURCE_MEASUREMENT": "cpu"},
+            {"SOURCE_DB": "metrics", "RUN_INTERVAL": "1h", "TASK_ID": "mem", "SOURCE_MEASUREMENT": "mem"}])
+
+class TestSchemaCache(unittest.TestCase):
+    def make_task(self, cache):
+        task = Task({"INCLUDE_TAGS": "host"})
+        task.source_client = Mock()
+        task.source_client.query.return_value = pa.table({"fieldKey": ["usage"], "fieldType": ["float"]})
+        task.source_host = "host"
+        task.source_db = "db"
+        task.source_measurement = "cpu"
+        task.interval = "1m"
+        task.schema_cache = cache
+        return task
+
+    def test_persisted_across_restarts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            task = self.make_task(SchemaCache(tmp, ttl=3600))
+            setup_tags_and_fields(task)
+            self.assertEqual((task.schema_cache_hits, task.schema_cache_misses), (0, 1))
+
+            # a new cache instance reads the entry written to disk by the first one
+            restarted = self.make_task(SchemaCache(tmp, ttl=3600))
+            setup_tags_and_fields(restarted)
+            self.assertEqual((restarted.schema_cache_hits, restarted.schema_cache_misses), (1, 0))
+            restarted.source_client.query.assert_not_called()
+            self.assertEqual(restarted.fields, {"usage": "float"})
+            self.assertEqual(restarted.tags, ["host"])
+
+    def test_stale_entry_is_refreshed(self):
+        cache = SchemaCache(ttl=60)
+        key = cache.key("host", "db", "cpu")
+        entry = cache.put(key, {"usage": "float"}, ["host"])
+        self.assertTrue(cache.is_fresh(entry))
+        entry["fetched_at"] -= 120
+        self.assertFalse(cache.is_fresh(entry))
+
+    @patch('main.logger')
+    def test_background_refresh_only_updates_cache(self, mock_logger):
+        cache = SchemaCache(ttl=60)
+        task = self.make_task(cache)
+        key = cache.key("host", "db", "cpu", "host")
+        cache.put(key, {"usage": "float"}, ["host"])["fetched_at"] -= 120
+        task.source_client.query.return_value = pa.table({"fieldKey": ["usage", "idle"],
+                                                          "fieldType": ["float", "float"]})
+
+        with patch('main.threading.Thread') as mock_thread:
+            setup_tags_and_fields(task)
+            refresh = mock_thread.call_args.kwargs["target"]
+        # a run in progress keeps the schema it started with
+        refresh()
+        self.assertEqual(task.fields, {"usage": "float"})
+        self.assertEqual(cache.get(key)["fields"], {"usage": "float", "idle": "float"})
+
+        setup_tags_and_fields(task)
+        self.assertEqual(task.fields, {"usage": "float", "idle": "float"})
+
+    @patch('main.logger')
+    def test_query_template_rebuilt_only_on_schema_change(self, mock_logger):
+        task = self.make_task(None)
+        setup_tags_and_fields(task)
+        first = get_query_for_window(task, datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 1))
+        template = task.query_template
+        second = get_query_for_window(task, datetime(2023, 7, 7, 12, 1), datetime(2023, 7, 7, 12, 2))
+        self.assertIs(task.query_template, template)
+        self.assertIn("time > '2023-07-07 12:01:00'", second)
+        self.assertNotEqual(first, second)
+
+        task.fields = {"usage": "float", "idle": "float"}
+        task.schema_hash = schema_hash(task.fields, task.tags)
+        third = get_query_for_window(task, datetime(2023, 7, 7, 12, 1), datetime(2023, 7, 7, 12, 2))
+        self.assertIn('mean("idle")', third)
+
 class TestNowANdThen(unittest.TestCase):
     def test_get_then_boundaries(self):
         test_time = datetime(2023,7,7,12,0)
@@ -137,42 +321,973 @@ class TestWriteData(unittest.TestCase):
         mock_target_client = Mock()
         mock_target_client.write = MagicMock()
 
-        # Create a mock dataframe
-        mock_df = MagicMock()
-        mock_df.columns = []
-        mock_df.shape = (0, 0)
-        mock_df.__getitem__.return_value = False
-        mock_df.drop.return_value = mock_df
-
-        # Create a mock batch
-        mock_batch = Mock()
-        mock_batch.to_pandas.return_value = mock_df
-
-        # Setup the mock batch to return a mock dataframe
-        mock_batch.to_pandas.return_value = mock_df
+        # Create a batch shaped like the InfluxQL results
+        batch = pa.RecordBatch.from_pydict({
+            "iox::measurement": ["cpu"],
+            "time": pa.array([60_000_000_000], pa.timestamp("ns", tz="UTC")),
+            "host": ["a"],
+            "usage": [1.5]})
 
         # Create a mock reader
         mock_reader = Mock()
         mock_reader.read_chunk.side_effect = [
-            # Return a mock batch and buffer on the first call
-            (mock_batch, None),
+            # Return a batch and buffer on the first call
+            (batch, None),
             # Raise StopIteration on the second call to end the loop
             StopIteration()
         ]
 
-        with patch('main.target_client', new=mock_target_client):
-            success, error, row_count, retries = write_downsampled_data(mock_reader)
+        task = Task()
+        task.target_client = mock_target_client
+        task.target_db = "downsampled"
+        task.target_measurement = "cpu_1m"
+        task.tags = ["host"]
+
+        with patch('main.logger'):
+            success, error, row_count, retries = write_downsampled_data(task, mock_reader)
 
         # Verify the result
         assert success
-        assert row_count == 0
+        assert row_count == 1
         assert retries == 0
         assert error is None
 
         # Verify the mocks were called as expected
         mock_reader.read_chunk.assert_called()
-        mock_batch.to_pandas.assert_called()
-        mock_target_client.write.assert_called()
-        
+        mock_target_client.write.assert_called_once_with(record=b"cpu_1m,host=a usage=1.5 60000000000\n",
+                                                         database="downsampled")
+
+    def test_write_failure_stops_pipeline(self):
+        mock_target_client = Mock()
+        mock_target_client.write = MagicMock(side_effect=Exception("target down"))
+
+        batch = pa.RecordBatch.from_pydict({
+            "time": pa.array([0], pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5]})
+        mock_reader = Mock()
+        mock_reader.read_chunk.side_effect = [(batch, None)] * 3 + [StopIteration()]
+
+        task = Task()
+        task.target_client = mock_target_client
+        task.tags = []
+        task.max_write_retries = 1
+        task.write_workers = 2
+
+        stats = {}
+        with patch('main.logger'):
+            success, error, row_count, retries = write_downsampled_data(task, mock_reader, stats)
+
+        assert not success
+        assert error == "target down"
+        assert retries >= 1
+        assert "drain_time" in stats and "write_time" in stats
+
+    def test_failed_batches_are_spooled_and_replayed(self):
+        mock_target_client = Mock()
+        mock_target_client.write = MagicMock(side_effect=Exception("target down"))
+        chunks = [pa.RecordBatch.from_pydict({
+            "time": pa.array([start, start + 1], pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5, 2.5]}) for start in (0, 2)]
+        mock_reader = Mock()
+        mock_reader.read_chunk.side_effect = [(c, None) for c in chunks] + [StopIteration()]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            task = Task()
+            task.task_id = "task"
+            task.target_client = mock_target_client
+            task.target_db = "downsampled"
+            task.target_measurement = "m"
+            task.tags = []
+            task.max_write_retries = 1
+            task.write_workers = 1
+            task.write_batch_rows = 2
+            task.write_limiter = WriteLimiter(1)
+            task.write_spool = WriteSpool(tmp, 10**6)
+            task.write_spool.register(task)
+
+            stats = {}
+            with patch('main.logger'), patch('write_limiter.random.random', return_value=0), \
+                    patch.object(task.write_limiter, "backoff_base", 0):
+                success, error, row_count, retries = write_downsampled_data(task, mock_reader, stats)
+
+            # the target was only tried once, the second batch went straight to the spool
+            assert success
+            self.assertEqual(stats["spooled_rows"], 4)
+            self.assertEqual(mock_target_client.write.call_count, 1)
+            self.assertEqual(len(task.write_spool.files()), 2)
+
+            # the target recovered
+            mock_target_client.write = MagicMock()
+            self.assertEqual(task.write_spool.drain(), 2)
+            self.assertEqual(task.write_spool.files(), [])
+            self.assertEqual(task.write_spool.replayed_rows, 4)
+            mock_target_client.write.assert_any_call(record=b"m usage=1.5 0\nm usage=2.5 1\n", database="downsampled")
+
+    def test_spool_evicts_oldest_batches(self):
+        lines = pa.array(["m usage=1.5 0"] * 100)
+        task = Task()
+        task.task_id = "task"
+        with tempfile.TemporaryDirectory() as tmp:
+            size = os.path.getsize(self.spill_once(tmp, task, lines))
+            spool = WriteSpool(tmp, int(size * 2.5))
+            self.assertTrue(spool.spill(task, lines))
+            oldest = spool.files()[0]
+            self.assertTrue(spool.spill(task, lines))
+            self.assertNotIn(oldest, spool.files())
+            self.assertEqual((len(spool.files()), spool.evicted_files), (2, 1))
+            # a batch larger than the whole spool is not kept
+            self.assertFalse(spool.spill(task, pa.array(["m usage=1.5 0"] * 1000)))
+
+    def spill_once(self, directory, task, lines):
+        spool = WriteSpool(directory, 10**6)
+        spool.spill(task, lines)
+        return spool.files()[0]
+
+    def test_encode_failure_is_not_a_retry(self):
+        mock_target_client = Mock()
+        batch = pa.RecordBatch.from_pydict({
+            "time": pa.array([0], pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5]})
+        mock_reader = Mock()
+        mock_reader.read_chunk.side_effect = [(batch, None), StopIteration()]
+
+        task = Task()
+        task.target_client = mock_target_client
+        task.tags = []
+
+        stats = {}
+        with patch('main.logger'), patch('main.encode_record_batch', side_effect=ValueError("bad batch")):
+            success, error, row_count, retries = write_downsampled_data(task, mock_reader, stats)
+
+        assert not success
+        self.assertEqual(retries, 0)
+        self.assertEqual(stats["error_stage"], "encode")
+        mock_target_client.write.assert_not_called()
+
+    def test_rebatching_and_gzip(self):
+        mock_target_client = Mock()
+        # chunks of 1, 4 and 2 rows
+        chunks = [pa.RecordBatch.from_pydict({
+            "time": pa.array(list(range(start, start + size)), pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5] * size}) for start, size in [(0, 1), (1, 4), (5, 2)]]
+        mock_reader = Mock()
+        mock_reader.read_chunk.side_effect = [(c, None) for c in chunks] + [StopIteration()]
+
+        task = Task()
+        task.target_client = mock_target_client
+        task.target_measurement = "m"
+        task.tags = []
+        task.write_batch_rows = 3
+        task.write_gzip_level = 1
+        # one writer, so the batches arrive in order
+        task.write_workers = 1
+
+        stats = {}
+        with patch('main.logger'):
+            success, error, row_count, retries = write_downsampled_data(task, mock_reader, stats)
+
+        assert success
+        self.assertEqual(row_count, 7)
+        self.assertEqual(stats["write_batches"], 3)
+        lines = []
+        for call in mock_target_client.write.call_args_list:
+            self.assertEqual(call.kwargs["content_encoding"], "gzip")
+            lines.append(gzip.decompress(call.kwargs["record"]).decode().splitlines())
+        self.assertEqual([len(batch) for batch in lines], [3, 3, 1])
+        self.assertEqual(lines[0][0], "m usage=1.5 0")
+        self.assertEqual(stats["write_bytes"], sum(len(line) + 1 for batch in lines for line in batch))
+
+class TestWriteLimiter(unittest.TestCase):
+    def overloaded_error(self, status, retry_after=None):
+        error = Exception("too many requests")
+        error.response = Mock(status=status)
+        error.retry_after = retry_after
+        return error
+
+    def test_additive_increase_multiplicative_decrease(self):
+        limiter = WriteLimiter(4)
+        self.assertEqual(limiter.limit, 1)
+        for _ in range(10):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 4)
+
+        limiter.release(limiter.acquire(), failed=True, overloaded=True, retry_after=0)
+        self.assertEqual(limiter.limit, 2)
+        # writes that started before the decrease do not halve it again
+        started = limiter.acquire()
+        limiter.release(limiter.acquire(), failed=True, overloaded=True, retry_after=0)
+        limiter.release(started, failed=True, overloaded=True, retry_after=0)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_latency_target(self):
+        limiter = WriteLimiter(4, initial=4, latency_target=0.01)
+        started = limiter.acquire()
+        time.sleep(0.02)
+        limiter.release(started)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after_seconds(self.overloaded_error(429, "2")), 2.0)
+        self.assertIsNone(retry_after_seconds(Exception("connection refused")))
+        self.assertTrue(is_overloaded(self.overloaded_error(503)))
+        self.assertTrue(is_overloaded(Exception("connection refused")))
+        self.assertFalse(is_overloaded(self.overloaded_error(400)))
+
+        limiter = WriteLimiter(2)
+        limiter.release(limiter.acquire(), failed=True, overloaded=True, retry_after=0.2)
+        start = time.monotonic()
+        limiter.release(limiter.acquire())
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_write_batch_retries_after_throttling(self):
+        task = Task()
+        task.target_client = Mock()
+        task.target_client.write.side_effect = [self.overloaded_error(429, "0"), None]
+        task.write_limiter = WriteLimiter(4, initial=4)
+
+        with patch('main.logger'):
+            self.assertEqual(write_batch(task, b"m f=1 0\n", 1), 1)
+        self.assertEqual(task.target_client.write.call_count, 2)
+        self.assertLess(task.write_limiter.limit, 4)
+
+class TestLineProtocol(unittest.TestCase):
+    def test_encode_record_batch(self):
+        batch = pa.RecordBatch.from_pydict({
+            "iox::measurement": ["cpu", "cpu", "cpu"],
+            "time": pa.array([0, 60, 120], pa.timestamp("s", tz="UTC")),
+            "host": pa.array(["a b", "c,d", None]).dictionary_encode(),
+            "usage": [1.5, None, float("nan")],
+            "count": pa.array([3, None, 2], pa.int64()),
+            "state": ['say "hi"', None, None]})
+
+        lines = encode_record_batch(batch, "my cpu", ["host"])
+
+        # the second row has no fields and is dropped, NaN is left out of the third
+        self.assertEqual(lines.to_pylist(), [
+            'my\\ cpu,host=a\\ b usage=1.5,count=3i,state="say \\"hi\\"" 0',
+            'my\\ cpu count=2i 120000000000'])
+        self.assertEqual(to_payload(lines.slice(1)), b'my\\ cpu count=2i 120000000000\n')
+
+    def test_encode_without_tags(self):
+        batch = pa.RecordBatch.from_pydict({
+            "time": pa.array([0], pa.timestamp("ns")),
+            "flag": [True],
+            "total": pa.array([7], pa.uint64())})
+
+        lines = encode_record_batch(batch, "m", [])
+        self.assertEqual(lines.to_pylist(), ["m flag=true,total=7u 0"])
+
+    def test_split_lines(self):
+        lines = pa.array(["a", "bb", "ccc", "dddddddd", "e"])
+        # every line counts its newline, a line over the limit gets a slice of its own
+        slices = split_lines(lines, 7)
+        self.assertEqual([s.to_pylist() for s in slices], [["a", "bb"], ["ccc"], ["dddddddd"], ["e"]])
+        self.assertTrue(all(len(to_payload(s)) <= 7 for s in slices if len(s) > 1))
+
+class TestLocalAggregation(unittest.TestCase):
+    # raw rows spanning three 1m buckets, two hosts, a missing tag and null values
+    raw = pa.table({
+        "iox::measurement": ["cpu"] * 10,
+        "time": pa.array([5, 0, 30, 59, 61, 90, 75, 125, 10, 70], pa.timestamp("s", tz="UTC")),
+        "host": pa.array(["a", "a", "b", "a", "a", "a", "b", "a", None, "b"]).dictionary_encode(),
+        "usage": [1.5, 4.0, 3.0, None, 2.0, 8.0, 7.0, None, 6.0, 7.0],
+        "requests": pa.array([1, 4, 3, 9, 2, 8, 5, 4, 6, 5], pa.int64())})
+
+    def influxql_reference(self, field, aggregate):
+        # what GROUP BY time(1m), host returns for each aggregate, computed row by row
+        groups = {}
+        rows = sorted(self.raw.to_pylist(), key=lambda r: r["time"])
+        for row in rows:
+            bucket = row["time"].replace(second=0)
+            groups.setdefault((bucket, row["host"]), []).append(row[field])
+
+        result = []
+        for (bucket, host), values in groups.items():
+            values = [v for v in values if v is not None]
+            if aggregate == "distinct":
+                for value in dict.fromkeys(values):
+                    result.append((bucket, host, value))
+                continue
+            if aggregate == "count":
+                value = len(values)
+            elif len(values) == 0:
+                value = None
+            elif aggregate == "stddev":
+                value = statistics.stdev(values) if len(values) > 1 else None
+            else:
+                value = {"mean": statistics.mean, "median": statistics.median, "sum": sum,
+                         "first": lambda v: v[0], "last": lambda v: v[-1],
+                         "max": max, "min": min}[aggregate](values)
+            result.append((bucket, host, value))
+        return sorted(result, key=lambda r: (r[1] is None, r[1] or "", r[0], r[2] is None, r[2] or 0))
+
+    def local_result(self, field, aggregate):
+        table = aggregate_table(self.raw, [(field, aggregate, field)], ["host"], "1m")
+        result = [(r["time"], r["host"], r[field]) for r in table.to_pylist()]
+        return sorted(result, key=lambda r: (r[1] is None, r[1] or "", r[0], r[2] is None, r[2] or 0))
+
+    def test_parity_with_influxql(self):
+        for aggregate in ["count", "distinct", "mean", "median", "stddev", "sum", "first", "last", "max", "min"]:
+            for field in ["usage", "requests"]:
+                with self.subTest(aggregate=aggregate, field=field):
+                    expected = self.influxql_reference(field, aggregate)
+                    actual = self.local_result(field, aggregate)
+                    self.assertEqual(len(actual), len(expected))
+                    for (e_time, e_host, e_value), (a_time, a_host, a_value) in zip(expected, actual):
+                        self.assertEqual((a_time, a_host), (e_time, e_host))
+                        if e_value is None:
+                            self.assertIsNone(a_value)
+                        else:
+                            self.assertAlmostEqual(a_value, e_value)
+
+    def test_multiple_aggregates_per_field(self):
+        aggregations = [("usage", "mean", "usage_mean"), ("usage", "max", "usage_max"),
+                        ("requests", "count", "requests_count")]
+        table = aggregate_table(self.raw, aggregations, ["host"], "1m")
+        self.assertEqual(table.column_names, ["time", "host", "usage_mean", "usage_max", "requests_count"])
+        first = table.to_pylist()[0]
+        self.assertEqual((first["usage_mean"], first["usage_max"], first["requests_count"]), (2.75, 4.0, 3))
+
+    def test_distinct_can_not_be_combined(self):
+        with self.assertRaises(ValueError):
+            aggregate_table(self.raw, [("usage", "distinct", "usage"), ("requests", "distinct", "requests")],
+                            ["host"], "1m")
+
+    def test_raw_query_selects_fields_and_tags(self):
+        fields = {'usage': 'float', 'state': 'string'}
+        query = get_raw_query(fields, "cpu", datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 1),
+                              ["host"], "mean", None)
+        self.assertIn('"usage",\n\t"host"::tag', query)
+        self.assertNotIn("GROUP BY", query)
+        self.assertNotIn("state", query)
+
+class TestCascade(unittest.TestCase):
+    fields = {"usage": "float", "state": "string"}
+    aggregate = {"usage": ["mean", "max", "count"], "state": ["last"]}
+
+    def test_tier_queries(self):
+        first = get_cascade_query_template(state_aggregations(self.fields, self.aggregate), "cpu", ["host"], "1m")
+        self.assertIn('sum("usage") as "usage_mean__sum"', first)
+        self.assertIn('count("usage") as "usage_mean__count"', first)
+        self.assertIn("time > '$__then'", first)
+
+        higher = get_cascade_query_template(merge_aggregations(self.fields, self.aggregate), "cpu_1m", ["host"], "1h",
+                                            include_then=True)
+        self.assertIn('sum("usage_mean__count") as "usage_mean__count"', higher)
+        self.assertIn('sum("usage_count") as "usage_count"', higher)
+        self.assertIn('last("state_last") as "state_last"', higher)
+        # the first bucket of the lower tier starts exactly at the start of the window
+        self.assertIn("time >= '$__then'", higher)
+        self.assertIn('GROUP BY\n    time(1h), "host"', higher)
+
+    def test_merged_state_matches_raw(self):
+        minute = 60 * 10**9
+        times = [0, 10 * 10**9, minute, minute + 1, 2 * minute, 61 * minute]
+        raw = pa.table({"time": pa.array(times, pa.timestamp("ns", tz="UTC")),
+                        "host": ["a"] * 6,
+                        "usage": [1.0, 2.0, 4.0, None, 10.0, 7.0],
+                        "state": ["x", "y", "z", "w", None, "v"]})
+
+        def tier(table, selections, interval):
+            aggregations = [(column, function, alias) for function, column, alias in selections]
+            result = aggregate_table(table, aggregations, ["host"], interval)
+            reader = MeanReader(MagicMock(read_chunk=Mock(return_value=(result.to_batches()[0], None))), ["usage_mean"])
+            return pa.Table.from_batches([reader.read_chunk()[0]])
+
+        minutes = tier(raw, state_aggregations(self.fields, self.aggregate), "1m")
+        hours = tier(minutes, merge_aggregations(self.fields, self.aggregate), "1h")
+        direct = aggregate_table(raw, [("usage", "mean", "usage_mean"), ("usage", "max", "usage_max"),
+                                       ("usage", "count", "usage_count"), ("state", "last", "state_last")],
+                                 ["host"], "1h")
+
+        for column in ["usage_mean", "usage_max", "usage_count", "state_last"]:
+            self.assertEqual(hours.column(column).to_pylist(), direct.column(column).to_pylist(), column)
+        self.assertEqual(hours.column("usage_mean").to_pylist(), [17 / 4, 7.0])
+
+    def test_tier_windows(self):
+        task = Task()
+        task.target_measurement = "cpu"
+        task.cascade_tiers = [{"interval": "1h", "interval_val": 1, "interval_type": "h", "measurement": "cpu_1h"},
+                              {"interval": "1d", "interval_val": 1, "interval_type": "d", "measurement": "cpu_1d"}]
+        then = datetime(2023, 7, 7, 23, 59, tzinfo=timezone.utc)
+        now = datetime(2023, 7, 8, 0, 0, tzinfo=timezone.utc)
+
+        with patch('main.run_tier', return_value=True) as mock_run_tier:
+            self.assertTrue(run_cascade(task, then, now))
+            # a window in the middle of the hour closes no tier
+            self.assertTrue(run_cascade(task, then - timedelta(minutes=30), now - timedelta(minutes=30)))
+
+        self.assertEqual([c.args[2:] for c in mock_run_tier.call_args_list], [
+            ("cpu", datetime(2023, 7, 7, 23, 0, tzinfo=timezone.utc), now),
+            ("cpu_1h", datetime(2023, 7, 7, 0, 0, tzinfo=timezone.utc), now)])
+
+class TestBackfill(unittest.TestCase):
+    def test_get_backfill_windows(self):
+        windows = get_backfill_windows(10, "m", datetime(2023, 7, 7, 12, 5), datetime(2023, 7, 7, 12, 30))
+        self.assertEqual(windows, [datetime(2023, 7, 7, 12, 10),
+                                   datetime(2023, 7, 7, 12, 20),
+                                   datetime(2023, 7, 7, 12, 30)])
+
+    def test_get_backfill_windows_across_midnight(self):
+        windows = get_backfill_windows(1, "h", datetime(2023, 7, 7, 22, 30), datetime(2023, 7, 8, 1, 0))
+        self.assertEqual(windows, [datetime(2023, 7, 7, 23), datetime(2023, 7, 8, 0), datetime(2023, 7, 8, 1)])
+
+        # every window of a 6h task ends on an aligned boundary
+        windows = get_backfill_windows(6, "h", datetime(2023, 7, 7, 12, tzinfo=timezone.utc),
+                                       datetime(2023, 7, 8, 3, tzinfo=timezone.utc))
+        self.assertEqual([w.hour for w in windows], [18, 0, 6])
+
+        windows = get_backfill_windows(1, "d", datetime(2023, 7, 31, 5), datetime(2023, 8, 1))
+        self.assertEqual(windows, [datetime(2023, 8, 1)])
+
+    def test_watermark_stops_at_first_failure(self):
+        windows = get_backfill_windows(1, "m", datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 6))
+        failing = datetime(2023, 7, 7, 12, 4)
+
+        def run_window(now):
+            # finish later windows first to exercise out of order completion
+            time.sleep(0.01 * (len(windows) - windows.index(now)))
+            return now != failing
+
+        with tempfile.TemporaryDirectory() as tmp:
+            watermark_file = os.path.join(tmp, "watermark")
+            completed, failed = run_windows(windows, run_window, concurrency=4, watermark_file=watermark_file)
+            watermark = read_watermark(watermark_file)
+
+        self.assertEqual((completed, failed), (5, 1))
+        self.assertEqual(watermark, datetime(2023, 7, 7, 12, 3))
+        self.assertEqual(skip_completed_windows(windows, watermark)[0], failing)
+
+    def test_group_windows(self):
+        windows = get_backfill_windows(1, "m", datetime(2023, 7, 7, 12, 0), datetime(2023, 7, 7, 12, 5))
+        self.assertEqual(group_windows(windows, 2), [datetime(2023, 7, 7, 12, 2),
+                                                     datetime(2023, 7, 7, 12, 4),
+                                                     datetime(2023, 7, 7, 12, 5)])
+        self.assertEqual(group_windows(windows, 1), windows)
+
+
+class TestSubwindows(unittest.TestCase):
+    def test_split_window_aligned_to_buckets(self):
+        then = datetime(2023, 7, 7, 12, 3, tzinfo=timezone.utc)
+        now = datetime(2023, 7, 7, 12, 40, tzinfo=timezone.utc)
+        subwindows = split_window(then, now, timedelta(minutes=10), 2)
+        self.assertEqual(subwindows, [(then, datetime(2023, 7, 7, 12, 20, tzinfo=timezone.utc)),
+                                      (datetime(2023, 7, 7, 12, 20, tzinfo=timezone.utc), now)])
+
+    def test_intervals_per_subwindow(self):
+        self.assertEqual(intervals_per_subwindow(60), 60)
+        self.assertEqual(intervals_per_subwindow(60, subwindow_intervals=10), 10)
+        # the row budget wins once the density is known
+        self.assertEqual(intervals_per_subwindow(60, 10, row_budget=1000, rows_per_interval=200), 5)
+        self.assertEqual(intervals_per_subwindow(60, 10, row_budget=1000), 10)
+
+    def chunks(self, values):
+        reader = MagicMock()
+        reader.read_chunk.side_effect = [(v, None) for v in values] + [StopIteration]
+        return lambda: (True, reader)
+
+    def test_concurrent_reader_returns_every_chunk(self):
+        reader = ConcurrentChunkReader([self.chunks([1, 2]), self.chunks([3]), self.chunks([])],
+                                       max_concurrency=2, queue_size=1)
+        results = []
+        while True:
+            try:
+                chunk, _ = reader.read_chunk()
+            except StopIteration:
+                break
+            results.append(chunk)
+        self.assertEqual(sorted(results), [1, 2, 3])
+
+    def test_concurrent_reader_raises_query_errors(self):
+        reader = ConcurrentChunkReader([self.chunks([1]), lambda: (False, "query failed")])
+        with self.assertRaises(SubwindowQueryError):
+            while True:
+                reader.read_chunk()
+
+class TestCheckpointStore(unittest.TestCase):
+    def test_completed_windows_survive_reopening(self):
+        ends = [datetime(2023, 7, 7, 12, m, tzinfo=timezone.utc) for m in (1, 2, 4)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "checkpoints.db")
+            store = SQLiteCheckpointStore(path)
+            store.mark_completed("task", ends, row_count=10)
+            store.close()
+
+            store = SQLiteCheckpointStore(path)
+            self.assertEqual(store.first_window("task"), ends[0])
+            self.assertIsNone(store.first_window("other"))
+            self.assertEqual(store.completed_windows("task", ends[0], ends[-1]), set(ends))
+            self.assertTrue(store.is_completed("task", ends[:2]))
+            self.assertFalse(store.is_completed("task", [datetime(2023, 7, 7, 12, 3, tzinfo=timezone.utc)]))
+            # naive windows are in UTC
+            self.assertTrue(store.is_completed("task", [datetime(2023, 7, 7, 12, 4)]))
+            store.close()
+
+    def test_run_skips_completed_window(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteCheckpointStore(os.path.join(tmp, "checkpoints.db"))
+            task = Task()
+            task.task_id = "task"
+            task.interval_val, task.interval_type = 1, "m"
+            task.checkpoint_store = store
+            task.source_client = Mock()
+            now = datetime(2023, 7, 7, 12, 5, tzinfo=timezone.utc)
+            store.mark_completed("task", [now])
+
+            with patch('main.logger'):
+                self.assertTrue(run(task, now=now))
+            task.source_client.query.assert_not_called()
+            store.close()
+
+    def test_claims_keep_overlapping_runs_apart(self):
+        ends = [datetime(2023, 7, 7, 12, m, tzinfo=timezone.utc) for m in (1, 2)]
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteCheckpointStore(os.path.join(tmp, "checkpoints.db"))
+            self.assertTrue(store.claim("task", ends[1:]))
+            self.assertFalse(store.claim("task", ends))
+            # the failed claim gave back the window it had claimed
+            self.assertTrue(store.claim("task", ends[:1]))
+            self.assertTrue(store.claim("other", ends))
+            store.release("task", ends)
+            self.assertTrue(store.claim("task", ends))
+
+            task = Task()
+            task.task_id = "task"
+            task.interval_val, task.interval_type = 1, "m"
+            task.checkpoint_store = store
+            task.source_client = Mock()
+            with patch('main.logger'):
+                self.assertTrue(run(task, now=ends[1]))
+            task.source_client.query.assert_not_called()
+            store.close()
+
+    def test_incomplete_backend_fails_when_created(self):
+        class PartialStore(CheckpointStore):
+            def mark_completed(self, task_id, window_ends, row_count=None):
+                pass
+
+        with self.assertRaises(TypeError):
+            PartialStore()
+
+    def test_late_data_reruns_changed_windows(self):
+        now = datetime(2023, 7, 7, 12, 5, tzinfo=timezone.utc)
+        minute = timedelta(minutes=1)
+        # buckets start at 12:01 to 12:04, their windows end a minute later
+        buckets = [datetime(2023, 7, 7, 12, m, tzinfo=timezone.utc) for m in range(1, 5)]
+        counts = pa.table({"time": pa.array(buckets, pa.timestamp("ns", tz="UTC")),
+                           "usage": [5, 5, 7, 2],
+                           "state": [1, 1, 1, None]})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteCheckpointStore(os.path.join(tmp, "checkpoints.db"))
+            store.record_source_counts("task", {now - 3 * minute: 6, now - minute: 6})
+            # the window ending 12:03 failed when it was scheduled
+            store.mark_completed("task", [now - 3 * minute, now - minute])
+            task = Task()
+            task.task_id = "task"
+            task.interval, task.interval_val, task.interval_type = "1m", 1, "m"
+            task.fields = {"usage": "float", "state": "string"}
+            task.tags = []
+            task.checkpoint_store = store
+            task.late_data_windows = 3
+            task.source_client = Mock()
+            task.source_client.query.return_value = counts
+
+            with patch('main.logger'), patch('main.setup_tags_and_fields'), \
+                    patch('main.run', return_value=True) as mock_run:
+                self.assertTrue(run_with_late_data(task, now=now))
+
+            # the failed window is run again, and only the window ending 12:04 changed, from 6 to 8 points
+            self.assertEqual(mock_run.call_args_list, [unittest.mock.call(task, now=now, then=None, scheduler_lag=None),
+                                                       unittest.mock.call(task, now=now - 2 * minute),
+                                                       unittest.mock.call(task, now=now - minute, rerun=True)])
+            self.assertEqual(store.source_counts("task", now - 3 * minute, now),
+                             {now - 3 * minute: 6, now - 2 * minute: 6, now - minute: 8, now: 2})
+            store.close()
+
+class TestDiagnostics(unittest.TestCase):
+    def test_sampled_run_logs_plan_and_chunks(self):
+        chunks = [pa.RecordBatch.from_pydict({
+            "time": pa.array([0, 1], pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5, 2.5]})] * 2
+        reader = Mock()
+        reader.read_chunk.side_effect = [(c, None) for c in chunks] + [StopIteration()]
+
+        task = Task()
+        task.task_id = "task"
+        task.interval, task.interval_val, task.interval_type = "1m", 1, "m"
+        task.fields, task.tags = {"usage": "float"}, []
+        task.source_measurement, task.target_measurement = "cpu", "cpu_1m"
+        task.target_client = Mock()
+        task.logging_client = Mock()
+        task.source_client = Mock()
+        task.source_client.query.return_value = pa.table({"plan_type": ["Plan with Metrics"],
+                                                          "plan": ["ProjectionExec: elapsed_compute=1ms"]})
+        task.diagnostics_sample_rate = 1
+
+        with patch('main.logger'), patch('main.setup_tags_and_fields'), \
+                patch('main.run_query', return_value=(True, reader)):
+            self.assertTrue(run(task, now=datetime(2023, 7, 7, 12, 5, tzinfo=timezone.utc)))
+
+        explain = task.source_client.query.call_args
+        self.assertTrue(explain.args[0].startswith("EXPLAIN ANALYZE SELECT"))
+        points = [c.args[0] for c in task.logging_client.write.call_args_list]
+        diagnostics = [p for p in points if p._name == "task_diagnostics"]
+        self.assertEqual([p._tags["record"] for p in diagnostics], ["run", "chunk", "chunk"])
+        self.assertEqual(diagnostics[0]._fields["plan"], "Plan with Metrics: ProjectionExec: elapsed_compute=1ms")
+        self.assertEqual(diagnostics[0]._fields["chunks"], 2)
+        self.assertEqual(diagnostics[2]._fields["rows"], 2)
+        self.assertGreaterEqual(diagnostics[2]._fields["arrival_time"], diagnostics[1]._fields["arrival_time"])
+
+class TestProfiler(unittest.TestCase):
+    def test_profiled_run_logs_cpu_time_and_peak_memory(self):
+        chunks = [pa.RecordBatch.from_pydict({
+            "time": pa.array([0, 1], pa.timestamp("ns", tz="UTC")),
+            "usage": [1.5, 2.5]})] * 3
+        reader = Mock()
+        reader.read_chunk.side_effect = [(c, None) for c in chunks] + [StopIteration()]
+
+        task = Task()
+        task.task_id = "task"
+        task.interval, task.interval_val, task.interval_type = "1m", 1, "m"
+        task.fields, task.tags = {"usage": "float"}, []
+        task.source_measurement, task.target_measurement = "cpu", "cpu_1m"
+        task.target_client = Mock()
+        task.logging_client = Mock()
+        task.write_workers = 2
+        task.profile_sample_rate = 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            task.profile_dir = directory
+            with patch('main.logger'), patch('main.setup_tags_and_fields'), \
+                    patch('main.run_query', return_value=(True, reader)):
+                self.assertTrue(run(task, now=datetime(2023, 7, 7, 12, 5, tzinfo=timezone.utc)))
+
+            point = task.logging_client.write.call_args.args[0]
+            self.assertGreater(point._fields["cpu_time"], 0)
+            self.assertGreater(point._fields["peak_mem_bytes"], 0)
+            self.assertEqual(os.listdir(directory), ["task-20230707T120400Z.prof"])
+            # the write workers are merged into the run's profile
+            stats = pstats.Stats(os.path.join(directory, "task-20230707T120400Z.prof"))
+            functions = [name for _, _, name in stats.stats]
+            self.assertIn("encode_record_batch", functions)
+            self.assertIn("write_batch", functions)
+
+    def test_unsampled_run_is_not_profiled(self):
+        task = Task()
+        task.interval_val, task.interval_type = 1, "m"
+        task.profile_sample_rate = 0
+        with patch('main.run_window', return_value=True) as run_window, patch('main.RunProfile') as profile:
+            self.assertTrue(run(task, now=datetime(2023, 7, 7, 12, 5, tzinfo=timezone.utc),
+                                then=datetime(2023, 7, 7, 12, 4, tzinfo=timezone.utc)))
+        profile.assert_not_called()
+        self.assertEqual(len(run_window.call_args.args), 5)
+
+class TestWriteDedup(unittest.TestCase):
+    def make_reader(self, usage):
+        batch = pa.RecordBatch.from_pydict({
+            "iox::measurement": ["cpu"] * 3,
+            "time": pa.array([60_000_000_000] * 3, pa.timestamp("ns", tz="UTC")),
+            "host": pa.array(["a", "b", "c"]).dictionary_encode(),
+            "usage": usage})
+        reader = Mock()
+        reader.read_chunk.side_effect = [(batch, None), StopIteration()]
+        return reader
+
+    def make_task(self):
+        task = Task()
+        task.target_client = Mock()
+        task.target_db = "downsampled"
+        task.target_measurement = "cpu_1m"
+        task.tags = ["host"]
+        task.write_workers = 1
+        task.written_hashes = WrittenHashes(100, 3600)
+        return task
+
+    def test_rerun_only_writes_changed_series(self):
+        task = self.make_task()
+        with patch('main.logger'):
+            write_downsampled_data(task, self.make_reader([1.0, 2.0, 3.0]))
+            stats = {}
+            success, _, row_count, _ = write_downsampled_data(task, self.make_reader([1.0, 2.5, 3.0]), stats)
+            self.assertTrue(success)
+            self.assertEqual(row_count, 3)
+            self.assertEqual(stats["skipped_rows"], 2)
+            self.assertEqual(stats["write_rows"], 1)
+            self.assertEqual(task.target_client.write.call_args.kwargs["record"],
+                             b"cpu_1m,host=b usage=2.5 60000000000\n")
+
+            # nothing changed, nothing is written
+            task.target_client.write.reset_mock()
+            stats = {}
+            write_downsampled_data(task, self.make_reader([1.0, 2.5, 3.0]), stats)
+            self.assertEqual(stats["skipped_rows"], 3)
+            task.target_client.write.assert_not_called()
+
+            # the same values in another measurement are not the same rows
+            task.target_measurement = "cpu_1h"
+            write_downsampled_data(task, self.make_reader([1.0, 2.5, 3.0]))
+            task.target_client.write.assert_called_once()
+
+    def test_failed_write_is_not_remembered(self):
+        task = self.make_task()
+        task.max_write_retries = 1
+        task.target_client.write.side_effect = Exception("unavailable")
+        with patch('main.logger'), patch('write_limiter.random.random', return_value=0), \
+                patch.object(task, 'write_limiter', WriteLimiter(1, backoff_base=0)):
+            success, _, _, _ = write_downsampled_data(task, self.make_reader([1.0, 2.0, 3.0]))
+            self.assertFalse(success)
+
+            task.target_client.write.side_effect = None
+            stats = {}
+            self.assertTrue(write_downsampled_data(task, self.make_reader([1.0, 2.0, 3.0]), stats)[0])
+        self.assertEqual(stats["skipped_rows"], 0)
+        self.assertEqual(stats["write_rows"], 3)
+
+    def test_hashes_are_evicted_oldest_first_and_after_the_ttl(self):
+        batch = pa.RecordBatch.from_pydict({"time": pa.array(range(4), pa.timestamp("s", tz="UTC")),
+                                            "host": ["a", "b", "a", None],
+                                            "state": ["on", None, "on", "off"]})
+        keys, values = row_hashes(batch, "cpu", ["host"])
+        self.assertEqual(len(set(keys.tolist())), 4)
+        self.assertEqual(values[0], values[2])
+
+        hashes = WrittenHashes(3)
+        hashes.remember(keys, values)
+        self.assertEqual(len(hashes), 3)
+        self.assertEqual(hashes.unchanged(keys, values).tolist(), [False, True, True, True])
+
+        expiring = WrittenHashes(10, ttl=60)
+        with patch('write_dedup.time.monotonic', return_value=1000):
+            expiring.remember(keys[:2], values[:2])
+        with patch('write_dedup.time.monotonic', return_value=1030):
+            expiring.remember(keys[2:], values[2:])
+        with patch('write_dedup.time.monotonic', return_value=1070):
+            self.assertEqual(expiring.unchanged(keys, values).tolist(), [False, False, True, True])
+            expiring.remember(keys[3:], values[3:])
+        self.assertEqual(len(expiring), 2)
+
+class TestTelemetry(unittest.TestCase):
+    def test_lines_are_batched_and_flushed_on_close(self):
+        client = Mock()
+        telemetry = TelemetryFlusher(flush_interval=60)
+        telemetry.submit(("host", "logs"), client, "logs", "task_log,task_id=a row_count=1i 1")
+        telemetry.submit(("host", "logs"), client, "logs", "task_log,task_id=b row_count=2i 2")
+        client.write.assert_not_called()
+
+        telemetry.close()
+        client.write.assert_called_once_with(
+            record=b"task_log,task_id=a row_count=1i 1\ntask_log,task_id=b row_count=2i 2", database="logs")
+
+    def test_full_buffer_spills_and_replays(self):
+        client = Mock()
+        client.write.side_effect = Exception("logging instance down")
+        with tempfile.TemporaryDirectory() as tmp:
+            telemetry = TelemetryFlusher(flush_interval=60, max_lines=2, spill_dir=tmp)
+            for i in range(3):
+                telemetry.submit(("host", "logs"), client, "logs", f"task_log row_count={i}i {i}")
+            self.assertEqual(telemetry.spilled, 1)
+
+            # failed lines stay buffered until the logging instance is back
+            telemetry.flush()
+            client.write.side_effect = None
+            client.write.reset_mock()
+            telemetry.flush()
+            telemetry.close()
+
+        payloads = [call.kwargs["record"] for call in client.write.call_args_list]
+        self.assertEqual(payloads, [b"task_log row_count=2i 2", b"task_log row_count=0i 0\ntask_log row_count=1i 1"])
+        self.assertEqual(telemetry.dropped, 0)
+
+    def test_flushed_on_sigterm(self):
+        script = ("import os, time, atexit, signal, main\n"
+                  "main.setup_logger()\n"
+                  "main.setup_shutdown_handler()\n"
+                  "atexit.register(lambda: print('flushed', flush=True))\n"
+                  "os.kill(os.getpid(), signal.SIGTERM)\n"
+                  "time.sleep(10)\n")
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=30,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("flushed", result.stdout)
+
+class TestMetrics(unittest.TestCase):
+    def test_render_histogram_and_counter(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram("test_seconds", "Test latency.", buckets=(0.1, 1))
+        total = registry.counter("test_bytes", "Test bytes.")
+        latency.observe(0.05, task_id="a")
+        latency.observe(0.5, task_id="a")
+        latency.observe(5, task_id="a")
+        total.inc(10, task_id="a")
+
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP test_seconds Test latency.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{task_id="a",le="0.1"} 1',
+            'test_seconds_bucket{task_id="a",le="1.0"} 2',
+            'test_seconds_bucket{task_id="a",le="+Inf"} 3',
+            'test_seconds_sum{task_id="a"} 5.55',
+            'test_seconds_count{task_id="a"} 3',
+            "# HELP test_bytes Test bytes.",
+            "# TYPE test_bytes counter",
+            'test_bytes_total{task_id="a"} 10',
+            "# EOF"])
+        self.assertIn("# TYPE test_bytes_total counter", registry.render(openmetrics=False))
+
+    def test_metrics_endpoint(self):
+        server = start_metrics_server(0, "127.0.0.1")
+        try:
+            request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/metrics",
+                                             headers={"Accept": "application/openmetrics-text"})
+            with urllib.request.urlopen(request) as response:
+                body = response.read().decode()
+                self.assertTrue(response.headers["Content-Type"].startswith("application/openmetrics-text"))
+        finally:
+            server.shutdown()
+        self.assertIn("# TYPE downsampler_write_batch_seconds histogram", body)
+        self.assertTrue(body.endswith("# EOF\n"))
+
+    def test_scheduled_time(self):
+        task = Task()
+        task.schedule_start = datetime(2023, 7, 7, 12, 0)
+        task.schedule_interval = timedelta(minutes=10)
+        self.assertEqual(get_scheduled_time(task, datetime(2023, 7, 7, 12, 20, 3)), datetime(2023, 7, 7, 12, 20))
+        task.schedule_interval = None
+        self.assertEqual(get_scheduled_time(task, datetime(2023, 7, 7, 12, 0, 1)), datetime(2023, 7, 7, 12, 0))
+
+class TestScheduler(unittest.TestCase):
+    def make_task(self):
+        task = Task()
+        task.task_id = "task"
+        task.interval, task.interval_val, task.interval_type = "10m", 10, "m"
+        task.schedule_start = datetime(2023, 7, 7, 12, 0)
+        task.schedule_interval = timedelta(minutes=10)
+        return task
+
+    def test_missed_windows_are_coalesced(self):
+        task = self.make_task()
+        scheduled = datetime(2023, 7, 7, 12, 40, tzinfo=timezone.utc)
+        self.assertEqual(get_scheduled_window(task, scheduled), (scheduled - timedelta(minutes=10), scheduled))
+
+        # the runs due at 12:20 and 12:30 were skipped while the one of 12:10 was still going
+        task.last_window_end = scheduled - timedelta(minutes=30)
+        self.assertEqual(get_scheduled_window(task, scheduled), (task.last_window_end, scheduled))
+
+        task.max_coalesced_windows = 2
+        with patch('main.logger'):
+            self.assertEqual(get_scheduled_window(task, scheduled), (scheduled - timedelta(minutes=20), scheduled))
+
+    def test_scheduled_run_logs_lag_and_coalesced_windows(self):
+        task = self.make_task()
+        task.fields, task.tags = {"usage": "float"}, []
+        task.source_measurement, task.target_measurement = "cpu", "cpu_10m"
+        task.target_client = Mock()
+        task.logging_client = Mock()
+        scheduled = datetime(2023, 7, 7, 12, 40)
+        missed = (scheduled - timedelta(minutes=30)).astimezone(timezone.utc)
+        task.last_window_end = missed
+        reader = Mock()
+        reader.read_chunk.side_effect = StopIteration()
+
+        with patch('main.logger'), patch('main.setup_tags_and_fields'), \
+                patch('main.run_query', return_value=(True, reader)) as run_query, \
+                patch('main.datetime') as mock_datetime:
+            mock_datetime.now.return_value = scheduled + timedelta(seconds=3)
+            self.assertTrue(run_scheduled(task))
+
+        # one query over the three windows
+        query = run_query.call_args.args[1]
+        self.assertIn("time(10m)", query)
+        self.assertIn(f"time > '{missed.strftime('%Y-%m-%d %H:%M:%S')}'", query)
+        fields = task.logging_client.write.call_args.args[0]._fields
+        self.assertEqual(fields["coalesced_windows"], 3)
+        self.assertEqual(fields["scheduler_lag"], 3)
+        self.assertEqual(task.last_window_end, scheduled.astimezone(timezone.utc))
+
+    def test_runs_of_a_task_never_overlap(self):
+        task = self.make_task()
+        with patch('main.logger'), patch('apscheduler.schedulers.background.BlockingScheduler') as scheduler:
+            schedule_and_run([task])
+        job = scheduler.return_value.add_job.call_args.kwargs
+        self.assertEqual(job["max_instances"], 1)
+        self.assertTrue(job["coalesce"])
+        self.assertIsNone(job["misfire_grace_time"])
+
+class TestFleet(unittest.TestCase):
+    def test_rendezvous_only_moves_tasks_to_a_new_replica(self):
+        tasks = [f"task-{i}" for i in range(200)]
+        before = {task: rendezvous_owner(task, ["a", "b", "c"]) for task in tasks}
+        after = {task: rendezvous_owner(task, ["a", "b", "c", "d"]) for task in tasks}
+        moved = [task for task in tasks if before[task] != after[task]]
+        self.assertTrue(all(after[task] == "d" for task in moved))
+        self.assertTrue(20 < len(moved) < 80)
+
+    def test_replicas_split_the_tasks_and_take_over_when_one_leaves(self):
+        tasks = [f"task-{i}" for i in range(20)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "leases.db")
+            a = Fleet(SQLiteLeaseStore(path), "a", lease_ttl=60)
+            b = Fleet(SQLiteLeaseStore(path), "b", lease_ttl=60)
+            a.heartbeat()
+            b.heartbeat()
+            a.heartbeat()
+
+            owned_a = [task for task in tasks if a.acquire(task)]
+            owned_b = [task for task in tasks if b.acquire(task)]
+            self.assertEqual(sorted(owned_a + owned_b), sorted(tasks))
+            self.assertTrue(owned_a and owned_b)
+
+            a.close()
+            b.heartbeat()
+            self.assertTrue(all(b.acquire(task) for task in tasks))
+            b.close()
+
+    def test_lease_is_exclusive_until_it_expires(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteLeaseStore(os.path.join(tmp, "leases.db"))
+            self.assertTrue(store.acquire("task", "a", expires=100, now=0))
+            # b does not see a as a member yet, the lease still keeps it from running the task
+            self.assertFalse(store.acquire("task", "b", expires=150, now=50))
+            self.assertTrue(store.acquire("task", "a", expires=200, now=50))
+            self.assertTrue(store.acquire("task", "b", expires=300, now=250))
+            store.release("task", "a")
+            self.assertFalse(store.acquire("task", "a", expires=300, now=260))
+            store.close()
+
+    def test_start_offsets_are_stable_and_within_the_interval(self):
+        interval = timedelta(minutes=1)
+        offsets = [get_start_offset(f"task-{i}", interval, 300) for i in range(50)]
+        self.assertTrue(all(timedelta(0) <= offset < interval for offset in offsets))
+        self.assertGreater(len(set(offsets)), 10)
+        self.assertEqual(get_start_offset("task-1", interval, 300), offsets[1])
+        self.assertEqual(get_start_offset("task-1", interval, 0), timedelta(0))
+
+    def test_task_owned_by_another_replica_is_skipped(self):
+        task = Task()
+        task.task_id = "task"
+        task.last_window_end = datetime(2023, 7, 7, 12, 0, tzinfo=timezone.utc)
+        task.fleet = Mock()
+        task.fleet.acquire.return_value = False
+        with patch('main.logger'), patch('main.run_with_late_data') as run_with_late_data:
+            self.assertTrue(run_scheduled(task))
+        run_with_late_data.assert_not_called()
+        self.assertIsNone(task.last_window_end)
+
+    def test_staggered_run_keeps_its_window_aligned(self):
+        task = Task()
+        task.task_id = "task"
+        task.interval_val, task.interval_type = 10, "m"
+        task.start_offset = timedelta(seconds=150)
+        task.schedule_start = datetime(2023, 7, 7, 12, 0) + task.start_offset
+        task.schedule_interval = timedelta(minutes=10)
+        with patch('main.logger'), patch('main.run_with_late_data', return_value=True) as run_with_late_data, \
+                patch('main.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2023, 7, 7, 12, 32, 31)
+            self.assertTrue(run_scheduled(task))
+        now = run_with_late_data.call_args.kwargs["now"]
+        self.assertEqual(now, datetime(2023, 7, 7, 12, 30).astimezone(timezone.utc))
+        self.assertEqual(run_with_late_data.call_args.kwargs["scheduler_lag"], 1)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
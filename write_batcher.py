@@ -0,0 +1,45 @@
+import gzip
+
+import pyarrow as pa
+
+
+class BatchCoalescer:
+    """
+    Re-chunks the record batches of a query stream into batches of max_rows rows, so the
+    number of writes no longer depends on the chunk size the server picked. Small chunks
+    are combined and large chunks are sliced. max_rows can be changed between batches.
+    """
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, batch):
+        # returns the batches that are full
+        ready = []
+        if self._pending and batch.schema != self._pending[0].schema:
+            # batches with different columns can not be combined
+            ready.extend(self.flush())
+        if batch.num_rows > 0:
+            self._pending.append(batch)
+            self._pending_rows += batch.num_rows
+        while self._pending_rows >= self.max_rows:
+            table = pa.Table.from_batches(self._pending)
+            ready.append(table.slice(0, self.max_rows).combine_chunks().to_batches()[0])
+            rest = table.slice(self.max_rows)
+            self._pending = rest.combine_chunks().to_batches() if rest.num_rows > 0 else []
+            self._pending_rows = rest.num_rows
+        return ready
+
+    def flush(self):
+        if not self._pending:
+            return []
+        table = pa.Table.from_batches(self._pending).combine_chunks()
+        self._pending = []
+        self._pending_rows = 0
+        return table.to_batches()
+
+
+def gzip_payload(payload, level):
+    return gzip.compress(payload, compresslevel=level)
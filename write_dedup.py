@@ -0,0 +1,124 @@
+import time
+import hashlib
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from line_protocol import IGNORED_COLUMNS
+
+NULL_HASH = np.uint64(0x9e3779b97f4a7c15)
+
+
+def mix(hashes):
+    # the splitmix64 finalizer, spreads every input bit over the whole 64 bit hash
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xbf58476d1ce4e5b9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def hash_string(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def hash_array(array):
+    # one 64 bit hash per value, computed for the whole array at once
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    data_type = array.type
+    if pa.types.is_dictionary(data_type):
+        # the dictionary is hashed once, the rows only look their value up
+        dictionary = hash_array(array.dictionary)
+        indices = pc.fill_null(array.indices, 0).to_numpy(zero_copy_only=False)
+        hashes = dictionary[indices] if len(dictionary) else np.zeros(len(array), np.uint64)
+    elif pa.types.is_floating(data_type):
+        values = pc.fill_null(pc.cast(array, pa.float64()), 0.0).to_numpy(zero_copy_only=False)
+        hashes = mix(values.view(np.uint64))
+    elif pa.types.is_integer(data_type) or pa.types.is_boolean(data_type) or pa.types.is_timestamp(data_type):
+        values = pc.fill_null(pc.cast(array, pa.int64()), 0).to_numpy(zero_copy_only=False)
+        hashes = mix(values.view(np.uint64))
+    else:
+        # strings are hashed once per distinct value
+        encoded = pc.dictionary_encode(array)
+        distinct = np.fromiter((hash_string(value) for value in encoded.dictionary.to_pylist()),
+                               dtype=np.uint64, count=len(encoded.dictionary))
+        indices = pc.fill_null(encoded.indices, 0).to_numpy(zero_copy_only=False)
+        hashes = distinct[indices] if len(distinct) else np.zeros(len(array), np.uint64)
+    if array.null_count:
+        hashes = np.where(array.is_valid().to_numpy(zero_copy_only=False), hashes, NULL_HASH)
+    return hashes
+
+
+def hash_columns(batch, names, seed):
+    hashes = np.full(batch.num_rows, np.uint64(hash_string(seed)), dtype=np.uint64)
+    for name in names:
+        hashes = mix((hashes * np.uint64(31)) ^ hash_array(batch.column(name)))
+    return hashes
+
+
+def row_hashes(batch, measurement, tag_columns, timestamp_column="time"):
+    """
+    Returns two hashes for every row of a downsampled batch: one of the series and window
+    it belongs to, from the measurement, the tags and the time, and one of its aggregated
+    values. Columns are selected like encode_record_batch does.
+    """
+    names = batch.schema.names
+    tag_columns = [t for t in tag_columns if t in names]
+    field_columns = [n for n in names
+                     if n not in tag_columns and n != timestamp_column and n not in IGNORED_COLUMNS]
+    key_columns = tag_columns + ([timestamp_column] if timestamp_column in names else [])
+    keys = hash_columns(batch, key_columns, f"{measurement}\n{','.join(key_columns)}")
+    values = hash_columns(batch, field_columns, ",".join(field_columns))
+    return keys, values
+
+
+class WrittenHashes:
+    """
+    Remembers the value hash last written for each series and window, so rows a re-run
+    computes again with the same values are not written again. It holds at most max_entries
+    hashes and forgets them ttl seconds after they were written, the oldest written first.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # in the order they were written, the oldest first
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def unchanged(self, keys, values):
+        # a mask of the rows whose values were already written
+        expired = -1.0 if self.ttl is None else time.monotonic() - self.ttl
+        with self._lock:
+            get = self._hashes.get
+            entries = [get(key) for key in keys.tolist()]
+        return np.fromiter((entry is not None and entry[0] == value and entry[1] > expired
+                            for entry, value in zip(entries, values.tolist())),
+                           dtype=bool, count=len(entries))
+
+    def remember(self, keys, values):
+        now = time.monotonic()
+        with self._lock:
+            hashes = self._hashes
+            for key, value in zip(keys.tolist(), values.tolist()):
+                # written again, so it moves to the end
+                hashes.pop(key, None)
+                hashes[key] = (value, now)
+            self._evict(now)
+
+    def _evict(self, now):
+        hashes = self._hashes
+        while len(hashes) > self.max_entries:
+            del hashes[next(iter(hashes))]
+        if self.ttl is not None:
+            while hashes:
+                oldest = next(iter(hashes))
+                if now - hashes[oldest][1] < self.ttl:
+                    break
+                del hashes[oldest]
@@ -0,0 +1,89 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+
+def retry_after_seconds(exception):
+    # the Retry-After header of a failed write, in seconds, or None
+    value = getattr(exception, "retry_after", None)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_overloaded(exception):
+    # 429 and 5xx responses, and writes that got no response at all, mean the target needs less load
+    response = getattr(exception, "response", None)
+    status = getattr(response, "status", None)
+    if status is None:
+        return True
+    return status == 429 or status >= 500
+
+
+class WriteLimiter:
+    """
+    Limits the writes in flight to a target with additive increase, multiplicative decrease:
+    every successful write raises the limit by about one per limit writes, up to max_limit,
+    and a write the target rejected as overloaded, or one slower than latency_target, halves
+    it. After a failed write no write starts until its Retry-After, or an exponential backoff
+    with jitter, has passed.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial=None, latency_target=None,
+                 decrease_factor=0.5, backoff_base=1.0, backoff_cap=60.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.limit = float(min(max_limit, initial if initial is not None else min_limit))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._failures = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        # blocks until a write may start, returns the start time to pass to release
+        with self._condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return time.monotonic()
+                self._condition.wait(wait if wait > 0 else None)
+
+    def _decrease(self, started):
+        # writes that started before the last decrease saw the old limit, they only count once
+        if started < self._last_decrease:
+            return
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        self._last_decrease = time.monotonic()
+
+    def release(self, started, failed=False, overloaded=False, retry_after=None):
+        with self._condition:
+            self.in_flight -= 1
+            latency = time.monotonic() - started
+            if failed:
+                self._failures += 1
+                if overloaded:
+                    self._decrease(started)
+                if retry_after is None:
+                    retry_after = min(self.backoff_cap, self.backoff_base * 2 ** (self._failures - 1)) + random.random()
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                self._failures = 0
+                if self.latency_target is not None and latency > self.latency_target:
+                    self._decrease(started)
+                else:
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._condition.notify_all()